@@ -0,0 +1,337 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import engine
+from engine import TemplateEngine
+
+
+# The largest corpora in the 'corpora' folder, whose loading cost dominates the construction of engines that use them
+LARGE_CORPORA = ('surnames.txt', 'forenames.txt', 'occupations.txt')
+
+
+def best_time(function, repeat=5, number=1):
+    """Return the fastest of several timings of the given function, in seconds per call.
+
+    Taking the minimum, rather than the mean, filters out most of the noise from whatever else the machine is
+    doing, which makes the numbers comparable from one run to the next.
+
+    Args:
+        function:
+            A callable that takes no arguments.
+        repeat:
+            An int, being the number of timings to take.
+        number:
+            An int, being the number of calls in each timing.
+
+    Returns:
+        A float, being the fastest timing divided by 'number'.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append(time.perf_counter() - start)
+    return min(timings) / number
+
+
+def template_files():
+    """Return the paths of the template definitions files in the 'templates' folder, in sorted order."""
+    return sorted(glob.glob('templates/*.txt'))
+
+
+def bench_parse(results):
+    """Time the construction of an engine for each file in the 'templates' folder, with a cold corpus cache.
+
+    The 'parse' measurements cover everything an engine does before it can generate: reading the file, loading
+    the corpora it references, parsing the definitions and compiling the templates. The 'parse_lazy'
+    measurements are of engines that defer loading their corpora (see TemplateEngine's 'lazy_corpora'), so
+    they leave out the loading, which happens later, as the slots are first filled.
+    """
+    for file_path in template_files():
+        for lazy_corpora in (False, True):
+            def construct():
+                engine.corpus_cache.clear()
+                TemplateEngine(file_path=file_path, random_seed=0, lazy_corpora=lazy_corpora)
+            name = 'parse_lazy' if lazy_corpora else 'parse'
+            results[f"{name}/{os.path.basename(file_path)}"] = best_time(construct)
+
+
+def bench_corpus_load(results):
+    """Time the loading of the largest corpora, both into tuples of strings and as memory-mapped corpora."""
+    for corpus_filename in LARGE_CORPORA:
+        for mapped in (False, True):
+            def load():
+                engine.corpus_cache.clear()
+                TemplateEngine._load_corpus(corpus_filename=corpus_filename, mapped=mapped)
+            name = 'corpus_load_mmap' if mapped else 'corpus_load'
+            results[f"{name}/{corpus_filename}"] = best_time(load)
+
+
+def bench_generate(results, number=2000):
+    """Time generate() for every template in every file in the 'templates' folder, in seconds per output."""
+    for file_path in template_files():
+        template_engine = TemplateEngine(file_path=file_path, random_seed=0)
+        for template in template_engine.templates:
+            generate = template_engine.generate
+            template_name = template.name
+            seconds = best_time(lambda: generate(template_name), repeat=3, number=number)
+            results[f"generate/{os.path.basename(file_path)}/{template_name}"] = seconds
+
+
+def bench_single_use(results, number=20000):
+    """Time the single-use pool of the 'WORD1' slot in 'c6_template.txt', whose values are all single-use.
+
+    Every value is drawn exactly once between refills, so this exercises the draw, the swap-remove and the
+    refill of the pool (see Slot.draw()), both on their own and within the template that uses the slot.
+    """
+    template_engine = TemplateEngine(file_path='templates/c6_template.txt', random_seed=0)
+    template = template_engine._get_template(template_name='DADAIST_ADVANCED')
+    # The template unescapes its whole output, so the slot it fills is the filtered 'WORD1|unescape'
+    slot = next(slot for slot in template.slots if slot.name.split('|')[0] == 'WORD1')
+    rng = template._rngs[template.slots.index(slot)]
+    results['single_use/WORD1_fill'] = best_time(lambda: slot.fill(rng), repeat=3, number=number)
+    results['single_use/DADAIST_ADVANCED'] = best_time(
+        lambda: template_engine.generate('DADAIST_ADVANCED'), repeat=3, number=number // 10
+    )
+
+
+def bench_memory(results):
+    """Measure the peak memory allocated while constructing an engine for each file in the 'templates' folder.
+
+    The corpus cache is cleared first, so that the corpora an engine loads count against it. As in
+    bench_parse(), the 'peak_memory_lazy' measurements are of engines that defer loading their corpora.
+    """
+    for file_path in template_files():
+        for lazy_corpora in (False, True):
+            engine.corpus_cache.clear()
+            tracemalloc.start()
+            template_engine = TemplateEngine(file_path=file_path, random_seed=0, lazy_corpora=lazy_corpora)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del template_engine
+            name = 'peak_memory_lazy' if lazy_corpora else 'peak_memory'
+            results[f"{name}/{os.path.basename(file_path)}"] = peak
+
+
+# The benchmarks run by run_suite(), in order
+SUITE = (bench_parse, bench_corpus_load, bench_generate, bench_single_use, bench_memory)
+
+
+def run_suite():
+    """Run every benchmark in the suite.
+
+    Returns:
+        A dictionary mapping the name of each measurement to its value. Every value is one where lower is better:
+        seconds (per call, for the 'generate' and 'single_use' measurements) or, for the memory ones, bytes.
+    """
+    results = {}
+    for benchmark in SUITE:
+        benchmark(results)
+    engine.corpus_cache.clear()
+    return results
+
+
+def format_value(name, value):
+    """Return a measurement formatted for display, in units that suit its size."""
+    if name.startswith(('peak_memory/', 'peak_memory_lazy/')):
+        return f"{value / 1024:10.1f} KiB"
+    if value < 1e-3:
+        return f"{value * 1e6:10.2f} us"
+    return f"{value * 1e3:10.2f} ms"
+
+
+def save_baseline(results, path):
+    """Save the results of a run of the suite as a JSON baseline, for later runs to be compared against."""
+    baseline = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(path, 'w') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write('\n')
+
+
+def compare(results, baseline_path, threshold=0.2):
+    """Compare the results of a run of the suite against a JSON baseline saved by save_baseline().
+
+    Args:
+        results:
+            A dictionary of results, as returned by run_suite().
+        baseline_path:
+            A string containing the path to the baseline.
+        threshold:
+            A float, being how much worse than the baseline a measurement can get (as a fraction: 0.2 means 20%
+            slower, or 20% more memory) before it counts as a regression.
+
+    Returns:
+        A list of the names of the measurements that regressed.
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)['results']
+    regressions = []
+    for name in sorted(set(baseline) | set(results)):
+        if name not in results or name not in baseline:
+            status = 'removed' if name not in results else 'new'
+            print(f"{name:<64} {status}")
+            continue
+        ratio = results[name] / baseline[name] if baseline[name] else 1.0
+        if ratio > 1 + threshold:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            status = 'improved'
+        else:
+            status = ''
+        print(
+            f"{name:<64} {format_value(name, baseline[name])} -> {format_value(name, results[name])} "
+            f"({ratio:5.2f}x) {status}"
+        )
+    return regressions
+
+
+def write_synthetic_definitions(file_path, size):
+    """Write a synthetic template definitions file with the given number of slots and of templates.
+
+    Slot i has three values, and template i references slot i along with one other slot, so that the
+    templates section (which comes first, as in our own files) is full of forward references.
+
+    Args:
+        file_path:
+            A string containing the path to write the file to.
+        size:
+            An int, being the number of slots (and also the number of templates) to define.
+    """
+    with open(file_path, 'w') as definitions_file:
+        definitions_file.write("<BEGIN TEMPLATES>\n\n")
+        for i in range(size):
+            definitions_file.write(f"TEMPLATE_{i} -> The <SLOT_{i}> met the <SLOT_{(i * 7919) % size}>.\n")
+        definitions_file.write("\n<END TEMPLATES>\n\n<BEGIN SLOTS>\n\n")
+        for i in range(size):
+            definitions_file.write(f"SLOT_{i} -> red_{i},green_{i},blue_{i}\n")
+        definitions_file.write("\n<END SLOTS>\n")
+
+
+def bench_parse_scaling(sizes=(1000, 10000, 100000)):
+    """Time the parsing of synthetic definitions files of increasing size.
+
+    Parsing (TemplateEngine._parse_template_definition_file()) and compiling the parsed templates are reported
+    separately. If both are linear, the time per definition stays roughly flat as the files grow.
+
+    Args:
+        sizes:
+            A sequence of ints, being the numbers of slots (and of templates) in each synthetic file.
+
+    Returns:
+        A list of (size, parse seconds, compile seconds) tuples.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            file_path = os.path.join(directory, f"synthetic_{size}.txt")
+            write_synthetic_definitions(file_path=file_path, size=size)
+            start = time.perf_counter()
+            template_engine = TemplateEngine(file_path=file_path, random_seed=0)
+            total_seconds = time.perf_counter() - start
+            # Compiling again takes as long as the compile that was part of construction, so subtracting it
+            # leaves the time spent parsing
+            start = time.perf_counter()
+            template_engine._compile_templates()
+            compile_seconds = time.perf_counter() - start
+            parse_seconds = total_seconds - compile_seconds
+            results.append((size, parse_seconds, compile_seconds))
+            print(
+                f"{size:>8} slots + {size:>8} templates: "
+                f"parse {parse_seconds:7.3f} s ({parse_seconds / size * 1e6:5.1f} us each), "
+                f"compile {compile_seconds:7.3f} s ({compile_seconds / size * 1e6:5.1f} us each)"
+            )
+    return results
+
+
+def bench_reload(size=100000):
+    """Time TemplateEngine.reload() after a one-line edit to a synthetic definitions file, against a full parse.
+
+    Args:
+        size:
+            An int, being the number of slots (and of templates) in the synthetic file.
+
+    Returns:
+        A (full parse seconds, reload seconds) tuple.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, f"synthetic_{size}.txt")
+        write_synthetic_definitions(file_path=file_path, size=size)
+        start = time.perf_counter()
+        template_engine = TemplateEngine(file_path=file_path, random_seed=0)
+        full_seconds = time.perf_counter() - start
+        with open(file_path) as definitions_file:
+            contents = definitions_file.read()
+        with open(file_path, 'w') as definitions_file:
+            definitions_file.write(contents.replace("SLOT_0 -> red_0,", "SLOT_0 -> pink_0,"))
+        # Make sure the edit shows up even on file systems with coarse modification times
+        stat = os.stat(file_path)
+        os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        start = time.perf_counter()
+        template_engine.reload()
+        reload_seconds = time.perf_counter() - start
+    print(
+        f"{size:>8} slots + {size:>8} templates: "
+        f"full parse {full_seconds:7.3f} s, one-line reload {reload_seconds:7.3f} s"
+    )
+    return full_seconds, reload_seconds
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line. Run this from the root of the repository:
+
+        python bench.py                                  # Run the suite and print the results
+        python bench.py --save bench_baseline.json       # ...and save them as a baseline
+        python bench.py --compare bench_baseline.json    # ...or compare them against a saved baseline
+        python bench.py --scaling 1000 10000 100000      # Run the synthetic parse-scaling and reload benchmarks
+
+    With --compare, the exit status is 1 if any measurement regressed by more than the threshold.
+
+    Args:
+        argv:
+            A list of command-line arguments, or None to use sys.argv.
+    """
+    parser = argparse.ArgumentParser(prog='python bench.py', description='Benchmarks for the template engine.')
+    parser.add_argument('--save', metavar='PATH', help='Save the results as a JSON baseline.')
+    parser.add_argument('--compare', metavar='PATH', help='Compare the results against a JSON baseline.')
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='How much worse than the baseline a measurement can get before it counts as a regression (default 0.2).'
+    )
+    parser.add_argument(
+        '--scaling', type=int, nargs='*', metavar='SIZE',
+        help='Run the synthetic parse-scaling and reload benchmarks instead of the suite.'
+    )
+    args = parser.parse_args(argv)
+    if args.scaling is not None:
+        sizes = args.scaling or (1000, 10000, 100000)
+        bench_parse_scaling(sizes=sizes)
+        bench_reload(size=max(sizes))
+        return
+    results = run_suite()
+    if args.save:
+        save_baseline(results=results, path=args.save)
+    if args.compare:
+        regressions = compare(results=results, baseline_path=args.compare, threshold=args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}.")
+            sys.exit(1)
+        return
+    for name, value in results.items():
+        print(f"{name:<64} {format_value(name, value)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,21 @@
 from engine import TemplateEngine
 
 def component1a():
-    engine = TemplateEngine(file_path="templates/c1_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c1_template.txt")
     
     for i in range(5):
         output = engine.generate(template_name="NO_CORPUS")
         print(f"{i} {output}")
 
 def component1b():
-    engine = TemplateEngine(file_path="templates/c1_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c1_template.txt")
     
     for i in range(5):
         output = engine.generate(template_name="YES_CORPUS")
         print(f"{i} {output}")
     
 def component1c():
-    engine = TemplateEngine(file_path="templates/c1_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c1_template.txt")
     
     for i in range(5):
         output = engine.generate(template_name="MY_CORPUS")
@@ -23,7 +23,7 @@ def component1c():
 
 
 def component1d():
-    engine = TemplateEngine(file_path="templates/c1_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c1_template.txt")
   
     multi_line_output = ""
 
@@ -2,13 +2,13 @@ from engine import TemplateEngine
 
 def component2a():
     for i in range(5):
-        engine = TemplateEngine(file_path="templates/c1_template.txt", random_seed = 3)
+        engine = TemplateEngine.cached(file_path="templates/c1_template.txt", random_seed = 3)
         output = engine.generate(template_name="NO_CORPUS")
         print(f"{i} {output}")
 
 
 def component2b():
-    engine = TemplateEngine(file_path="templates/c2_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c2_template.txt")
 
     for i in range(10):
         output = engine.generate(template_name="PROBABILISTIC")
@@ -16,7 +16,7 @@ def component2b():
 
 
 def component2c():
-    engine = TemplateEngine(file_path="templates/c2_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c2_template.txt")
 
     for i in range(10):
         output = engine.generate(template_name="OPTIONAL")
@@ -24,7 +24,7 @@ def component2c():
 
 
 def component2d():
-    engine = TemplateEngine(file_path="templates/c2_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c2_template.txt")
 
     for i in range(10):
         output = engine.generate(template_name="OPTIONAL2")
@@ -32,55 +32,33 @@ def component2d():
 
 
 def component2e():
-    engine = TemplateEngine(file_path="templates/c2_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c2_template.txt")
     print("\nCapitalizing the first character of each line...\n")
     for i in range(5):
-        output = engine.generate(template_name="LOWERCASE").capitalize()
+        output = engine.generate(template_name="LOWERCASE_CAPITALIZED")
 
         print(f"{i} {output}")
     
     print("\nNow onto capitalizing every character...\n")
     for i in range(5):
-        output = engine.generate(template_name="LOWERCASE")
+        output = engine.generate(template_name="LOWERCASE_SHOUTED")
 
-        final_output = ""
-        for j in range(len(output)):
-          final_output+= output[j].capitalize()
-
-        print(f"{i} {final_output}")
+        print(f"{i} {output}")
 
 
 def component2f():
-    engine = TemplateEngine(file_path="templates/c2_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c2_template.txt")
 
     for i in range(10):
         output = engine.generate(template_name="CONJUGATION")
-        output_word_list = output.split()
-        
-        if output_word_list[3][0] == "a" or output_word_list[3][0] == "e" or output_word_list[3][0] == "i" or output_word_list[3][0] == "o" or output_word_list[3][0] == "u":
-          output_word_list[2] = "an"
-        else: 
-          output_word_list[2] = "a"
-        
-        if output_word_list[7][0] == "a" or output_word_list[7][0] == "e" or output_word_list[7][0] == "i" or output_word_list[7][0] == "o" or output_word_list[7][0] == "u":
-          output_word_list[6] = "an"
-        else: 
-          output_word_list[6] = "a"
-        
-        final_output = ""
-        for j in range(len(output_word_list)):
-          final_output += f" {output_word_list[j]}"
-        
-        print(f"{i} {final_output}")
+        print(f"{i} {output}")
 
 def component2g():
-    engine = TemplateEngine(file_path="templates/c2_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c2_template.txt")
 
     for i in range(5):
         output = engine.generate(template_name="NEWLINE")
-        output_list = output.split('\\n')
-        for j in range (len(output_list)):
-          print(f"{output_list[j]}")
+        print(output)
         print(" ")
 
 
@@ -1,7 +1,7 @@
 from engine import TemplateEngine
 
 def component4():
-    engine = TemplateEngine(file_path="templates/c4_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c4_template.txt")
     
     for i in range(5):
         output = engine.generate(template_name="SHANNON_ZERO")
@@ -1,13 +1,13 @@
 from engine import TemplateEngine
 
 def component5a():
-  engine = TemplateEngine(file_path="templates/c5_template.txt")
+  engine = TemplateEngine.cached(file_path="templates/c5_template.txt")
   for _ in range(5):
     print(engine.generate(template_name="PLOT_SKELETON"),end='\n\n')
 
 
 def component5b():
-  engine = TemplateEngine(file_path="templates/c5_template.txt")
+  engine = TemplateEngine.cached(file_path="templates/c5_template.txt")
   for _ in range(5):
     print(engine.generate(template_name="PLOT_PROSE1"),end='\n\n')
 
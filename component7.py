@@ -1,7 +1,7 @@
 from engine import TemplateEngine
 
 def component7a():
-    engine = TemplateEngine(file_path="templates/c7_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c7_template.txt")
     
     for i in range(10):
         output = engine.generate(template_name="ALPHABETICAL")
@@ -9,7 +9,7 @@ def component7a():
 
 
 def component7b():
-    engine = TemplateEngine(file_path="templates/c7_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c7_template.txt")
     
     for i in range(10):
         output = engine.generate(template_name="LONGER")
@@ -17,7 +17,7 @@ def component7b():
 
 
 def component7c():
-    engine = TemplateEngine(file_path="templates/c7_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c7_template.txt")
     
     for i in range(10):
         output = engine.generate(template_name="PALINDROME")
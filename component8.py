@@ -1,35 +1,29 @@
 from engine import TemplateEngine
 
 def component8a():
-    engine = TemplateEngine(file_path="templates/c8_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c8_template.txt")
 
     for i in range(5):
         output = engine.generate(template_name="QUATRAIN")
-        output_list = output.split('\\n')
-        for j in range (len(output_list)):
-          print(f"{output_list[j]}")
+        print(output)
         print("\n")
 
 
 def component8b():
-    engine = TemplateEngine(file_path="templates/c8_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c8_template.txt")
 
     for i in range(5):
         output = engine.generate(template_name="LIMERICK")
-        output_list = output.split('\\n')
-        for j in range (len(output_list)):
-          print(f"{output_list[j]}")
+        print(output)
         print("\n")
 
 
 def component8c():
-    engine = TemplateEngine(file_path="templates/c8_template.txt")
+    engine = TemplateEngine.cached(file_path="templates/c8_template.txt")
 
     for i in range(5):
         output = engine.generate(template_name="HAIKU")
-        output_list = output.split('\\n')
-        for j in range (len(output_list)):
-          print(f"{output_list[j]}")
+        print(output)
         print("\n")
 
 
@@ -1,4 +1,26 @@
+import hashlib
+import mmap
+import multiprocessing
+import os
+import pickle
 import random
+import re
+import struct
+import threading
+import time
+import weakref
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from functools import lru_cache, partial
+from itertools import accumulate, repeat
+from math import prod
+
+try:
+    import numpy
+except ImportError:  # NumPy is only needed for batched generation via generate_many()
+    numpy = None
 
 class TemplateEngine:
     """An engine for template-based text generation.
@@ -6,23 +28,720 @@ class TemplateEngine:
     Attributes:
         templates:
             A list of Template objects, one for each template in the given template definitions file.
+        reload_error:
+            The Exception raised by the most recent attempt of the watcher (see watch()) to reload the engine,
+            or None if that attempt succeeded (or there hasn't been one).
     """
 
-    def __init__(self, file_path, random_seed=None):
+    def __init__(self, file_path, random_seed=None, mmap_corpora=False, single_use_policy='refill',
+                 max_template_depth=32, lazy_corpora=True):
         """Initialize a TemplateEngine object.
         
         Args:
             file_path:
                 A string containing the path to a template definitions file in the expected format.
             random_seed:
-                A value that will be used to seed the random module. If None is passed, no seed 
-                will be used. Look up random seeds if you're not familiar with the notion.
+                A value that will be used to seed this engine's random generators. If None is passed, no seed
+                will be used. Look up random seeds if you're not familiar with the notion. Note that the engine
+                never touches the global state of the random module: each template gets its own generators,
+                seeded from this value (see Template.compile()), so engines don't perturb one another, and a
+                template's outputs don't change when other templates are added to the file or called.
+            mmap_corpora:
+                If True, corpora referenced by slots are memory-mapped rather than read into lists of strings,
+                and each fill decodes only the line that it picks (see MappedCorpus). This is worth turning
+                on for huge corpora like 'surnames.txt'.
+            single_use_policy:
+                A string, being the policy that slots will use for single-use values. See Slot.SINGLE_USE_POLICIES.
+            max_template_depth:
+                An int, being how deeply templates may be nested inside one another via references like
+                '<@ENDING>'.
+            lazy_corpora:
+                If True, a slot that references corpora doesn't load them until it's first used, so that the
+                engine only ever loads the corpora of the templates that are actually generated from (and none
+                for slots that no template uses). See prewarm() for loading them up front instead. The corpus
+                files are still checked for existence straight away.
         """
-        # Parse the template definitions file located at the given file path
+        self.mmap_corpora = mmap_corpora
+        self.lazy_corpora = lazy_corpora
+        self.single_use_policy = single_use_policy
+        self.max_template_depth = max_template_depth
+        # If we didn't receive a random seed, we'll make one up, so that everything downstream can derive its
+        # own seed from this one in the same way regardless
+        if random_seed is None:
+            random_seed = random.SystemRandom().getrandbits(64)
+        self.random_seed = random_seed
+        self.file_path = file_path
+        # Parse the template definitions file located at the given file path. The parser also fills in
+        # self.corpus_paths, the paths of the corpus files that the definitions reference.
         self.templates = self._parse_template_definition_file(file_path=file_path)
-        # If we received a random seed, use it to seed the random module
-        if random_seed is not None:
-            random.seed(random_seed)
+        self._compile_templates()
+        self._set_up_reloading()
+        # Set by enable_instrumentation()
+        self._instrumentation = None
+
+    def _compile_templates(self):
+        """Compile each template into a flat render program, and index the templates by name.
+
+        With the index, generate() can retrieve a template with a single dictionary lookup, instead of scanning
+        the whole list of templates on every call. Any references to other templates are expanded first, so
+        that a composite template compiles into a single program and is generated in one go.
+
+        Raises:
+            Exception:
+                A template references an undefined template, the references form a cycle, or they are nested
+                more deeply than max_template_depth.
+        """
+        templates_by_name = {template.name: template for template in self.templates}
+        expansions, depths = self._expand_template_references(templates_by_name=templates_by_name)
+        for template in self.templates:
+            template.compile(random_seed=self.random_seed, elements=expansions[template.name])
+        self._templates_by_name = templates_by_name
+        # Keep the expansions, and an index of which templates depend on which slots and templates, so that
+        # reload() can work out what an edit affects without looking at every template
+        self._expansions = expansions
+        self._depths = depths
+        self._slot_users = {}
+        self._referrers = {}
+        for template in self.templates:
+            self._index_template(name=template.name, elements=template.template)
+
+    def _expand_template_references(self, templates_by_name, roots=None, expansions=None, depths=None):
+        """Expand every reference to another template (e.g., '<@ENDING>') into that template's elements.
+
+        We do this without recursion, by walking the graph of references with an explicit stack. The walk is
+        a depth-first search that finishes a template only after it has finished every template it references,
+        which lets us catch cycles (a template we're still in the middle of turns up again) and means that
+        when we come to expand a template, the expansions of the templates it references are already done. So
+        each template is expanded exactly once, however many other templates reference it.
+
+        Args:
+            templates_by_name:
+                A dictionary mapping each template name to its Template object.
+            roots:
+                A list of the names of the templates to expand. If None is passed, every template is expanded.
+            expansions:
+                A dictionary of templates that have already been expanded, as returned by an earlier call. It's
+                updated in place. Any template in it is taken as is, rather than expanded again.
+            depths:
+                A dictionary giving the nesting depth of each template in 'expansions'. It's updated in place.
+
+        Returns:
+            A tuple containing two dictionaries. The first maps each template name to a list of strings and Slot
+            objects, being the template's elements with every template reference replaced by the referenced
+            template's expanded elements. The second maps each template name to how deeply template references
+            are nested inside it.
+
+        Raises:
+            Exception:
+                A template references an undefined template, the references form a cycle, or they are nested
+                more deeply than max_template_depth.
+        """
+        if roots is None:
+            roots = [template.name for template in self.templates]
+        expansions = {} if expansions is None else expansions
+        depths = {} if depths is None else depths
+        in_progress = set()
+        for root in roots:
+            if root in expansions:
+                continue
+            # Each stack entry is a template name and a flag saying whether its references have been visited
+            stack = [(root, False)]
+            path = []  # The chain of templates we're in the middle of, for error messages
+            while stack:
+                name, references_visited = stack.pop()
+                template = templates_by_name[name]
+                if references_visited:
+                    elements = []
+                    depth = 0
+                    for element in template.template:
+                        if isinstance(element, TemplateReference):
+                            if element.filters:
+                                elements += self._filter_elements(
+                                    elements=expansions[element.name], filters=element.filters
+                                )
+                            else:
+                                elements += expansions[element.name]
+                            depth = max(depth, depths[element.name] + 1)
+                        else:
+                            elements.append(element)
+                    if template.filters:
+                        elements = self._filter_elements(elements=elements, filters=template.filters)
+                    if depth > self.max_template_depth:
+                        raise Exception(
+                            f"Template '{name}' nests template references {depth} deep, but the limit is "
+                            f"{self.max_template_depth}."
+                        )
+                    expansions[name] = elements
+                    depths[name] = depth
+                    in_progress.discard(name)
+                    path.pop()
+                    continue
+                if name in expansions:
+                    continue
+                in_progress.add(name)
+                path.append(name)
+                stack.append((name, True))
+                for element in template.template:
+                    if not isinstance(element, TemplateReference):
+                        continue
+                    if element.name not in templates_by_name:
+                        raise Exception(f"Template '{name}' references an undefined template '{element.name}'.")
+                    if element.name in in_progress:
+                        cycle = path[path.index(element.name):] + [element.name]
+                        raise Exception(f"Template references form a cycle: {' -> '.join(cycle)}.")
+                    if element.name not in expansions:
+                        stack.append((element.name, False))
+        return expansions, depths
+
+    @staticmethod
+    def _filter_elements(elements, filters):
+        """Apply template-level filters (see Template.TEMPLATE_FILTERS) to a template's expanded elements.
+
+        Each filter is applied to every static element, and to every slot by way of Slot.filtered(), which
+        filters the slot's values up front. For 'upper', 'lower' and 'unescape', filtering the pieces of an output
+        is the same as filtering the whole thing. 'cap' upper-cases the first character that isn't whitespace
+        and lower-cases the rest, so it's applied to the first element that could supply that character (the
+        first static element that isn't blank, or the first slot, whichever comes first), and 'lower' is applied
+        to every element after it. (If that slot has a blank value, and it's drawn, the output won't be
+        capitalized.)
+
+        Args:
+            elements:
+                A list of strings, Slot objects and RhymeReference objects.
+            filters:
+                A tuple of strings, each being one of Template.TEMPLATE_FILTERS.
+
+        Returns:
+            A list of strings, Slot objects and RhymeReference objects.
+        """
+        for filter_name in filters:
+            elements = list(elements)
+            for position, element in enumerate(elements):
+                if isinstance(element, Slot):
+                    elements[position] = element.filtered(filters=(filter_name,))
+                elif isinstance(element, RhymeReference):
+                    elements[position] = RhymeReference(
+                        slot=element.slot.filtered(filters=(filter_name,)), target=element.target
+                    )
+                else:
+                    elements[position] = Slot.FILTERS[filter_name](element)
+                if filter_name == 'cap' and (not isinstance(element, str) or element.strip()):
+                    filter_name = 'lower'  # Everything after the capitalized character is lower-cased
+        return elements
+
+    def _index_template(self, name, elements, add=True):
+        """Record (or, if 'add' is False, forget) which slots and templates the given template depends on.
+
+        Args:
+            name:
+                A string, being the template's name.
+            elements:
+                A list of the template's (unexpanded) elements.
+            add:
+                If True, record the dependencies; otherwise, remove them.
+        """
+        for element in elements:
+            if isinstance(element, RhymeReference):
+                element = element.slot
+            if isinstance(element, Slot):
+                # A filtered or constrained slot (e.g., 'ADJ|cap') depends on the slot it's derived from
+                dependents = self._slot_users.setdefault(element.name.split('|', 1)[0], set())
+            elif isinstance(element, TemplateReference):
+                dependents = self._referrers.setdefault(element.name, set())
+            else:
+                continue
+            if add:
+                dependents.add(name)
+            else:
+                dependents.discard(name)
+
+    @classmethod
+    def cached(cls, file_path, random_seed=None, **options):
+        """Return an engine for the given file, reusing the definitions parsed for an earlier engine if possible.
+
+        This takes the same arguments as __init__(), and returns an engine that behaves just like a newly
+        constructed one (see fork()), but the file is only parsed the first time an engine is asked for (and
+        again if it changes). See EngineCache.
+
+        Returns:
+            A TemplateEngine object.
+        """
+        return engine_cache.get(file_path=file_path, random_seed=random_seed, **options)
+
+    def fork(self, random_seed=None):
+        """Return a new engine that shares this engine's parsed definitions but has random state of its own.
+
+        Parsing (reading the definitions file and loading its corpora) is by far the bulk of the work of
+        constructing an engine, and none of it depends on the seed. So instead of parsing again, the fork gets
+        new Template objects with the same definitions, which it compiles with its own seed. Compiling sets up
+        fresh random generators and fresh pools for single-use values (see Template.compile()), so the fork's
+        outputs are exactly those of a new engine constructed with the same seed, and generating from the fork
+        has no effect on this engine, or vice versa.
+
+        Args:
+            random_seed:
+                A value that will be used to seed the fork's random generators, just as in __init__().
+
+        Returns:
+            A TemplateEngine object.
+        """
+        engine = TemplateEngine.__new__(TemplateEngine)
+        # Everything but the compiled templates and per-engine state, just as when pickling
+        engine.__dict__.update(self.__getstate__())
+        engine._source_layout = self._source_layout  # The fork is in the same process, so the hashes still hold
+        if random_seed is None:
+            random_seed = random.SystemRandom().getrandbits(64)
+        engine.random_seed = random_seed
+        engine.templates = [
+            Template(name=template.name, template=template.template, filters=template.filters)
+            for template in self.templates
+        ]
+        engine._compile_templates()
+        engine._set_up_reloading()
+        engine._instrumentation = None
+        return engine
+
+    # The first bytes of every template pack, and the version of the pack format. The version must be bumped
+    # whenever a change to this module changes what gets pickled into a pack.
+    PACK_MAGIC = b'TPLPACK\0'
+    PACK_VERSION = 7
+    PACK_HEADER = struct.Struct('<8sI32s')
+
+    def content_hash(self):
+        """Return a SHA-256 digest of this engine's template definitions file and every corpus it references.
+
+        Returns:
+            A bytes object, being the digest.
+        """
+        digest = hashlib.sha256()
+        for path in [self.file_path] + sorted(self.corpus_paths):
+            with open(path, 'rb') as source_file:
+                contents = source_file.read()
+            # Include each path and length, so that moving bytes between files can't produce the same digest
+            digest.update(f"{path}\0{len(contents)}\0".encode('utf-8'))
+            digest.update(contents)
+        return digest.digest()
+
+    def compile_pack(self, pack_path):
+        """Save this engine's fully parsed slots, corpora and templates to a template pack.
+
+        A template pack lets a process skip parsing the template definitions file, and loading the corpora it
+        references, altogether: TemplateEngine.from_pack() gets an engine back with a single read of the pack.
+        The pack is versioned, and keyed by a content hash of the definitions file and the corpora, so that a
+        stale pack can be detected (see from_pack()). Memory-mapped corpora are stored by path, not contents.
+
+        The pack holds the engine's state, as pickled (see __getstate__()), less its random seed, which is
+        given afresh to from_pack(). Compiled templates aren't pickled either, so they're compiled just once, by
+        from_pack(), with that seed. Since loading a pack unpickles it, and unpickling can run arbitrary code,
+        only load packs that you (or someone you trust) compiled; see from_pack().
+
+        Args:
+            pack_path:
+                A string containing the path to write the pack to.
+        """
+        header = self.PACK_HEADER.pack(self.PACK_MAGIC, self.PACK_VERSION, self.content_hash())
+        state = self.__getstate__()
+        del state['random_seed']
+        payload = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        # Write to a temporary file first, so that a reader never sees a half-written pack
+        temporary_path = f"{pack_path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as pack_file:
+            pack_file.write(header)
+            pack_file.write(payload)
+        os.replace(temporary_path, pack_path)
+
+    @classmethod
+    def from_pack(cls, pack_path, random_seed=None, verify=False):
+        """Load a TemplateEngine from a template pack written by compile_pack().
+
+        A pack is a pickle, and unpickling a file can run any code it asks to, so only load packs from a trusted
+        source, such as a directory that only you can write to. The header and content hash check that the file
+        is a pack, and (with 'verify') that it isn't stale, but they don't check who wrote it: anyone can write
+        a file with a valid header.
+
+        Args:
+            pack_path:
+                A string containing the path to a template pack.
+            random_seed:
+                A value that will be used to seed the engine's random generators, just as in __init__(). The
+                pack doesn't store the seed of the engine that wrote it (see compile_pack()).
+            verify:
+                If True, recompute the content hash of the definitions file and corpora that the pack was
+                built from, and raise an Exception if they've changed since. This means reading those files
+                (though not parsing them), so it's off by default.
+
+        Returns:
+            A TemplateEngine object.
+
+        Raises:
+            IOError:
+                There is no file at the given path.
+            Exception:
+                The file is not a template pack, was written by an incompatible version of this module, or
+                (if 'verify' is True) is stale.
+        """
+        with open(pack_path, 'rb') as pack_file:
+            contents = pack_file.read()
+        try:
+            magic, version, content_hash = cls.PACK_HEADER.unpack_from(contents)
+        except struct.error:
+            magic = version = content_hash = None
+        if magic != cls.PACK_MAGIC:
+            raise Exception(f"'{pack_path}' is not a template pack.")
+        if version != cls.PACK_VERSION:
+            raise Exception(f"Template pack '{pack_path}' has version {version}, but version {cls.PACK_VERSION} is needed.")
+        state = pickle.loads(memoryview(contents)[cls.PACK_HEADER.size:])
+        state['random_seed'] = random.SystemRandom().getrandbits(64) if random_seed is None else random_seed
+        # Restoring the state compiles the templates, with the seed we've just given it
+        engine = cls.__new__(cls)
+        engine.__setstate__(state)
+        if verify and engine.content_hash() != content_hash:
+            raise Exception(f"Template pack '{pack_path}' is stale; its sources have changed since it was compiled.")
+        return engine
+
+    def __getstate__(self):
+        # The compiled form of each template is rebuilt on unpickling (see __setstate__()), so don't pickle it,
+        # and a lock or a watcher thread can't be pickled at all
+        state = self.__dict__.copy()
+        for name in ('_templates_by_name', '_expansions', '_depths', '_slot_users', '_referrers', '_reload_lock',
+                     '_watcher'):
+            del state[name]
+        # String hashes differ from one process to the next, so the line hashes of the source layout are no good
+        # anywhere else (reload() scans the whole file again when there's no layout)
+        state['_source_layout'] = None
+        # Instrumentation stays with the engine it was enabled on
+        state.pop('generate', None)
+        state.pop('_instrumentation', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile_templates()
+        self._set_up_reloading()
+        self._instrumentation = None
+
+    def _set_up_reloading(self):
+        """Set up the state used by reload() and watch()."""
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        self.reload_error = None
+
+    @staticmethod
+    def _stat_source(path):
+        """Return a (modification time in nanoseconds, size) tuple for the file at the given path, or None if
+        there's no such file. If either number changes, we take it that the file has changed."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self):
+        """Bring this engine up to date with any edits to its template definitions file or corpora.
+
+        Only what has changed is scanned and parsed again. If the definitions file has been edited, it's read
+        again, and the hash of each of its lines is compared with the hash that line had last time (see
+        SourceLayout), to find the range of lines that the edit touched. Only those lines are scanned again, so
+        only the slots and templates defined on them count as edited (unless the edit adds or removes a section
+        marker, in which case the whole file is scanned again, and every definition is compared against the text
+        it had last time). A slot is parsed again only if its definition was edited or a corpus it references has
+        changed; a template, only if its definition was edited or it uses a slot that was parsed again. Finally,
+        the templates that were parsed again are compiled, along with any templates that reference them
+        (directly or through other templates). Every other slot and template is kept exactly as it was, without
+        being looked at, and corpora that haven't changed aren't read at all. So, apart from reading the file and
+        hashing its lines, a reload costs in proportion to the size of the edit, not the size of the file.
+
+        The new state is built on the side and then swapped in with a single assignment, so a generate() call
+        that's in progress in another thread finishes with the old version of its template, and the next call
+        gets the new one; no call ever sees a half-reloaded engine. If anything goes wrong (say, an edit left a
+        definition malformed), the Exception is raised and the engine carries on with its old state.
+
+        Templates that are compiled again get fresh random generators (see Template.compile()), and slots that are
+        parsed again get fresh pools of single-use values. Everything else carries on where it left off.
+
+        Returns:
+            A bool indicating whether anything had changed.
+
+        Raises:
+            IOError:
+                The template definitions file, or a corpus that it references, can't be read.
+            AssertionError:
+                The template definitions file does not conform to the expected format.
+            Exception:
+                There is a malformed definition, two slots or two templates with the same name, a reference to
+                an undefined slot or template, or a problem with the nesting of template references.
+        """
+        with self._reload_lock:
+            file_stamp = self._stat_source(path=self.file_path)
+            changed_corpora = {
+                path for path, stamp in self._corpus_stamps.items() if self._stat_source(path=path) != stamp
+            }
+            if file_stamp == self._file_stamp and not changed_corpora:
+                return False
+            # Work out which definitions were edited. The sources of those are up to date; the line numbers in
+            # the sources of the others may have been shifted by lines added or removed above them since.
+            slot_sources, template_sources, layout = self._slot_sources, self._template_sources, self._source_layout
+            edited_slots = edited_templates = ()
+            if file_stamp != self._file_stamp or layout is None:
+                edit = None if layout is None else self._scan_edit(layout=layout)
+                if edit is None:
+                    slot_sources, template_sources, layout = self._scan_template_definition_file(
+                        file_path=self.file_path
+                    )
+                    edited_slots = set(slot_sources).union(self._slot_sources)
+                    edited_templates = set(template_sources).union(self._template_sources)
+                else:
+                    slot_sources, template_sources, layout, edited_slots, edited_templates = edit
+            # Parse the slots whose definitions or corpora have changed. Any corpus that has changed is dropped
+            # from the stamps, so that it's stamped afresh when it's loaded again.
+            corpus_stamps = {
+                path: stamp for path, stamp in self._corpus_stamps.items() if path not in changed_corpora
+            }
+            changed_slots = set()
+            for slot_name in edited_slots:
+                old_source = self._slot_sources.get(slot_name)
+                source = slot_sources.get(slot_name)
+                if old_source is None or source is None or old_source[0] != source[0]:
+                    changed_slots.add(slot_name)
+            for slot_name, corpus_paths in self._slot_corpora.items():
+                if slot_name in slot_sources and not changed_corpora.isdisjoint(corpus_paths):
+                    changed_slots.add(slot_name)
+            slots = self._slots
+            slot_corpora = self._slot_corpora
+            if changed_slots:
+                slots = dict(slots)
+                slot_corpora = dict(slot_corpora)
+                for slot_name in changed_slots:
+                    slot_corpora.pop(slot_name, None)
+                    if slot_name not in slot_sources:  # The slot was removed
+                        slots.pop(slot_name, None)
+                        continue
+                    line, line_number, column = slot_sources[slot_name]
+                    if slot_name not in edited_slots:
+                        line_number = layout.line_number(name=slot_name, section='SLOTS')
+                    slots[slot_name], corpus_paths = self._parse_slot_definition(
+                        line=line,
+                        location=f"{self.file_path}, line {line_number}, column {column}",
+                        corpus_stamps=corpus_stamps
+                    )
+                    if corpus_paths:
+                        slot_corpora[slot_name] = corpus_paths
+            # Parse the templates whose definitions were edited or that use a slot that was parsed again
+            changed_templates = set()
+            for template_name in edited_templates:
+                old_source = self._template_sources.get(template_name)
+                source = template_sources.get(template_name)
+                if old_source is None or source is None or old_source[0::3] != source[0::3]:
+                    changed_templates.add(template_name)
+            for slot_name in changed_slots:
+                changed_templates.update(self._slot_users.get(slot_name, ()))
+            templates_by_name = dict(self._templates_by_name)
+            for template_name in changed_templates:
+                source = template_sources.get(template_name)
+                if source is None:  # The template was removed
+                    templates_by_name.pop(template_name, None)
+                    continue
+                definition, line_number, column, filters = source
+                if template_name not in edited_templates:
+                    line_number = layout.line_number(name=template_name, section='TEMPLATES')
+                template = self._parse_template_definition(
+                    template_definition=definition,
+                    slots=slots,
+                    location=f"{self.file_path}, line {line_number}",
+                    column=column
+                )
+                templates_by_name[template_name] = Template(name=template_name, template=template, filters=filters)
+            # Keep the templates in the order in which they're defined, if templates were added or moved
+            reordered = template_sources is not self._template_sources and list(templates_by_name) != list(
+                template_sources
+            )
+            if reordered:
+                templates_by_name = {name: templates_by_name[name] for name in template_sources}
+            # A template that references a changed template (even indirectly) must be expanded and compiled again
+            affected = set()
+            pending = list(changed_templates)
+            while pending:
+                template_name = pending.pop()
+                if template_name in affected:
+                    continue
+                affected.add(template_name)
+                pending += self._referrers.get(template_name, ())
+            expansions = dict(self._expansions)
+            depths = dict(self._depths)
+            for template_name in affected:
+                expansions.pop(template_name, None)
+                depths.pop(template_name, None)
+            affected.intersection_update(templates_by_name)  # Removed templates don't need compiling
+            expansions, depths = self._expand_template_references(
+                templates_by_name=templates_by_name,
+                roots=sorted(affected),
+                expansions=expansions,
+                depths=depths
+            )
+            for template_name in affected:
+                template = templates_by_name[template_name]
+                if template_name not in changed_templates:
+                    # Never recompile a template that's in use; make a new one with the same definition
+                    template = Template(name=template_name, template=template.template, filters=template.filters)
+                    templates_by_name[template_name] = template
+                template.compile(random_seed=self.random_seed, elements=expansions[template_name])
+            # Nothing below can fail, so now we can update the dependency index in place...
+            for template_name in changed_templates:
+                old_template = self._templates_by_name.get(template_name)
+                if old_template is not None:
+                    self._index_template(name=template_name, elements=old_template.template, add=False)
+                if template_name in templates_by_name:
+                    self._index_template(name=template_name, elements=templates_by_name[template_name].template)
+            # ...and swap in the new state. generate() only looks at self._templates_by_name, so it's that single
+            # assignment that switches generate() over to the reloaded templates.
+            if changed_templates or reordered:
+                self.templates = list(templates_by_name.values())
+                self._templates_by_name = templates_by_name
+            self._expansions = expansions
+            self._depths = depths
+            self._slots = slots
+            self._slot_sources = slot_sources
+            self._template_sources = template_sources
+            self._source_layout = layout
+            self._slot_corpora = slot_corpora
+            self._corpus_stamps = {path: corpus_stamps[path] for paths in slot_corpora.values() for path in paths}
+            self.corpus_paths = list(self._corpus_stamps)
+            self._file_stamp = file_stamp
+            return True
+
+    def _scan_edit(self, layout):
+        """Scan just the lines of the template definitions file that have changed since it was last scanned.
+
+        Args:
+            layout:
+                A SourceLayout object, describing the file as it was last scanned.
+
+        Returns:
+            None if the edit adds, removes or moves a section marker, in which case the whole file has to be
+            scanned again. Otherwise, a tuple containing the slot and template sources (as returned by
+            _scan_template_definition_file()), a SourceLayout object for the file as it is now, and sets of the
+            names of the slots and of the templates that were defined on the changed lines, before or after
+            the edit.
+
+        Raises:
+            IOError:
+                An error occurred accessing the template definitions file.
+            Exception:
+                There is a malformed definition on one of the changed lines, or it duplicates a name.
+        """
+        with open(self.file_path) as template_definitions_file:
+            lines = template_definitions_file.read().split('\n')
+        if lines[-1] == '':  # The file ends with a newline (or is empty)
+            lines.pop()
+        line_hashes = array('q', map(hash, lines))
+        start, old_stop, new_stop = layout.changed_range(line_hashes=line_hashes)
+        changed_lines = lines[start:new_stop]
+        if any(start <= index < old_stop for index in layout.marker_lines.values()) or any(
+            self._section_marker(raw_line=raw_line) for raw_line in changed_lines
+        ):
+            return None
+        section = layout.section_at(index=start)
+        old_names = [name for name in layout.line_names[start:old_stop] if name is not None]
+        new_names = []
+        slot_sources = self._slot_sources
+        template_sources = self._template_sources
+        if section is not None:
+            old_sources = slot_sources if section == 'SLOTS' else template_sources
+            sources = dict(old_sources)
+            for name in old_names:
+                del sources[name]
+            scanned_sources = {}
+            for line_number, raw_line in enumerate(changed_lines, start=start + 1):
+                scanned = self._scan_definition(
+                    file_path=self.file_path, line_number=line_number, raw_line=raw_line, section=section,
+                    sources=scanned_sources
+                )
+                if scanned is None:
+                    new_names.append(None)
+                    continue
+                name, source = scanned
+                if name in sources:
+                    # The name is also defined on a line that wasn't changed. Report whichever of the two lines
+                    # comes later, just as scanning the whole file would.
+                    index = layout.line_number(name=name, section=section) - 1
+                    index = max(line_number - 1, index if index < start else index + new_stop - old_stop)
+                    column = len(lines[index]) - len(lines[index].lstrip()) + 1
+                    raise Exception(
+                        f"{self.file_path}, line {index + 1}, column {column}: Multiple "
+                        f"{section.lower()} with the name '{name}'."
+                    )
+                new_names.append(name)
+                scanned_sources[name] = source
+            sources.update(scanned_sources)
+        else:  # Lines outside of the two sections are ignored
+            new_names = [None] * len(changed_lines)
+        line_names = layout.line_names[:start] + new_names + layout.line_names[old_stop:]
+        shift = new_stop - old_stop
+        marker_lines = {
+            marker: index if index < start else index + shift for marker, index in layout.marker_lines.items()
+        }
+        edited = set(old_names).union(name for name in new_names if name is not None)
+        if section is not None:
+            if [name for name in new_names if name is not None] == old_names:
+                # The same definitions, in the same order, so they keep their places
+                sources = dict(old_sources)
+                sources.update(scanned_sources)
+            else:
+                # A definition was added, removed, renamed or moved, so put the definitions back in file order
+                first, last = marker_lines[f'<BEGIN {section}>'], marker_lines[f'<END {section}>']
+                sources = {name: sources[name] for name in line_names[first + 1:last] if name is not None}
+            if section == 'SLOTS':
+                slot_sources = sources
+            else:
+                template_sources = sources
+        layout = SourceLayout(line_hashes=line_hashes, line_names=line_names, marker_lines=marker_lines)
+        edited_slots = edited if section == 'SLOTS' else set()
+        edited_templates = edited if section == 'TEMPLATES' else set()
+        return slot_sources, template_sources, layout, edited_slots, edited_templates
+
+    def watch(self, interval=1.0):
+        """Start watching the template definitions file and corpora for edits, and reload the engine when they change.
+
+        A background thread checks the modification time and size of each file every 'interval' seconds, and
+        calls reload() if any of them has changed. If reloading fails (e.g., because the file was saved with a
+        mistake in it), the engine keeps its old state, the Exception is kept in self.reload_error, and the
+        watcher tries again once the files change again. Calling this method while already watching does nothing.
+
+        Args:
+            interval:
+                A float, being the number of seconds between checks.
+        """
+        if self._watcher is not None:
+            return
+        stop = threading.Event()
+        thread = threading.Thread(target=self._watch, args=(interval, stop), name='TemplateEngine watcher', daemon=True)
+        self._watcher = (thread, stop)
+        thread.start()
+
+    def stop_watching(self):
+        """Stop the watcher started by watch(), if there is one, and wait for its thread to finish."""
+        if self._watcher is None:
+            return
+        thread, stop = self._watcher
+        self._watcher = None
+        stop.set()
+        thread.join()
+
+    def _watch(self, interval, stop):
+        """Poll for edits until told to stop. This is the body of the watcher thread started by watch()."""
+        failed_stamps = None  # The stamps of the files as they were when reloading last failed
+        while not stop.wait(interval):
+            stamps = [self._stat_source(path=path) for path in [self.file_path] + self.corpus_paths]
+            if stamps == failed_stamps:
+                continue  # Don't keep trying to reload files that we already know are broken
+            try:
+                self.reload()
+            except Exception as error:
+                self.reload_error = error
+                failed_stamps = stamps
+            else:
+                self.reload_error = None
+                failed_stamps = None
 
     def _parse_template_definition_file(self, file_path):
         """Parse the template definitions file at the given file path.
@@ -36,295 +755,622 @@ class TemplateEngine:
         and-methods. I don't always conform to this style guide, but in this case I do. One nice thing about using
         it for docstrings is that IDEs like PyCharm recognize the format and can use it to help you debug.
 
+        The work happens in two steps. First, _scan_template_definition_file() reads the file and sorts its lines
+        into slot definitions and template definitions, keyed by name. Then each slot definition is turned into
+        a Slot object, and each template definition into a Template object. Template definitions have to wait
+        until every slot is known, since a template may be defined before the slots it references (in most of
+        our files, the templates come first). The raw definitions are kept around, along with the layout of the
+        file's lines (see SourceLayout), so that reload() can tell which of them have changed when the file is
+        edited.
+
         Args:
             file_path:
                 A string containing the path to a template definitions file in the expected format.
 
         Returns:
-            A list of Slot objects and a list of Template objects.
+            A list of Template objects.
 
         Raises:
             IOError:
-                An error occurred accessing the template definitions file.
+                An error occurred accessing the template definitions file, or a corpus that it references.
+            AssertionError:
+                The template definitions file does not conform to the expected format (e.g., a section marker
+                is missing or out of place).
+            Exception:
+                There is a malformed slot or template definition in the template definitions file, or two slots
+                or two templates with the same name.
         """
-        # Read in the raw template definitions. If there's no file at this path, or if the path is otherwise
-        # malformed, an IOError will be raised. Note that the template definitions include both slot and
-        # template definitions.
-        template_definitions = open(file_path).read()
-        # Parse the slot definitions to form a Slot object for each defined slot
-        slots = self._parse_slot_definitions(template_definitions=template_definitions)
-        # Parse the template definitions to form a Template object for each defined template. Note how this
-        # requires access to the list of Slot objects that we just created -- this is why we parsed the slot
-        # definitions first, and it's also why I place the definition for the method _parse_slot_definitions()
-        # before that of _parse_template_definitions.
-        templates = self._parse_template_definitions(template_definitions=template_definitions, slots=slots)
+        # Note the file's modification time and size before reading it, so that an edit made while we're
+        # reading is still picked up by the next reload()
+        self._file_stamp = self._stat_source(path=file_path)
+        slot_sources, template_sources, layout = self._scan_template_definition_file(file_path=file_path)
+        corpus_stamps = {}
+        slots = {}
+        slot_corpora = {}
+        for slot_name, (line, line_number, column) in slot_sources.items():
+            slots[slot_name], corpus_paths = self._parse_slot_definition(
+                line=line, location=f"{file_path}, line {line_number}, column {column}", corpus_stamps=corpus_stamps
+            )
+            if corpus_paths:
+                slot_corpora[slot_name] = corpus_paths
+        # Finally, parse each template definition to form a Template object for each defined template
+        templates = []
+        for template_name, (definition, line_number, column, filters) in template_sources.items():
+            template = self._parse_template_definition(
+                template_definition=definition,
+                slots=slots,
+                location=f"{file_path}, line {line_number}",
+                column=column
+            )
+            templates.append(Template(name=template_name, template=template, filters=filters))
+        self._slot_sources = slot_sources
+        self._template_sources = template_sources
+        self._source_layout = layout
+        self._slots = slots
+        self._slot_corpora = slot_corpora
+        self._corpus_stamps = corpus_stamps
+        self.corpus_paths = list(corpus_stamps)
         return templates
 
-    def _parse_slot_definitions(self, template_definitions):
-        """Parse the slot definitions included in the given template definitions file content.
+    def _scan_template_definition_file(self, file_path):
+        """Read a template definitions file and sort its lines into slot definitions and template definitions.
+
+        The file is read as a stream, one line at a time, in a single pass. Each line is either a section marker
+        (like '<BEGIN SLOTS>', which must sit on a line of its own), a blank line or comment, something outside of
+        any section (which is ignored), or a definition belonging to the section that we're in (see
+        _scan_definition()). Slots and templates are kept in dictionaries keyed by name, so duplicate names are
+        caught in constant time. Every error message gives the line and column at which the problem was found.
+        Along the way, we note the hash of each line and the name defined on it (see SourceLayout), so that
+        reload() can tell which lines an edit touched.
 
         Args:
-            template_definitions:
-                A string containing the contents of a template definitions file.
+            file_path:
+                A string containing the path to a template definitions file in the expected format.
 
         Returns:
-            A list of Slot objects.
+            A tuple containing two dictionaries, both in the order in which the definitions appear in the file,
+            and a SourceLayout object. The first dictionary maps each slot name to a (slot definition, line
+            number, column) tuple, and the second maps each template name to a (template definition, line
+            number, column, filters) tuple, where the template definition is just the part after the '->'
+            delimiter, the column is where that part starts on its line, and the filters are a tuple of the
+            template-level filters written after the name.
 
         Raises:
+            IOError:
+                An error occurred accessing the template definitions file.
             AssertionError:
                 The template definitions file does not conform to the expected format.
             Exception:
-                There is a malformed slot definition in the template definitions file, or two slots with the
-                same name.
-        """
-        # First, make sure that the template definitions file is in the expected format. We'll do this using
-        # Python's 'assert' statement, which raises an AssertionError if the condition in the left side of the
-        # comma evaluates to False, in which case the error message on the right side of the comma will be printed.
-        # This form of validation will be used throughout the process of parsing the template definitions.
-        assert "<BEGIN SLOTS>" in template_definitions, "Template definitions file missing '<BEGIN SLOTS>'."
-        assert "<END SLOTS>" in template_definitions, "Template definitions file missing '<END SLOTS>'."
-        assert template_definitions.index("<BEGIN SLOTS>") < template_definitions.index("<END SLOTS>"), (
-            "'<BEGIN SLOTS>' comes after <END SLOTS> in template definitions file."
-        )
-        # Extract the slot definitions by taking the substring between the index of the start marker ("<BEGIN SLOTS>")
-        # and the end marker ("<END SLOTS>"). Note that the str.index() function returns the index of the first
-        # character of the first instance of the substring that is passed to it; as such, we'll add to the start
-        # index the length of the start marker, so that we don't include the marker itself in the extracted content.
-        slot_definitions_start_index = template_definitions.index("<BEGIN SLOTS>") + len("<BEGIN SLOTS>")
-        slot_definitions_end_index = template_definitions.index("<END SLOTS>")
-        slot_definitions = template_definitions[slot_definitions_start_index:slot_definitions_end_index]
-        # Next, iterate over each line in the slot definitions to attempt to form a Slot object for any line that
-        # doesn't consists of non-whitespace characters or begin with '#' (our comment symbol). We'll append each
-        # Slot object to the list of slots.
-        slots = []
-        for line in slot_definitions.split('\n'):
-            line = line.lstrip()  # Remove all leading whitespace on the line
-            if not line:  # The line contained only whitespace, so now it's an empty string
-                continue  # Move on to the next iteration of the 'for' loop, i.e., to the next line
-            if line.startswith('#'):  # It's a comment
-                continue
-            while '\t\t' in line:  # Replace consecutive tab characters with a single tab character
-                line = line.replace('\t\t', '\t')
-            # If we get to here, this must be a slot definition, though it may be malformed. Here, we'll use
-            # a try-except block to safely attempt to parse it as if it were in the expected format. If it's
-            # not in the expected format, i.e., it doesn't have two fields separated by a single tab, a
-            # ValueError will be raised indicating that splitting on the tab character did not produce exactly
-            # two components. If this happens, we'll raise an Exception with an error message including the
-            # malformed slot definition.
-            try:
-                slot_name, slot_values_str = line.split('->')
-            except ValueError:
-                # Let's form a nice error message that includes the exact slot definition that was malformed. We'll
-                # do this using a Python f-String (http://zetcode.com/python/fstring/).
-                if '->' not in line:
-                    error_message = f"Malformed slot definition (no '->' delimiter): '{line}'"
-                else:  # It has too few or too many components; there should be exactly two: name and values
-                    error_message = f"Malformed slot definition: '{line}'"
-                raise Exception(error_message)
-            # At this point, there's two ways that this slot definition could be malformed: 1) the slot name is an
-            # empty string or comprises only whitespace, or 2) the slot-values component is an empty string or
-            # comprises only whitespace. We'll check for both and raise an Exception, with an informative error
-            # message, in each case.
-            slot_name = slot_name.strip()  # Remove leading or trailing whitespace
-            slot_values_str = slot_values_str.strip()
-            if not slot_name:  # It comprised only whitespace
-                error_message = f"Slot definition includes no name: {line}"
-                raise Exception(error_message)
-            if not slot_values_str:  # It comprised only whitespace
-                error_message = f"Slot definition includes no values: {line}"
-                raise Exception(error_message)
-            # If we got to here, we successfully parsed out the slot name and slot values. Next, we'll parse the
-            # list of values; this is simply a comma separated list. Note that calling str.split(delimiter) on a
-            # string that doesn't include the delimiter is just fine -- it will just return the entire string.
-            raw_slot_values = slot_values_str.split(',')
-            # Some of these values may be commands to load in the contents of a corpus file, so let's iterate
-            # over them one by one to check. If we find a corpus reference, we'll remove that from the slot values
-            # and append to the slot values every element in the referenced corpus.
-            slot_values = []
-            for raw_slot_value in raw_slot_values:
-                if not raw_slot_value.startswith('$'):
-                    # It's a regular slot value, so append it to the list of slot values and move onto the 
-                    # next iteration of the loop
-                    slot_values.append(raw_slot_value)
+                There is a malformed slot or template definition in the template definitions file, or two slots
+                or two templates with the same name.
+        """
+        slot_sources = {}
+        template_sources = {}
+        line_hashes = array('q')
+        line_names = []
+        marker_lines = {}  # Maps each section marker to the index of its line
+        section = None  # 'SLOTS' or 'TEMPLATES' while we're inside that section
+        # If there's no file at this path, or if the path is otherwise malformed, an IOError will be raised
+        with open(file_path) as template_definitions_file:
+            for line_number, raw_line in enumerate(template_definitions_file, start=1):
+                raw_line = raw_line.rstrip('\n')
+                line_hashes.append(hash(raw_line))
+                marker = self._section_marker(raw_line=raw_line)
+                if marker is not None:
+                    column = len(raw_line) - len(raw_line.lstrip()) + 1
+                    location = f"{file_path}, line {line_number}, column {column}"
+                    # We'll validate the file structure using Python's 'assert' statement, which raises an
+                    # AssertionError if the condition on its left evaluates to False, with the message on its right
+                    boundary, section_name = marker[1:-1].split(' ')
+                    assert marker not in marker_lines, f"{location}: Template definitions file repeats '{marker}'."
+                    if boundary == 'BEGIN':
+                        assert section is None, f"{location}: '{marker}' appears inside the {section} section."
+                        section = section_name
+                    else:
+                        assert section == section_name, (
+                            f"{location}: '{marker}' comes before <BEGIN {section_name}> in template definitions file."
+                        )
+                        section = None
+                    marker_lines[marker] = line_number - 1
+                    line_names.append(None)
+                    continue
+                if section is None:  # Anything outside of the two sections is ignored
+                    line_names.append(None)
+                    continue
+                sources = slot_sources if section == 'SLOTS' else template_sources
+                scanned = self._scan_definition(
+                    file_path=file_path, line_number=line_number, raw_line=raw_line, section=section, sources=sources
+                )
+                if scanned is None:
+                    line_names.append(None)
                     continue
-                corpus_filename = raw_slot_value[1:]  # Remove the leading dollar sign
-                corpus_values = self._load_corpus(corpus_filename=corpus_filename)
-                slot_values += corpus_values
-            # Finally, instantiate a Slot object for this slot definition and append it to the list of Slot objects
-            slot_object = Slot(name=slot_name, values=slot_values)
-            slots.append(slot_object)
-        # As a final check, make sure that there's no cases of two slots having the same name
-        for slot in slots:
-            for other_slot in slots:
-                if slot is not other_slot:  # They're not literally the same object (this is what 'is' checks for)
-                    if slot.name == other_slot.name:
-                        raise Exception(f"Multiple slots with the name '{slot.name}'.")
-        return slots
+                name, source = scanned
+                sources[name] = source
+                line_names.append(name)
+        # Make sure that we found both sections, and that neither was left open
+        for marker in self.SECTION_MARKERS:
+            assert marker in marker_lines, f"Template definitions file missing '{marker}'."
+        layout = SourceLayout(line_hashes=line_hashes, line_names=line_names, marker_lines=marker_lines)
+        return slot_sources, template_sources, layout
+
+    def _section_marker(self, raw_line):
+        """Return the section marker on the given line of a template definitions file, or None if it isn't one."""
+        line = raw_line.strip()
+        return line if line.startswith('<') and line in self.SECTION_MARKERS else None
 
     @staticmethod
-    def _load_corpus(corpus_filename):
-        """Return the contents of a corpus loaded from a corpus file.
+    def _scan_definition(file_path, line_number, raw_line, section, sources):
+        """Check a line from one of the sections of a template definitions file, and split it into a name and a source.
 
-        Note: I use the decorator '@staticmethod' because this instance method does not require access to
-        the instance's data, i.e., there is no point to passing the 'self' argument, since it's not used
-        anywhere in the method. While Python has formal support for 'static' methods like this one, I'm
-        using here as a convention that makes the code easier to understand; for example, by using the
-        decorator, I express to you that this method will not -- and, in fact, cannot -- modify the object
-        instance's attributes via side effects.
+        The definitions are only checked for structure here (each needs a name, a '->' delimiter and something
+        after it), and are otherwise kept as raw text.
 
         Args:
-            corpus_filename:
-                The filename for the corpus that's to be loaded.
+            file_path:
+                A string containing the path to the template definitions file (for error messages).
+            line_number:
+                An int, being the number of the line (counting from 1).
+            raw_line:
+                A string containing the line, without its newline.
+            section:
+                A string, being 'SLOTS' or 'TEMPLATES', whichever section the line is in.
+            sources:
+                A dictionary of the sources of the definitions found so far in the same section, keyed by name,
+                for catching duplicate names.
 
         Returns:
-            A list of strings.
+            None if the line is blank or a comment, or else a (name, source) tuple, where the source is as
+            described in _scan_template_definition_file().
 
         Raises:
-            IOError:
-                There is no corpus file with the given name in the 'corpora' folder.
+            Exception:
+                The definition is malformed, or its name is already in 'sources'.
         """
-        return open(f"corpora/{corpus_filename}").read().split('\n')
+        line = raw_line.lstrip()  # Remove all leading whitespace on the line
+        if not line or line.startswith('#'):  # It's a blank line or a comment
+            return None
+        column = len(raw_line) - len(line) + 1  # Where the line's content starts (counting from 1)
+        location = f"{file_path}, line {line_number}"
+        # If we get to here, this must be a definition, though it may be malformed. The name and the
+        # definition proper are separated by the '->' delimiter, which must appear exactly once.
+        name, delimiter, definition = line.partition('->')
+        kind = 'slot' if section == 'SLOTS' else 'template'
+        if not delimiter or '->' in definition:
+            if not delimiter:
+                error_message = f"Malformed {kind} definition (no '->' delimiter): '{line}'"
+            else:  # There are too many components; there should be exactly two: name and definition
+                error_message = f"Malformed {kind} definition: '{line}'"
+            raise Exception(f"{location}, column {column}: {error_message}")
+        name = name.strip()
+        if not name:
+            raise Exception(f"{location}, column {column}: {kind.capitalize()} definition includes no name: {line}")
+        if not definition.strip():
+            raise Exception(f"{location}, column {column}: {kind.capitalize()} definition includes no values: {line}")
+        if section == 'SLOTS':
+            if name in sources:
+                raise Exception(f"{location}, column {column}: Multiple slots with the name '{name}'.")
+            return name, (line, line_number, column)
+        # A template's name may be followed by filters for its whole output, as in 'POEM|unescape'
+        name, *filters = [part.strip() for part in name.split('|')]
+        for filter_name in filters:
+            if filter_name not in Template.TEMPLATE_FILTERS:
+                raise Exception(
+                    f"{location}, column {column}: Unknown template filter '{filter_name}'. Use one of: "
+                    f"{', '.join(Template.TEMPLATE_FILTERS)}."
+                )
+        if name in sources:
+            raise Exception(f"{location}, column {column}: Multiple templates with the name '{name}'.")
+        definition_column = column + line.index('->') + len(delimiter)
+        return name, (definition, line_number, definition_column, tuple(filters))
 
-    def _parse_template_definitions(self, template_definitions, slots):
-        """Parse the actual template definitions included in the given template definitions file content.
+    # The markers that open and close the two sections of a template definitions file
+    SECTION_MARKERS = ('<BEGIN TEMPLATES>', '<END TEMPLATES>', '<BEGIN SLOTS>', '<END SLOTS>')
 
-        Note: the procedure used here closely follows that of _parse_slot_definitions(), and so the comments
-        here are not as verbose, since they assume you've already read the comments for the earlier method.
-        Which is to say, consult the comments in _parse_slot_definitions() if you're having trouble understanding
-        what's going on here.
+    # Matches a run of two or more tab characters
+    TAB_RUN = re.compile('\t\t+')
 
-        Another note: I don't use '@staticmethod' here because this method calls another instance method,
-        _parse_template_definition(), and to access this other method, the method needs the 'self' argument
-        to be passed (so that the instance can call 'self._parse_template_definitions()').
+    def _parse_slot_definition(self, line, location, corpus_stamps):
+        """Parse a single slot definition, i.e., one line from the slots section of a template definitions file.
 
         Args:
-            template_definitions:
-                A string containing the contents of a template definitions file.
+            line:
+                A string containing the slot definition, with any leading whitespace removed. It must contain
+                exactly one '->' delimiter.
+            location:
+                A string giving the file, line and column at which the definition appears (for error messages).
+            corpus_stamps:
+                A dictionary mapping the path of each corpus referenced so far to the modification time and size
+                that its file had when it was first referenced (see _stat_source()). Any corpus that this slot
+                references for the first time is added to it.
 
         Returns:
-            A list of Template objects.
+            A tuple containing a Slot object and a tuple of the paths of the corpora that the slot references.
+            If the engine's 'lazy_corpora' is True and the slot references any corpora, the slot is deferred:
+            the corpora aren't loaded until the slot is first used (see Slot.deferred()).
 
         Raises:
-            AssertionError:
-                The template definitions file does not conform to the expected format.
+            IOError:
+                The slot definition references a corpus file that doesn't exist.
             Exception:
-                There is a malformed template definition in the template definitions file.
+                The slot definition is malformed.
+        """
+        if '\t\t' in line:  # Replace consecutive tab characters with a single tab character
+            line = self.TAB_RUN.sub('\t', line)
+        slot_name, _, slot_values_str = line.partition('->')
+        # At this point, there's two ways that this slot definition could be malformed: 1) the slot name is an
+        # empty string or comprises only whitespace, or 2) the slot-values component is an empty string or
+        # comprises only whitespace. We'll check for both and raise an Exception, with an informative error
+        # message, in each case.
+        slot_name = slot_name.strip()  # Remove leading or trailing whitespace
+        slot_values_str = slot_values_str.strip()
+        if not slot_name:  # It comprised only whitespace
+            raise Exception(f"{location}: Slot definition includes no name: {line}")
+        if not slot_values_str:  # It comprised only whitespace
+            raise Exception(f"{location}: Slot definition includes no values: {line}")
+        # If we got to here, we successfully parsed out the slot name and slot values. Next, we'll parse the
+        # list of values; this is simply a comma separated list. Note that calling str.split(delimiter) on a
+        # string that doesn't include the delimiter is just fine -- it will just return the entire string.
+        raw_slot_values = slot_values_str.split(',')
+        # Some of these values may be commands to load in the contents of a corpus file. Any value (or corpus
+        # reference) may also carry a weight, written after a caret: 'laziness^5,laundry' makes 'laziness' five
+        # times as likely as 'laundry'. We'll split off the weights and pick out the corpus references now, so
+        # that a malformed definition or a missing corpus is reported straight away, even if loading the corpora
+        # is deferred (see _build_slot()).
+        weighted_values = []
+        corpus_paths = []
+        for raw_slot_value in raw_slot_values:
+            raw_slot_value, weight = self._split_weight(raw_slot_value=raw_slot_value, line=f"{location}: {line}")
+            weighted_values.append((raw_slot_value, weight))
+            if not raw_slot_value.startswith('$'):
+                continue
+            corpus_path = f"corpora/{raw_slot_value[1:]}"  # Remove the leading dollar sign
+            if corpus_path not in corpus_stamps:
+                # As with the definitions file, note the stamp before loading, not after
+                corpus_stamps[corpus_path] = self._stat_source(path=corpus_path)
+                if corpus_stamps[corpus_path] is None:
+                    del corpus_stamps[corpus_path]
+                    raise IOError(f"{location}: Slot definition references a corpus file that doesn't exist: {line}")
+            if corpus_path not in corpus_paths:
+                corpus_paths.append(corpus_path)
+        if corpus_paths and self.lazy_corpora:
+            slot = Slot.deferred(
+                name=slot_name,
+                policy=self.single_use_policy,
+                loader=partial(self._build_slot, slot_name=slot_name, weighted_values=weighted_values)
+            )
+        else:
+            slot = self._build_slot(slot_name=slot_name, weighted_values=weighted_values)
+        return slot, tuple(corpus_paths)
+
+    def _build_slot(self, slot_name, weighted_values):
+        """Build a Slot object from the values in a slot definition, loading any corpora that they reference.
+
+        Args:
+            slot_name:
+                A string, being the slot name.
+            weighted_values:
+                A list of (value, weight) tuples, one for each comma-separated value in the slot definition,
+                where each weight is a float, or None if the value didn't have one. A value starting with '$'
+                is a corpus reference.
+
+        Returns:
+            A Slot object.
+
+        Raises:
+            IOError:
+                A referenced corpus file can't be read.
         """
-        # First, make sure that the template definitions file is in the expected format
-        assert "<BEGIN TEMPLATES>" in template_definitions, "Template definitions file missing '<BEGIN TEMPLATES>'."
-        assert "<END TEMPLATES>" in template_definitions, "Template definitions file missing '<END TEMPLATES>'."
-        assert template_definitions.index("<BEGIN TEMPLATES>") < template_definitions.index("<END TEMPLATES>"), (
-            "'<BEGIN TEMPLATES>' comes after <END TEMPLATES> in template definitions file."
+        # Let's iterate over the values one by one. If we find a corpus reference, we'll append to the slot
+        # values every element in the referenced corpus. Values without a weight get a weight of 1.
+        slot_values = []
+        slot_weights = []
+        weighted = False  # Whether any explicit weight appeared, either in the definition or in a corpus
+        packed_value_parts = []  # Only used when corpora are packed or memory-mapped (see below)
+        for raw_slot_value, weight in weighted_values:
+            if weight is not None:
+                weighted = True
+            else:
+                weight = 1.0
+            if not raw_slot_value.startswith('$'):
+                # It's a regular slot value, so append it to the list of slot values and move onto the 
+                # next iteration of the loop
+                slot_values.append(raw_slot_value)
+                slot_weights.append(weight)
+                continue
+            corpus_values = self._load_corpus(corpus_filename=raw_slot_value[1:], mapped=self.mmap_corpora)
+            if type(corpus_values) is PackedValues and corpus_values.contains('\t'):
+                # The corpus may have a weight column, which has to be split off line by line, so unpack it
+                corpus_values = tuple(corpus_values)
+            if isinstance(corpus_values, PackedValues):
+                # We can't splice a packed or memory-mapped corpus into a list without decoding every line,
+                # which would defeat the purpose of packing it, so we'll chain the pieces together instead. (A
+                # mapped corpus's own weight column, if it has one, is not honoured.)
+                packed_value_parts += [(slot_values, slot_weights), (corpus_values, weight)]
+                slot_values = []
+                slot_weights = []
+                continue
+            # A corpus file may give each line a weight in a second, tab-separated column
+            corpus_values, corpus_weights = self._split_corpus_weights(corpus_values=corpus_values)
+            if corpus_weights is not None:
+                weighted = True
+                slot_weights += [weight * corpus_weight for corpus_weight in corpus_weights]
+            else:
+                slot_weights += [weight] * len(corpus_values)
+            slot_values += corpus_values
+        if packed_value_parts:
+            packed_value_parts.append((slot_values, slot_weights))
+            slot_values = ChainedValues(parts=[part for part, _ in packed_value_parts])
+            # Single-use markers and weights are handled when the Slot is created, and both need a plain list
+            # of values, so in the (rare) case that we need either, we'll fall back to decoding the whole thing
+            if weighted or slot_values.has_single_use_values():
+                slot_values = list(slot_values)
+                slot_weights = []
+                for part, part_weight in packed_value_parts:
+                    slot_weights += part_weight if isinstance(part_weight, list) else [part_weight] * len(part)
+            elif len(slot_values.parts) == 1:
+                # The slot's values all come from one corpus, so there's nothing to chain
+                slot_values = slot_values.parts[0]
+        # Finally, instantiate a Slot object for this slot definition
+        slot = Slot(
+            name=slot_name,
+            values=slot_values,
+            weights=slot_weights if weighted else None,
+            policy=self.single_use_policy
         )
-        # Extract the template definitions
-        template_definitions_start_index = template_definitions.index("<BEGIN TEMPLATES>") + len("<BEGIN TEMPLATES>")
-        template_definitions_end_index = template_definitions.index("<END TEMPLATES>")
-        template_definitions = template_definitions[template_definitions_start_index:template_definitions_end_index]
-        # Next, iterate over each line in the template definitions to attempt to form a Template object for any line
-        # that doesn't consists of non-whitespace characters or begin with '#' (our comment symbol). We'll append each
-        # Template object to the list of slots.
-        templates = []
-        for line in template_definitions.split('\n'):
-            line = line.lstrip()  # Remove all leading whitespace on the line
-            if not line:  # The line contained only whitespace, so now it's an empty string
-                continue  # Move on to the next iteration of the 'for' loop, i.e., to the next line
-            if line.startswith('#'):  # It's a comment
+        return slot
+
+    @staticmethod
+    def _split_weight(raw_slot_value, line):
+        """Split a raw slot value into the value itself and its weight, if it has one.
+
+        A weight is written after a caret at the end of the value, as in 'laziness^5' or 'laundry^0.137'. A
+        caret that isn't followed by a number is just part of the value.
+
+        Args:
+            raw_slot_value:
+                A string, being one of the comma-separated values in a slot definition.
+            line:
+                A string, being the whole slot definition (for error messages).
+
+        Returns:
+            A tuple containing the value (a string) and its weight (a float, or None if there was no weight).
+
+        Raises:
+            Exception:
+                The weight is negative or not a finite number.
+        """
+        value, caret, weight_str = raw_slot_value.rpartition('^')
+        if not caret:
+            return raw_slot_value, None
+        try:
+            weight = float(weight_str)
+        except ValueError:  # Not a number, so the caret belongs to the value
+            return raw_slot_value, None
+        if not 0 <= weight < float('inf'):  # This also catches NaN, since every comparison with NaN is False
+            raise Exception(f"Slot definition includes an invalid weight '{weight_str}': {line}")
+        return value, weight
+
+    @staticmethod
+    def _split_corpus_weights(corpus_values):
+        """Split off the optional weight column of a corpus.
+
+        A line in a corpus file may end with a tab followed by a number, which is taken as the weight of the
+        value that precedes the tab. Lines without such a column get a weight of 1.
+
+        Args:
+            corpus_values:
+                A tuple of strings, being the lines of a corpus file.
+
+        Returns:
+            A tuple containing the corpus values (with any weight columns removed) and a list of their weights,
+            or the original corpus values and None if no line has a weight column.
+        """
+        values = None
+        weights = None
+        for index, corpus_value in enumerate(corpus_values):
+            if '\t' not in corpus_value:
                 continue
-            # If we get to here, this must be a slot definition, though it may be malformed. Again, we'll use
-            # a try-except block to safely attempt to parse it as if it were in the expected format.
+            value, _, weight_str = corpus_value.rpartition('\t')
             try:
-                template_name, template_definition = line.split('->')
-            except ValueError:
-                error_message = f"Malformed template definition: '{line}'"
-                raise Exception(error_message)
-            # At this point, here's two ways that this template definition could be malformed: 1) the template name
-            # is an empty string or comprises only whitespace, or 2) the actual template component is an empty string
-            # or comprises only whitespace. We'll check for both and raise an Exception, with an informative error
-            # message, in each case.
-            template_name = template_name.strip()  # Strip off surrounding whitespace, possibly leaving an empty string
-            if not template_name:
-                error_message = f"Template definition includes no name: {line}"
-                raise Exception(error_message)
-            if not template_definition.strip():
-                error_message = f"Template definition includes no values: {line}"
-                raise Exception(error_message)
-            # Now, let's parse the template definition to form a list representing the template. This list
-            # will contain strings (for the static elements in the template) and also Slot objects (for the slots
-            # in the template). To form such a list, we need to separate the slots from the static elements. This
-            # can be done in one line using a regular expression (i.e., the Python 're' module), but I assume that
-            # you haven't learned about those yet, so instead we'll iterate through the template string one
-            # character at a time. This will take several lines, during which we'll also retrieve any Slot objects
-            # referenced in the template, so let's break into a new method to preserve the granularity and readability
-            # of this one.
-            template = self._parse_template_definition(template_definition=template_definition, slots=slots)
-            # Finally, instantiate a Template object for this template definition and append it to the list of
-            # template objects
-            template_object = Template(name=template_name, template=template)
-            templates.append(template_object)
-        # As a final check, make sure that there's no cases of two templates having the same name
-        for template in templates:
-            for other_template in templates:
-                if template is not other_template:
-                    if template.name == other_template.name:
-                        raise Exception(f"Multiple templates with the name '{template.name}'.")
-        return templates
+                weight = float(weight_str)
+            except ValueError:  # Not a weight column, just a value that includes a tab
+                continue
+            if not 0 <= weight < float('inf'):
+                continue
+            if weights is None:
+                values = list(corpus_values)
+                weights = [1.0] * len(corpus_values)
+            values[index] = value
+            weights[index] = weight
+        if weights is None:
+            return corpus_values, None
+        return values, weights
+
+    @staticmethod
+    def _parse_constraint(key_name, argument):
+        """Return the keys allowed by an 'initial', 'syllables' or 'length' constraint (see Slot.CONSTRAINT_KEYS).
+
+        Args:
+            key_name:
+                A string, being the name of the constraint (the part before the '=').
+            argument:
+                A string, being the argument of the constraint (the part after the '='). This is a comma-separated
+                list of letters (for 'initial') or numbers (for the others), any of which can be a range, as in
+                'a-c' or '4-5'.
+
+        Returns:
+            A frozenset of keys: lower-case letters, or ints.
+
+        Raises:
+            ValueError:
+                The constraint is unknown, or its argument is malformed.
+        """
+        if key_name == 'rhyme':
+            raise ValueError(f"there is no slot named '{argument}' to rhyme with.")
+        if key_name not in Slot.CONSTRAINT_KEYS:
+            raise ValueError(f"there is no such constraint. Use one of: {', '.join(Slot.CONSTRAINT_KEYS)}.")
+        keys = set()
+        for part in argument.split(','):
+            first, dash, last = part.strip().partition('-')
+            last = last if dash else first
+            if key_name == 'initial':
+                if not (len(first) == len(last) == 1 and first.isalpha() and last.isalpha()):
+                    raise ValueError("expected letters, or ranges of letters like 'a-c'.")
+                keys.update(map(chr, range(ord(first.lower()), ord(last.lower()) + 1)))
+            else:
+                if not (first.isdigit() and last.isdigit()):
+                    raise ValueError("expected numbers, or ranges of numbers like '4-5'.")
+                keys.update(range(int(first), int(last) + 1))
+        if not keys:
+            raise ValueError("the range is empty.")
+        return frozenset(keys)
+
+    @staticmethod
+    def _load_corpus(corpus_filename, mapped=False):
+        """Return the contents of a corpus loaded from a corpus file.
+
+        Note: I use the decorator '@staticmethod' because this instance method does not require access to
+        the instance's data, i.e., there is no point to passing the 'self' argument, since it's not used
+        anywhere in the method. While Python has formal support for 'static' methods like this one, I'm
+        using here as a convention that makes the code easier to understand; for example, by using the
+        decorator, I express to you that this method will not -- and, in fact, cannot -- modify the object
+        instance's attributes via side effects.
+
+        Another note: corpora are loaded through the process-wide corpus cache (see CorpusCache below), so a
+        corpus that's referenced by several slots, or by several engines, is only read from disk once.
+
+        Args:
+            corpus_filename:
+                The filename for the corpus that's to be loaded.
+            mapped:
+                If True, return a memory-mapped MappedCorpus rather than a tuple of strings.
+
+        Returns:
+            A tuple of strings (or, for large corpora, a PackedValues object), or a MappedCorpus if 'mapped' is
+            True.
+
+        Raises:
+            IOError:
+                There is no corpus file with the given name in the 'corpora' folder.
+        """
+        return corpus_cache.load(f"corpora/{corpus_filename}", mapped=mapped)
+
+    # Matches a slot reference in a template definition, i.e., a name between angle brackets
+    SLOT_REFERENCE = re.compile('<([^>]*)>')
 
     @staticmethod
-    def _parse_template_definition(template_definition, slots):
+    def _parse_template_definition(template_definition, slots, location='', column=1):
         """Parse the given template definition.
 
+        We find the slot references with a regular expression that matches a '<', then everything up to the
+        next '>'. Whatever lies between two references (or before the first or after the last) is a static
+        element.
+
         Args:
             template_definition:
                 A string containing a raw template definition. For example: "<DET> <NOUN> <VERB>. The end.".
+            slots:
+                A dictionary mapping each slot name to its Slot object.
+            location:
+                A string giving the file and line at which the definition appears (for error messages).
+            column:
+                An int, being the column at which the definition starts on its line (for error messages).
 
         Returns:
-            A list containing both strings (template static elements) and Slot objects (template slots), in the
-            order in which they are included in the template definition.
+            A list containing strings (template static elements), Slot objects (template slots) and
+            TemplateReference objects (references to other templates, written like '<@ENDING>'), in the order
+            in which they are included in the template definition. A slot reference with filters, like
+            '<ADJ|cap>' or '<a/an:ANIMAL>', gets the filtered slot (see Slot.filtered()), and one with
+            constraints, like '<NOUN|initial=d>', gets the constrained slot (see Slot.constrained()). A reference
+            with a rhyme constraint, like '<PLACE|rhyme=NAME>', becomes a RhymeReference.
 
         Raises:
             Exception:
-                The template definition references a slot that has not been defined.
+                The template definition references a slot that has not been defined, uses an unknown filter or
+                constraint, has a malformed constraint, or has a '<' that is never closed.
         """
         template = []  # This will be populated with strings (static elements) and Slot objects (slots)
-        # Iterate over the template definition, one character at a time, looking specifically for the angle
-        # brackets that demarcate slots in the template.
-        iterating_over_slot_name = False
-        slot_name = None
-        static_element = ''
-        for character in template_definition:
-            if iterating_over_slot_name:
-                if character != '>':  # We're still iterating over the slot name, so append this character
-                    slot_name += character
-                else:  # We've hit the end of the slot name...
-                    iterating_over_slot_name = False
-                    # Now we need to retrieve the Slot object associated with this name. If there isn't one, we'll
-                    # treat this template definition as being malformed (since there's no way to fill it in), and raise
-                    # an Exception now to cue the authoring error.
-                    try:
-                        slot_object = next(slot for slot in slots if slot.name == slot_name)
-                    except StopIteration:  # There is no slot by that name in the 'slots' list
-                        error_message = (
-                            f"Template definition '{template_definition}' references an undefined slot '{slot_name}'."
+        static_start = 0
+        for match in TemplateEngine.SLOT_REFERENCE.finditer(template_definition):
+            # If there was a static element preceding this slot, append it to the template
+            if match.start() > static_start:
+                template.append(template_definition[static_start:match.start()])
+            static_start = match.end()
+            slot_name = match.group(1)
+            # A name that starts with '@' refers to another template rather than a slot. That template may
+            # not have been parsed yet, so for now we'll just note the reference; the engine expands it
+            # when it compiles the templates (see TemplateEngine._expand_template_references()).
+            # Either kind of name may be followed by filters, as in '<ADJ|cap>' (see Slot.FILTERS) or
+            # '<@ENDING|upper>' (see Template.TEMPLATE_FILTERS). A slot name may also be preceded by 'a/an:',
+            # which is shorthand for putting the 'a/an' filter first.
+            slot_name, *filters = slot_name.split('|')
+            if slot_name.startswith('a/an:'):
+                slot_name = slot_name[len('a/an:'):]
+                filters.insert(0, 'a/an')
+            if slot_name.startswith('@'):
+                for filter_name in filters:
+                    if filter_name not in Template.TEMPLATE_FILTERS:
+                        raise Exception(
+                            f"{location}, column {column + match.start()}: Template definition "
+                            f"'{template_definition}' uses an unknown template filter '{filter_name}'. Use one of: "
+                            f"{', '.join(Template.TEMPLATE_FILTERS)}."
                         )
-                        raise Exception(error_message)
-                    template.append(slot_object)
-            elif character == '<':  # We've hit the beginning of a slot name
-                # If there was a static element preceding this slot, append it to the template
-                if static_element:
-                    template.append(static_element)
-                    static_element = ''
-                iterating_over_slot_name = True
-                slot_name = ''
-            else:  # We must be iterating over a static element
-                static_element += character
-        # Even though we're done iterating over the template definition, there may have been a static element
-        # at the end of it, which we would have failed to have added to the template. Let's make sure to do
-        # that here.
-        if static_element:
-            template.append(static_element)
+                template.append(TemplateReference(name=slot_name[1:], filters=tuple(filters)))
+                continue
+            # Now we need to retrieve the Slot object associated with this name. If there isn't one, we'll
+            # treat this template definition as being malformed (since there's no way to fill it in), and raise
+            # an Exception now to cue the authoring error.
+            try:
+                slot = slots[slot_name]
+            except KeyError:  # There is no slot by that name
+                raise Exception(
+                    f"{location}, column {column + match.start()}: Template definition '{template_definition}' "
+                    f"references an undefined slot '{slot_name}'."
+                )
+            # Filters and constraints are applied from left to right, so '<NOUN|initial=d|upper>' and
+            # '<NOUN|upper|initial=D>' both give the upper-cased nouns that start with a 'd'
+            rhyme_target = None
+            pending_filters = []
+            for filter_name in filters:
+                if '=' not in filter_name:
+                    if filter_name not in Slot.FILTERS:
+                        raise Exception(
+                            f"{location}, column {column + match.start()}: Template definition "
+                            f"'{template_definition}' uses an unknown filter '{filter_name}'. Use one of: "
+                            f"{', '.join(Slot.FILTERS)}."
+                        )
+                    pending_filters.append(filter_name)
+                    continue
+                if pending_filters:
+                    slot = slot.filtered(filters=pending_filters)
+                    pending_filters = []
+                key_name, _, argument = filter_name.partition('=')
+                if key_name == 'rhyme' and argument in slots:
+                    rhyme_target = argument
+                    continue
+                try:
+                    keys = TemplateEngine._parse_constraint(key_name=key_name, argument=argument)
+                except ValueError as error:
+                    raise Exception(
+                        f"{location}, column {column + match.start()}: Template definition '{template_definition}' "
+                        f"has a malformed constraint '{filter_name}': {error}"
+                    )
+                slot = slot.constrained(key_name=key_name, keys=keys)
+            if pending_filters:
+                slot = slot.filtered(filters=pending_filters)
+            template.append(slot if rhyme_target is None else RhymeReference(slot=slot, target=rhyme_target))
+        if '<' in template_definition[static_start:]:
+            unclosed_column = column + template_definition.index('<', static_start)
+            raise Exception(
+                f"{location}, column {unclosed_column}: Template definition '{template_definition}' has a '<' "
+                f"that is never closed with a '>'."
+            )
+        # There may be a static element at the end of the definition, after the last slot
+        if static_start < len(template_definition):
+            template.append(template_definition[static_start:])
         return template
 
-    def generate(self, template_name):
+    def generate(self, template_name, max_len=None, min_len=None):
         """Use the template with the given name to generate a single text output.
 
         This method relies on Template.generate() to do most of the work, but it's handy in that it allows
@@ -334,65 +1380,1468 @@ class TemplateEngine:
         Args:
             template_name:
                 A string, being the name of the template that is to be used to generate a text output.
+            max_len:
+                An int, being the greatest number of characters that the output may have, or None for no limit.
+            min_len:
+                An int, being the least number of characters that the output may have, or None for no limit. With
+                either limit, the output is generated in one pass by Template.generate_within(), never by
+                generating outputs until one happens to fit.
 
         Returns:
             A string, being a single text output produced by filling the slots in the template with the given name.
 
         Raises:
             Exception:
-                There is no defined template with the given name.
+                There is no defined template with the given name, or (with a limit) the template can't produce
+                an output of the requested length.
         """
-        # First, we need to retrieve the Template object associated with this name. If there isn't one, we'll
-        # elect to raise an Exception to let the caller know.
-        try:
-            template_object = next(template for template in self.templates if template.name == template_name)
-        except StopIteration:  # There is no defined template by that name, so raise an Exception
-            error_message = f"There is no defined template with the name {template_name}. "
-            all_defined_template_names = ", ".join(template.name for template in self.templates)
-            error_message += f"These templates are defined: {all_defined_template_names}."
-            raise Exception(error_message)
+        # First, we need to retrieve the Template object associated with this name. If there isn't one,
+        # _get_template() will raise an Exception to let the caller know.
+        template_object = self._get_template(template_name=template_name)
         # If we retrieved a Template object, use it to generate a single text output, and return that
-        output = template_object.generate()
+        if max_len is None and min_len is None:
+            output = template_object.generate()
+        else:
+            output = template_object.generate_within(min_len=min_len, max_len=max_len)
         return output
 
+    def count(self, template_name):
+        """Return the number of outputs that the template with the given name can produce.
 
-class Template:
-    """A template, for use in template-based text generation.
+        See Template.count() for details.
 
-    Attributes:
-        name:
-            A string, being the template name.
-        template:
-            A list of strings (static elements) and Slot objects (slots).
-    """
+        Args:
+            template_name:
+                A string, being the name of a template.
 
-    def __init__(self, name, template):
-        """Initialize a Template object.
+        Returns:
+            An int, being the number of outputs.
 
-        Args:
-            name:
-                A string, being the template name.
-            template:
-                A list of strings (static elements) and Slot objects (slots).
+        Raises:
+            Exception:
+                There is no defined template with the given name.
         """
-        self.name = name
-        self.template = template
+        return self._get_template(template_name=template_name).count()
 
-    def generate(self):
-        """Use this template to generate a single text output.
+    def output_at(self, template_name, k):
+        """Return the k-th output that the template with the given name can produce.
 
-        Returns:
-            A string, being a single text output produced by filling the slots in this template.
+        See Template.output_at() for details. Together with count(), this lets one enumerate any range of the
+        template's outputs, or split them into shards, without generating the rest.
+
+        Args:
+            template_name:
+                A string, being the name of a template.
+            k:
+                An int, being an index between 0 and count(template_name) - 1 (or a negative index, counting back
+                from the end, as with a list).
+
+        Returns:
+            A string, being the k-th output.
+
+        Raises:
+            Exception:
+                There is no defined template with the given name.
+            IndexError:
+                The index is out of range.
+        """
+        return self._get_template(template_name=template_name).output_at(k=k)
+
+    def generate_unique(self, template_name, n, seed=None):
+        """Use the template with the given name to generate n distinct text outputs, in random order.
+
+        See Template.generate_unique() for details.
+
+        Args:
+            template_name:
+                A string, being the name of the template that is to be used to generate the text outputs.
+            n:
+                An int, being the number of outputs to generate. It can't exceed count(template_name).
+            seed:
+                A value that will be used to seed the permutation from which the outputs are drawn. If None is
+                passed, a seed is derived from the engine's random seed.
+
+        Returns:
+            A list of n distinct strings, each being a text output produced by filling the slots in the template.
+
+        Raises:
+            Exception:
+                There is no defined template with the given name, or it has fewer than n possible outputs.
+        """
+        return self._get_template(template_name=template_name).generate_unique(n=n, seed=seed)
+
+    def generate_many(self, template_name, n, seed=None, provenance=False):
+        """Use the template with the given name to generate a batch of text outputs.
+
+        This is the batched counterpart to generate(): rather than filling one output at a time, it draws the
+        slot values for all n outputs at once using NumPy, then assembles the outputs in bulk. See
+        Template.generate_many() for details.
+
+        Args:
+            template_name:
+                A string, being the name of the template that is to be used to generate the text outputs.
+            n:
+                An int, being the number of outputs to generate.
+            seed:
+                A value that will be used to seed the NumPy random generator for this batch. Calling this
+                method twice with the same seed produces the same outputs. If None is passed, a seed is derived
+                from the engine's random seed.
+            provenance:
+                If True, pair each output with the values that filled its slots (see Template.generate_many()).
+
+        Returns:
+            A list of n strings, each being a text output produced by filling the slots in the template.
+
+        Raises:
+            Exception:
+                There is no defined template with the given name.
+            ImportError:
+                NumPy is not installed.
+        """
+        return self._get_template(template_name=template_name).generate_many(n=n, seed=seed, provenance=provenance)
+
+    def iter_generate(self, template_name, n=None, seed=None, chunk_size=10000, provenance=False):
+        """Lazily generate text outputs using the template with the given name.
+
+        This is a generator: it produces outputs chunk_size at a time using generate_many(), and only moves on
+        to the next chunk once the caller has consumed the current one, so memory use stays constant however
+        many outputs are requested. The chunks are seeded exactly like those of generate_parallel(), so for
+        the same seed and chunk size, the two produce the same outputs in the same order.
+
+        Args:
+            template_name:
+                A string, being the name of the template that is to be used to generate the text outputs.
+            n:
+                An int, being the number of outputs to generate. If None is passed, outputs are generated
+                until the caller stops asking for them.
+            seed:
+                A value from which each chunk's sub-seed is derived. If None is passed, a seed is derived from
+                the engine's random seed.
+            chunk_size:
+                An int, being the number of outputs generated at a time. Changing this changes the output.
+            provenance:
+                If True, yield each output paired with the values that filled its slots (see
+                Template.generate_many()).
+
+        Yields:
+            Strings, each being a text output, or (output, slot values) tuples if 'provenance' is True.
+
+        Raises:
+            Exception:
+                There is no defined template with the given name.
+            ImportError:
+                NumPy is not installed.
+        """
+        template_object = self._get_template(template_name=template_name)
+        if seed is None:
+            seed = template_object.rng.getrandbits(64)
+        chunk_number = 0
+        remaining = n
+        while remaining is None or remaining > 0:
+            count = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk_seed = derive_seed(seed, template_name, 'chunk', chunk_number)
+            yield from template_object.generate_many(n=count, seed=chunk_seed, provenance=provenance)
+            chunk_number += 1
+            if remaining is not None:
+                remaining -= count
+
+    def generate_parallel(self, template_name, n, workers=None, seed=None, chunk_size=10000):
+        """Use the template with the given name to generate a batch of text outputs, using several processes.
+
+        The batch is cut into chunks of chunk_size outputs, each of which is generated by generate_many()
+        in a pool of worker processes. Chunk i is seeded with a sub-seed derived from the batch seed, the
+        template name and i, so the chunking (and with it the output) doesn't depend on how many workers
+        there are: the outputs come back in chunk order, and are identical for any number of workers. The
+        parsed engine is handed to the workers once, rather than with every chunk: where the operating system
+        supports it, the workers are forked and simply inherit it; elsewhere, it's pickled a single time and
+        unpickled by each worker as it starts up.
+
+        Args:
+            template_name:
+                A string, being the name of the template that is to be used to generate the text outputs.
+            n:
+                An int, being the number of outputs to generate.
+            workers:
+                An int, being the number of worker processes to use. If None is passed, one per CPU is used. If
+                1 is passed, the chunks are generated in this process.
+            seed:
+                A value from which each chunk's sub-seed is derived. If None is passed, a seed is derived from
+                the engine's random seed.
+            chunk_size:
+                An int, being the number of outputs per chunk. Changing this changes the output.
+
+        Returns:
+            A list of n strings, each being a text output produced by filling the slots in the template.
+
+        Raises:
+            Exception:
+                There is no defined template with the given name.
+            ImportError:
+                NumPy is not installed.
+        """
+        template_object = self._get_template(template_name=template_name)
+        if seed is None:
+            seed = template_object.rng.getrandbits(64)
+        chunks = [
+            (template_name, min(chunk_size, n - start), derive_seed(seed, template_name, 'chunk', chunk_number))
+            for chunk_number, start in enumerate(range(0, n, chunk_size))
+        ]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(chunks))
+        if workers <= 1:
+            return [output for chunk in chunks for output in self.generate_many(*chunk)]
+        global _worker_engine
+        if 'fork' in multiprocessing.get_all_start_methods():
+            # The workers inherit this engine through the module variable, so nothing needs to be pickled
+            context = multiprocessing.get_context('fork')
+            initializer, initargs = None, ()
+            _worker_engine = self
+        else:
+            context = multiprocessing.get_context()
+            initializer, initargs = _initialize_worker, (pickle.dumps(self),)
+        try:
+            with context.Pool(processes=workers, initializer=initializer, initargs=initargs) as pool:
+                # imap() hands back each chunk's outputs in chunk order, whichever worker finishes first
+                return [output for outputs in pool.imap(_generate_chunk, chunks) for output in outputs]
+        finally:
+            _worker_engine = None
+
+    def enable_instrumentation(self, callback=None, sketch_size=32):
+        """Start gathering statistics about the outputs that generate() produces, for stats() to report.
+
+        Instrumentation is off by default, and while it's off it costs nothing at all: rather than having
+        generate() check whether it's on, enabling it shadows generate() with an instrumented version (by setting
+        an instance attribute of the same name), and disabling it removes that attribute again. Only generate()
+        is instrumented; generate_many() and friends are already fast enough that any per-output bookkeeping
+        would dominate them, and they bypass it. Enabling instrumentation again starts over from scratch.
+
+        Args:
+            callback:
+                A callable, or None. If given, it's called with a dictionary describing each event as it
+                happens, for passing the events on to some other monitoring system. There are two kinds:
+                    {'event': 'render', 'template': name, 'seconds': float}, after each call to generate();
+                    {'event': 'refill', 'template': name, 'slot': name}, after each render in which a slot with
+                    single-use values had its pool refilled (see Slot.refill()).
+                The callback is called on the thread that called generate(), so it should be quick.
+            sketch_size:
+                An int, being how many of each slot's values are counted at once (see FrequencySketch). Any value
+                that makes up more than 1 / (sketch_size + 1) of a slot's fills is sure to be among them.
+        """
+        instrumentation = Instrumentation(callback=callback, sketch_size=sketch_size)
+        instrumentation.track_refills(
+            slot for template in self._templates_by_name.values() for slot in template.slots
+        )
+        self._instrumentation = instrumentation
+        self.generate = self._generate_instrumented
+
+    def disable_instrumentation(self):
+        """Stop gathering statistics. Those gathered so far can still be retrieved with stats()."""
+        self.__dict__.pop('generate', None)
+
+    def _generate_instrumented(self, template_name, max_len=None, min_len=None):
+        """Do what generate() does, and record the render. This stands in for generate() while instrumentation
+        is enabled (see enable_instrumentation())."""
+        template_object = self._get_template(template_name=template_name)
+        start = time.perf_counter_ns()
+        if max_len is None and min_len is None:
+            output, fills = template_object._render()
+        else:
+            output, fills = template_object._render_within(min_len=min_len, max_len=max_len)
+        self._instrumentation.record_render(
+            template=template_object, fills=fills, nanoseconds=time.perf_counter_ns() - start
+        )
+        return output
+
+    def reachable_slots(self, template_name):
+        """Return the names of the slots that the template with the given name fills, directly or through the
+        templates it references. A slot with filters gets its own name, as in 'ADJ|cap'.
+
+        Raises:
+            Exception:
+                There is no defined template with the given name.
+        """
+        return [slot.name for slot in self._get_template(template_name=template_name).slots]
+
+    def prewarm(self, template_names=None):
+        """Load every slot that the given templates fill, along with the corpora they reference.
+
+        With 'lazy_corpora' on (as it is by default), a slot's corpora are loaded when the slot is first filled,
+        which makes that first fill slow. Prewarming the templates that you know you'll use moves that cost up
+        front, and brings up any problem reading the corpora there and then.
+
+        Args:
+            template_names:
+                An iterable of strings, being the names of the templates to prewarm, or None to prewarm all of
+                them.
+
+        Raises:
+            Exception:
+                There is no defined template with one of the given names.
+            IOError:
+                One of the corpora can't be read.
+        """
+        if template_names is None:
+            template_names = list(self._templates_by_name)
+        for template_name in template_names:
+            for slot in self._get_template(template_name=template_name).slots:
+                slot.load()
+
+    def stats(self, top_values=10):
+        """Return statistics about this engine's templates, slots and corpora.
+
+        The statistics about templates and slots are only gathered while instrumentation is enabled (see
+        enable_instrumentation()). The corpus statistics come from the corpus cache, which always keeps them.
+
+        Args:
+            top_values:
+                An int, being how many of each slot's most frequent values to report.
+
+        Returns:
+            A dictionary with these keys:
+                'instrumented': whether instrumentation is currently enabled.
+                'templates': a dictionary mapping the name of each template that has been rendered to a dictionary
+                    with the keys 'renders' (how many times), 'seconds' (the total time taken) and
+                    'latency_histogram' (a list of (upper bound in seconds, count) tuples, one for each bucket
+                    that isn't empty, in increasing order; each bucket's lower bound is half of its upper bound).
+                'slots': a dictionary mapping the name of each slot that has been filled to a dictionary with
+                    the keys 'fills' (how many times), 'refills' (how many times its pool of single-use values
+                    was refilled) and 'top_values' (a list of (value, count) tuples for its most frequent values,
+                    from the most frequent down; the counts are lower bounds, as explained in FrequencySketch).
+                'corpora': a dictionary mapping the path of each corpus this engine references to a dictionary
+                    with the keys 'loads', 'seconds' and 'bytes' (see CorpusCache.load_stats()). A corpus that
+                    was served from the cache without being read is left out.
+        """
+        if self._instrumentation is None:
+            report = {'templates': {}, 'slots': {}}
+        else:
+            report = self._instrumentation.report(top_values=top_values)
+        report['instrumented'] = 'generate' in self.__dict__
+        report['corpora'] = corpus_cache.load_stats(paths=self.corpus_paths)
+        return report
+
+    def _get_template(self, template_name):
+        """Return the Template object with the given name.
+
+        Raises:
+            Exception:
+                There is no defined template with the given name.
+        """
+        try:
+            return self._templates_by_name[template_name]
+        except KeyError:  # There is no defined template by that name, so raise an Exception
+            error_message = f"There is no defined template with the name {template_name}. "
+            all_defined_template_names = ", ".join(template.name for template in self.templates)
+            error_message += f"These templates are defined: {all_defined_template_names}."
+            raise Exception(error_message)
+
+
+class SourceLayout:
+    """A record of the lines of a template definitions file, as it was when it was last scanned.
+
+    For each line, we keep its hash and the name of the slot or template defined on it (if any), along with the
+    index of the line of each section marker. When the file is edited, comparing the hashes of its lines now
+    against these tells us the range of lines that the edit touched (see changed_range()), so reload() only has
+    to scan those lines again. The hashes are Python's own string hashes, which differ from one process to the
+    next, so a layout must never be pickled.
+
+    Attributes:
+        line_hashes:
+            An array of ints, being the hash of each line of the file.
+        line_names:
+            A list with an item for each line of the file: the name of the slot or template defined on it, or
+            None if there isn't one.
+        marker_lines:
+            A dictionary mapping each section marker to the index of its line (counting from 0).
+    """
+
+    __slots__ = ('line_hashes', 'line_names', 'marker_lines', '_positions', '_lookups')
+
+    # The number of lines compared at a time when looking for the lines that have changed
+    BLOCK_SIZE = 4096
+    # The number of line numbers looked up by searching before they're all indexed (see line_number())
+    SEARCH_LIMIT = 32
+
+    def __init__(self, line_hashes, line_names, marker_lines):
+        """Initialize a SourceLayout object.
+
+        Args:
+            line_hashes:
+                An array of ints, being the hash of each line of the file.
+            line_names:
+                A list of the name defined on each line of the file (or None).
+            marker_lines:
+                A dictionary mapping each section marker to the index of its line.
+        """
+        self.line_hashes = line_hashes
+        self.line_names = line_names
+        self.marker_lines = marker_lines
+        self._positions = None  # Maps each (section, name) to the index of its line
+        self._lookups = 0
+
+    def changed_range(self, line_hashes):
+        """Find the range of lines that differ between the file as it was and the file as it is now.
+
+        The lines that the two versions share at the start and at the end are skipped over, a block at a time
+        (comparing slices of the arrays is done in C, which is far faster than comparing line by line in
+        Python), and then a line at a time within the block where they part ways. Whatever is left in between
+        is the changed range: an edit anywhere in a single definition gives a range of one line.
+
+        Args:
+            line_hashes:
+                An array of ints, being the hash of each line of the file as it is now.
+
+        Returns:
+            A tuple of three ints: the index of the first changed line, and the index just past the last
+            changed line in the old version and in the new version of the file. If a line was only inserted,
+            the first two are equal; if a line was only deleted, the first and the last are equal.
+        """
+        old_hashes = self.line_hashes
+        block_size = self.BLOCK_SIZE
+        old_size = len(old_hashes)
+        new_size = len(line_hashes)
+        limit = min(old_size, new_size)
+        start = 0
+        while start + block_size <= limit and (
+            old_hashes[start:start + block_size] == line_hashes[start:start + block_size]
+        ):
+            start += block_size
+        while start < limit and old_hashes[start] == line_hashes[start]:
+            start += 1
+        # Don't let the shared lines at the end overlap with those at the start
+        limit -= start
+        end = 0
+        while end + block_size <= limit and (
+            old_hashes[old_size - end - block_size:old_size - end]
+            == line_hashes[new_size - end - block_size:new_size - end]
+        ):
+            end += block_size
+        while end < limit and old_hashes[old_size - end - 1] == line_hashes[new_size - end - 1]:
+            end += 1
+        return start, old_size - end, new_size - end
+
+    def section_at(self, index):
+        """Return the section ('SLOTS' or 'TEMPLATES') that a line inserted at the given index would be in, or
+        None if it would be outside of both."""
+        marker_lines = self.marker_lines
+        for section in ('SLOTS', 'TEMPLATES'):
+            if marker_lines[f'<BEGIN {section}>'] < index <= marker_lines[f'<END {section}>']:
+                return section
+        return None
+
+    def line_number(self, name, section):
+        """Return the number (counting from 1) of the line on which the named slot or template is defined."""
+        first = self.marker_lines[f'<BEGIN {section}>'] + 1
+        last = self.marker_lines[f'<END {section}>']
+        # A reload usually needs just a few of these, and searching the list is done in C, but after enough
+        # searches it pays to index every line instead
+        positions = self._positions
+        if positions is None:
+            self._lookups += 1
+            if self._lookups <= self.SEARCH_LIMIT:
+                return self.line_names.index(name, first, last) + 1
+            positions = self._positions = {}
+            for section_name in ('SLOTS', 'TEMPLATES'):
+                start = self.marker_lines[f'<BEGIN {section_name}>'] + 1
+                stop = self.marker_lines[f'<END {section_name}>']
+                for index, line_name in enumerate(self.line_names[start:stop], start=start):
+                    if line_name is not None:
+                        positions[section_name, line_name] = index
+        return positions[section, name] + 1
+
+
+# The engine used by the worker processes of TemplateEngine.generate_parallel()
+_worker_engine = None
+
+
+def _initialize_worker(pickled_engine):
+    """Unpickle the engine that a worker process of generate_parallel() will use (when it can't be forked)."""
+    global _worker_engine
+    _worker_engine = pickle.loads(pickled_engine)
+
+
+def _generate_chunk(chunk):
+    """Generate one chunk of a generate_parallel() batch in a worker process."""
+    template_name, n, seed = chunk
+    return _worker_engine.generate_many(template_name, n, seed)
+
+
+def derive_seed(seed, *names):
+    """Derive a seed for a random generator from a parent seed and some names.
+
+    The derivation hashes its inputs with SHA-256, rather than using Python's built-in hash(), because the
+    latter is randomized for strings in every new process and we want derived seeds to be the same everywhere.
+
+    Args:
+        seed:
+            The parent seed (any value with a stable repr(), such as an int or a string).
+        *names:
+            Strings (or ints) that identify what the derived seed is for, such as a template and slot name.
+
+    Returns:
+        An int, being a 64-bit seed.
+    """
+    digest = hashlib.sha256(repr((seed,) + names).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+class IndexPermutation:
+    """A seeded pseudorandom permutation of the integers 0, 1, ..., size - 1.
+
+    The permutation is a small block cipher whose blocks are integers: a Feistel network, which splits a number
+    into a left and a right half and, in each of several rounds, swaps the halves while mixing a keyed hash of
+    one into the other. A Feistel network is a permutation whatever hash it uses, since each round can be undone.
+    Its domain, though, is a power of two, which is usually larger than 'size'. So we use 'cycle walking': if
+    encrypting a number lands outside of the range, we just encrypt the result again, and again, until we're
+    back inside it. We take the smallest power of two that covers the range (when it has an odd number of bits,
+    the halves differ in size by one bit, and trade sizes every round), so the domain is less than twice the
+    size of the range, and it takes fewer than two encryptions on average. Nothing is stored per element, so a
+    permutation of a range with 10 ** 30 elements takes no more memory than one with ten.
+
+    Attributes:
+        size:
+            An int, being the number of integers permuted.
+    """
+
+    # This must be even, so that the halves end up the sizes they started out as
+    ROUNDS = 4
+
+    def __init__(self, size, seed):
+        """Initialize an IndexPermutation object.
+
+        Args:
+            size:
+                A positive int, being the number of integers to permute.
+            seed:
+                A value from which the permutation's keys are derived. The same size and seed always give the
+                same permutation.
+        """
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        left_bits = bits // 2
+        right_bits = bits - left_bits
+        self._right_bits = right_bits
+        # For each round: the key, the number of bytes in the right half (which is hashed), the size of the hash,
+        # and a mask that trims the hash to the size of the left half (which it's mixed into). BLAKE2b digests
+        # are at most 64 bytes, so for (absurdly) large ranges the hash only mixes into the low 512 bits of each
+        # half. The network is still a permutation; it's just a less thorough shuffle.
+        rounds = []
+        for round_number in range(self.ROUNDS):
+            key = derive_seed(seed, 'permutation', round_number).to_bytes(8, 'little')
+            left_bytes = (left_bits + 7) // 8
+            rounds.append((key, (right_bits + 7) // 8, min(left_bytes, 64), (1 << left_bits) - 1))
+            left_bits, right_bits = right_bits, left_bits
+        self._rounds = tuple(rounds)
+
+    def _encrypt(self, value):
+        """Run the given number through the Feistel network once."""
+        left = value >> self._right_bits
+        right = value & ((1 << self._right_bits) - 1)
+        for key, right_bytes, digest_size, left_mask in self._rounds:
+            digest = hashlib.blake2b(right.to_bytes(right_bytes, 'little'), key=key, digest_size=digest_size).digest()
+            left, right = right, left ^ (int.from_bytes(digest, 'little') & left_mask)
+        return (left << self._right_bits) | right
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        """Return the integer that the given one is mapped to."""
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError(f"index {index} is out of range for a permutation of {self.size} integers")
+        value = self._encrypt(index)
+        while value >= self.size:  # Cycle-walk back into the range
+            value = self._encrypt(value)
+        return value
+
+
+class FrequencySketch:
+    """A summary, in bounded memory, of how often values turn up in a stream, which keeps the most frequent ones.
+
+    This is the Misra-Gries summary: it holds at most 'size' counters. A value that already has a counter bumps
+    it, and a new value takes a free counter if there is one. If there isn't, every counter is decremented
+    instead (and those that reach zero are dropped), which cancels the new value out against one occurrence of
+    each value being counted. After n values, then, any value that made up more than n / (size + 1) of them is
+    sure to have a counter, and each count falls short of the true count by at most n / (size + 1). Decrementing
+    every counter takes time proportional to 'size', but since each decrement cancels an earlier increment, it
+    all works out to constant time per value on average.
+
+    Attributes:
+        size:
+            An int, being the maximum number of values counted at once.
+        total:
+            An int, being the number of values added so far.
+    """
+
+    def __init__(self, size=32):
+        """Initialize a FrequencySketch object.
+
+        Args:
+            size:
+                An int, being the maximum number of values counted at once.
+        """
+        self.size = size
+        self.total = 0
+        self._counters = {}
+
+    def add(self, value):
+        """Count one occurrence of the given (hashable) value."""
+        self.total += 1
+        counters = self._counters
+        if value in counters:
+            counters[value] += 1
+        elif len(counters) < self.size:
+            counters[value] = 1
+        else:
+            for key in list(counters):
+                if counters[key] == 1:
+                    del counters[key]
+                else:
+                    counters[key] -= 1
+
+    def most_common(self, n=None):
+        """Return a list of (value, count) tuples for the n values with the highest counts (or all of them, if n is
+        None), from the highest count down. Each count is a lower bound on the value's true count."""
+        return sorted(self._counters.items(), key=lambda item: item[1], reverse=True)[:n]
+
+
+class Instrumentation:
+    """The statistics that an engine gathers about its templates and slots while instrumentation is enabled.
+
+    See TemplateEngine.enable_instrumentation(). For each template, we count its renders and keep a histogram of
+    how long they took, in buckets whose bounds are powers of two nanoseconds (so a render's bucket is just the
+    bit length of its duration). For each slot, we count its fills and refills, and keep a FrequencySketch of the
+    values it was filled with. Slots are tracked by name, so a slot that several templates reference (or that
+    has a separate copy in each of them, for its single-use values) is reported once, with everything added up.
+
+    Attributes:
+        callback:
+            A callable that's passed a dictionary describing each event as it happens, or None. See
+            TemplateEngine.enable_instrumentation() for the events.
+        sketch_size:
+            An int, being the size of the FrequencySketch kept for each slot.
+    """
+
+    # Durations are bucketed by their bit length in nanoseconds, and 2 ** 63 nanoseconds is about 292 years
+    HISTOGRAM_BUCKETS = 64
+
+    def __init__(self, callback=None, sketch_size=32):
+        """Initialize an Instrumentation object.
+
+        Args:
+            callback:
+                A callable that takes a dictionary, or None.
+            sketch_size:
+                An int, being the size of the FrequencySketch kept for each slot.
+        """
+        self.callback = callback
+        self.sketch_size = sketch_size
+        self._lock = threading.Lock()
+        # Maps a template name to a [renders, total nanoseconds, histogram] list
+        self._templates = {}
+        # Maps a slot name to a [fills, refills, FrequencySketch] list
+        self._slots = {}
+        # Maps each slot with single-use values to the number of its refills that have been accounted for
+        self._refills_seen = weakref.WeakKeyDictionary()
+
+    def track_refills(self, slots):
+        """Start counting refills of the given slots from now on, ignoring any that happened earlier."""
+        with self._lock:
+            for slot in slots:
+                # A slot that hasn't been loaded yet hasn't been refilled either
+                if slot.is_loaded() and slot.has_single_use_values():
+                    self._refills_seen[slot] = slot.refills
+
+    def _slot_stats(self, name):
+        """Return the [fills, refills, FrequencySketch] list for the slot with the given name. The caller must
+        hold the lock."""
+        slot_stats = self._slots.get(name)
+        if slot_stats is None:
+            slot_stats = self._slots[name] = [0, 0, FrequencySketch(size=self.sketch_size)]
+        return slot_stats
+
+    def record_render(self, template, fills, nanoseconds):
+        """Record a render of the given template.
+
+        Args:
+            template:
+                The Template object that was rendered.
+            fills:
+                A list of strings, being the value that filled each slot occurrence in the template.
+            nanoseconds:
+                An int, being how long the render took.
+        """
+        events = []
+        with self._lock:
+            template_stats = self._templates.get(template.name)
+            if template_stats is None:
+                template_stats = self._templates[template.name] = [0, 0, [0] * self.HISTOGRAM_BUCKETS]
+            template_stats[0] += 1
+            template_stats[1] += nanoseconds
+            template_stats[2][min(nanoseconds.bit_length(), self.HISTOGRAM_BUCKETS - 1)] += 1
+            slots = template.slots
+            for index, value in zip(template.slot_indices, fills):
+                slot_stats = self._slot_stats(slots[index].name)
+                slot_stats[0] += 1
+                slot_stats[2].add(value)
+            # A refill happens inside Slot.draw(), in the middle of a render, so we spot it afterwards by
+            # comparing the slot's count of refills with the last one we saw
+            for slot in slots:
+                if slot.has_single_use_values():
+                    refills = slot.refills - self._refills_seen.get(slot, 0)
+                    if refills:
+                        self._refills_seen[slot] = slot.refills
+                        self._slot_stats(slot.name)[1] += refills
+                        events.append({'event': 'refill', 'template': template.name, 'slot': slot.name})
+        if self.callback is not None:
+            self.callback({'event': 'render', 'template': template.name, 'seconds': nanoseconds / 1e9})
+            for event in events:
+                self.callback(event)
+
+    def report(self, top_values=10):
+        """Return the statistics gathered so far, in the form documented in TemplateEngine.stats()."""
+        with self._lock:
+            templates = {}
+            for name, (renders, nanoseconds, histogram) in self._templates.items():
+                templates[name] = {
+                    'renders': renders,
+                    'seconds': nanoseconds / 1e9,
+                    'latency_histogram': [
+                        (2 ** bucket / 1e9, count) for bucket, count in enumerate(histogram) if count
+                    ],
+                }
+            slots = {}
+            for name, (fills, refills, sketch) in self._slots.items():
+                slots[name] = {'fills': fills, 'refills': refills, 'top_values': sketch.most_common(top_values)}
+            return {'templates': templates, 'slots': slots}
+
+
+class Template:
+    """A template, for use in template-based text generation.
+
+    Attributes:
+        name:
+            A string, being the template name.
+        template:
+            A list of strings (static elements), Slot objects (slots), RhymeReference objects (slots that must
+            rhyme with an earlier slot) and TemplateReference objects (references to other templates).
+        filters:
+            A tuple of strings, being the filters applied to the template's whole output (see TEMPLATE_FILTERS).
+    """
+
+    # The filters that can be applied to a whole template by writing them after its name, separated by bars, as
+    # in 'POEM|unescape -> ...'. These are the filters of Slot.FILTERS that can be applied piece by piece: rather
+    # than filtering every output, the engine filters the template's static elements and the values of its slots
+    # when it compiles the template (see TemplateEngine._filter_elements()), so they cost nothing per output.
+    TEMPLATE_FILTERS = ('upper', 'lower', 'cap', 'unescape')
+
+    __slots__ = (
+        'name', 'template', 'filters', 'segments', 'slots', 'slot_indices', '_random_seed', '_rng', '_slot_rngs',
+        '_parts', '_fills', '_rhymes', '_length_table',
+    )
+
+    def __init__(self, name, template, filters=()):
+        """Initialize a Template object.
+
+        Args:
+            name:
+                A string, being the template name.
+            template:
+                A list of strings (static elements) and Slot objects (slots).
+            filters:
+                A tuple of strings, each being one of TEMPLATE_FILTERS.
+        """
+        self.name = name
+        self.template = template
+        self.filters = filters
+        # These are populated by compile(); see that method for details
+        self.segments = ()
+        self.slots = ()
+        self.slot_indices = array('I')
+        self._random_seed = 0
+        self._rng = None
+        self._slot_rngs = None
+        self._parts = []
+        self._fills = None
+        self._rhymes = {}
+        self._length_table = None
+
+    def __getstate__(self):
+        # Only pickle the definition of the template; it's recompiled after unpickling
+        return {'name': self.name, 'template': self.template, 'filters': self.filters}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def compile(self, random_seed=0, elements=None):
+        """Compile this template into a flat render program.
+
+        The program comprises three pieces: a tuple of static segments, a tuple of the distinct Slot objects
+        referenced by the template, and an array that gives, for each slot occurrence in the template, the
+        index of its Slot object in that tuple. There is always exactly one more static segment than there
+        are slot occurrences (some segments may be empty strings), so a text output is just the segments
+        interleaved with one fill per occurrence, which we can assemble with a single ''.join(). Doing all
+        the isinstance() checks here, once, means generate() never has to look at the element types again.
+
+        Compiling also sets up this template's random generators: one for each distinct slot, seeded from the
+        given seed together with the template's name and the slot's name, plus one for the template as a whole
+        (used to seed batches; see generate_many()). Since no other template draws from these generators, and
+        their seeds don't depend on anything else in the definitions file, the outputs of this template
+        depend only on the seed and on its own definition. By the same token, slots with single-use values get
+        a separate copy (see Slot.copy()) in each template that references them. Seeding a generator isn't free,
+        so the generators aren't made until they're first needed (see rng and _rngs), and nor are the fill
+        functions that use them (see _bind_fills()): a template that is compiled but never used doesn't pay
+        for them.
+
+        Args:
+            random_seed:
+                A value from which this template's random generators are seeded.
+            elements:
+                A list of strings and Slot objects to compile in place of this template's own elements. The
+                engine passes in the template's elements with any references to other templates expanded.
+        """
+        segments = []
+        occurrences = []  # The Slot object at each slot occurrence
+        rhymes = {}  # Maps the position of each occurrence that must rhyme to that of the occurrence it rhymes with
+        latest = {}  # Maps the name of each slot (without filters) to the position of its latest occurrence so far
+        static_element = ''
+        for element in self.template if elements is None else elements:
+            if isinstance(element, (Slot, RhymeReference)):
+                segments.append(static_element)
+                static_element = ''
+                if isinstance(element, RhymeReference):
+                    target = latest.get(element.target)
+                    if target is None:
+                        raise Exception(
+                            f"Template '{self.name}' has a slot '{element.slot.name}' that must rhyme with "
+                            f"'{element.target}', but '{element.target}' doesn't appear before it."
+                        )
+                    # Rhyming is transitive, so every occurrence in a chain of rhymes rhymes with the first one
+                    rhymes[len(occurrences)] = rhymes.get(target, target)
+                    element = element.slot
+                latest[element.name.split('|', 1)[0]] = len(occurrences)
+                occurrences.append(element)
+            else:
+                static_element += element
+        segments.append(static_element)
+        # Restrict each occurrence that others rhyme with to the values that every one of them has a rhyme for
+        for position, target in rhymes.items():
+            occurrences[target] = occurrences[target].constrained(key_name='rhyme', keys=occurrences[position])
+        slots = []
+        slot_indices = array('I')
+        for occurrence in occurrences:
+            # Reuse the index of this slot if we've already seen it earlier in the template
+            for index, slot in enumerate(slots):
+                if slot is occurrence:
+                    break
+            else:
+                index = len(slots)
+                slots.append(occurrence)
+            slot_indices.append(index)
+        self.segments = tuple(segments)
+        # A slot that hasn't been loaded yet gets a (deferred) copy too, since we can't tell yet whether it has
+        # single-use values without loading it
+        self.slots = tuple(
+            slot.copy() if not slot.is_loaded() or slot.has_single_use_values() else slot for slot in slots
+        )
+        self.slot_indices = slot_indices
+        self._random_seed = random_seed
+        self._rng = None
+        self._slot_rngs = None
+        # This list is a scaffold for the final output: the static segments sit at the even positions, and
+        # generate() drops a fill into each odd position before joining the whole thing
+        self._parts = [None] * (2 * len(segments) - 1)
+        self._parts[0::2] = self.segments
+        self._fills = None  # See _bind_fills()
+        self._rhymes = rhymes
+        self._length_table = None  # See _lengths_within()
+
+    @property
+    def rng(self):
+        """The random generator for this template as a whole (see compile()), made the first time it's needed."""
+        rng = self._rng
+        if rng is None:
+            rng = self._rng = random.Random(derive_seed(self._random_seed, self.name))
+        return rng
+
+    @property
+    def _rngs(self):
+        """A tuple of the random generators for this template's slots, in the order of 'slots' (see compile()),
+        made the first time they're needed."""
+        rngs = self._slot_rngs
+        if rngs is None:
+            rngs = self._slot_rngs = tuple(
+                random.Random(derive_seed(self._random_seed, self.name, slot.name)) for slot in self.slots
+            )
+        return rngs
+
+    def _bind_fills(self):
+        """Make, keep and return a tuple of the functions that fill each slot occurrence, for generate()."""
+        rngs = self._rngs
+        slot_indices = self.slot_indices
+        # Binding each occurrence's 'fill' method to its generator now saves attribute lookups on every fill later
+        fills = [partial(self.slots[index].fill, rngs[index]) for index in slot_indices]
+        # An occurrence that must rhyme reads the value of the occurrence it rhymes with, which (coming earlier in
+        # the template) is always filled first, from a list that the latter's fill function writes the value to
+        cells = {}
+        for position, target in self._rhymes.items():
+            if target not in cells:
+                cells[target] = [None]
+                fills[target] = partial(_record_fill, fills[target], cells[target])
+            index = slot_indices[position]
+            fills[position] = partial(_fill_rhyme, self.slots[index], rngs[index], cells[target])
+        self._fills = fills = tuple(fills)
+        return fills
+
+    def generate(self):
+        """Use this template to generate a single text output.
+
+        Returns:
+            A string, being a single text output produced by filling the slots in this template.
+        """
+        fills = self._fills
+        if fills is None:
+            fills = self._bind_fills()
+        parts = self._parts[:]
+        parts[1::2] = [fill() for fill in fills]
+        return ''.join(parts)
+
+    def _render(self):
+        """Do what generate() does, but return an (output, fills) tuple, where 'fills' is a list of the values that
+        filled the slot occurrences. This is what the engine renders with when instrumentation is enabled."""
+        fills = self._fills
+        if fills is None:
+            fills = self._bind_fills()
+        fills = [fill() for fill in fills]
+        parts = self._parts[:]
+        parts[1::2] = fills
+        return ''.join(parts), fills
+
+    def generate_within(self, min_len=None, max_len=None):
+        """Use this template to generate a single text output with a length (in characters) within the given limits.
+
+        An output's length is the length of the static segments, which is fixed, plus the lengths of the fills.
+        So we work out, for each slot occurrence, which totals the fills of the occurrences after it can add up
+        to (see _lengths_within()), and then fill the occurrences from left to right, each from just those of
+        its values that leave a total that the rest of the occurrences can still make up. The values of each
+        length are kept together (see Slot.key_index()), so each fill is a draw from a slot that holds the
+        values of the allowed lengths (see Slot.constrained()). Every output fits, and none is thrown away.
+
+        Each value is drawn in proportion to its weight among the values that are allowed at that point, so the
+        outputs lean towards those that leave the most room. An occurrence that doesn't need restricting is
+        filled from its own slot, as generate() would; one that does is filled from a slot with a pool of its
+        own, so its single-use values aren't used up in step with the unrestricted slot's.
+
+        Args:
+            min_len:
+                An int, being the least number of characters the output may have, or None for no limit.
+            max_len:
+                An int, being the greatest number of characters the output may have, or None for no limit.
+
+        Returns:
+            A string, being a text output produced by filling the slots in this template.
+
+        Raises:
+            Exception:
+                The template can't produce an output of the requested length, or it has slots that must rhyme
+                (see RhymeReference), whose lengths depend on each other.
+        """
+        return self._render_within(min_len=min_len, max_len=max_len)[0]
+
+    def _render_within(self, min_len, max_len):
+        """Do what generate_within() does, but return an (output, fills) tuple, as _render() does."""
+        fits, length_sets, choices = self._lengths_within(min_len=min_len, max_len=max_len)
+        rngs = self._rngs
+        fills = []
+        used = 0
+        for position, index in enumerate(self.slot_indices):
+            # Bit n of this is set if a value of length n is allowed here, given what's been used so far
+            allowed = (fits[position] >> used) & length_sets[position]
+            slot = choices[position].get(allowed)
+            if slot is None:
+                slot = self.slots[index]
+                if allowed != length_sets[position]:
+                    keys = frozenset(length for length in range(allowed.bit_length()) if allowed >> length & 1)
+                    slot = slot.constrained(key_name='length', keys=keys)
+                choices[position][allowed] = slot
+            value = slot.fill(rngs[index])
+            fills.append(value)
+            used += len(value)
+        parts = self._parts[:]
+        parts[1::2] = fills
+        return ''.join(parts), fills
+
+    def _lengths_within(self, min_len, max_len):
+        """Work out which lengths the slot occurrences can be filled with to keep the output within the given limits.
+
+        First comes a table of which totals each suffix of the occurrences can add up to, built from the last
+        occurrence back to the first by dynamic programming. Each set of totals is held as the bits of an int (bit
+        t is set if the occurrences from that point on can add up to t), so adding every length that an
+        occurrence's values can have to the totals of the occurrences after it is one shift and one 'or' per
+        length, whatever the number of totals. Totals past the most that fits are masked off.
+
+        A value of length n is then allowed at an occurrence, with u characters used so far, if the occurrences
+        after it can add up to a total between low - u - n and high - u - n (where 'low' and 'high' are the
+        limits on the total length of the fills). Smearing each bit of the totals upwards over the width of that
+        range (high - low + 1 bits) turns that into a check of the single bit high - u - n, and reversing the
+        bits turns it into a check of bit u + n. So, for each occurrence, we keep the reversed, smeared totals
+        of the occurrences after it, and the allowed lengths at generation time are those totals shifted down by
+        u, masked by the lengths the occurrence's values can have: one shift and one 'and', with no loop over
+        the lengths. The table for the last limits asked for is kept, since a caller usually asks for the same
+        limits over and over.
+
+        Returns:
+            A tuple containing three lists, each with an entry for each slot occurrence: the reversed, smeared
+            totals described above; the bit set of the lengths that the occurrence's values can have; and an
+            (initially empty) dictionary mapping a bit set of allowed lengths to the Slot object to fill the
+            occurrence from, which _render_within() fills in as it goes.
+
+        Raises:
+            Exception:
+                The template can't produce an output of the requested length, or it has slots that must rhyme.
+        """
+        limits = (min_len, max_len)
+        if self._length_table is not None and self._length_table[0] == limits:
+            return self._length_table[1]
+        if self._rhymes:
+            raise Exception(f"Template '{self.name}' has slots that must rhyme, so it can't be generated to a length.")
+        # Only the lengths of values that can be drawn count, so a length held only by values of weight zero
+        # is left out
+        slot_lengths = []
+        for slot in self.slots:
+            index = slot.key_index(key_name='length')
+            weights = slot.weights
+            slot_lengths.append(sorted(
+                length for length, value_indices in index.items()
+                if weights is None or any(weights[value_index] > 0 for value_index in value_indices)
+            ))
+        lengths = [slot_lengths[index] for index in self.slot_indices]
+        static_length = sum(map(len, self.segments))
+        low = max((min_len or 0) - static_length, 0)
+        high = sum(occurrence_lengths[-1] for occurrence_lengths in lengths)
+        if max_len is not None:
+            high = min(high, max_len - static_length)
+        reachable = [1]
+        if high >= 0:
+            mask = (2 << high) - 1
+            for occurrence_lengths in reversed(lengths):
+                after = reachable[-1]
+                totals = 0
+                for length in occurrence_lengths:
+                    if length > high:
+                        break
+                    totals |= after << length
+                reachable.append(totals & mask)
+            reachable.reverse()
+        if high < 0 or low > high or not reachable[0] >> low:
+            if max_len is None:
+                limit = f"at least {min_len}"
+            else:
+                limit = f"at most {max_len}" if min_len is None else f"between {min_len} and {max_len}"
+            raise Exception(f"Template '{self.name}' can't produce an output of {limit} characters.")
+        width = high - low + 1
+        fits = []
+        for totals in reachable[1:]:
+            # Smear each bit over itself and the 'width' - 1 bits above it, doubling the smeared width each time
+            smeared = totals
+            width_so_far = 1
+            while width_so_far < width:
+                shift = min(width_so_far, width - width_so_far)
+                smeared |= smeared << shift
+                width_so_far += shift
+            fits.append(int(format(smeared & mask, f'0{high + 1}b')[::-1], 2))
+        length_sets = [sum(1 << length for length in occurrence_lengths) for occurrence_lengths in lengths]
+        table = (fits, length_sets, [{} for _ in lengths])
+        self._length_table = (limits, table)
+        return table
+
+    def generate_many(self, n, seed=None, provenance=False):
+        """Use this template to generate a batch of text outputs.
+
+        All the slot indices for the whole batch are drawn in one go, as an n-by-k NumPy integer array
+        with one column per slot occurrence in the template. Each column is then turned into a column of
+        strings with a single fancy-indexing operation, and each output is assembled with one ''.join()
+        over its row. Slots that include single-use values can't be drawn like this, since every fill of
+        such a slot depends on the fills that came before it, so those occurrences are filled one at a time
+        (still reproducibly, using a random.Random seeded from the batch's generator). The same goes for slots
+        whose policy is 'shuffle_bag', and for every occurrence in a template with slots that must rhyme (see
+        RhymeReference), since the fill of a rhyming occurrence depends on an earlier fill in the same output.
+
+        Args:
+            n:
+                An int, being the number of outputs to generate.
+            seed:
+                A value that will be used to seed the NumPy random generator for this batch. If None is
+                passed, a seed is drawn from this template's own generator, so that successive batches
+                differ but are still reproducible under the engine's seed.
+            provenance:
+                If True, pair each output with the values that filled its slots.
+
+        Returns:
+            A list of n strings, each being a text output produced by filling the slots in this template. If
+            'provenance' is True, each element is instead a tuple containing the output and a tuple of
+            (slot name, value) pairs, one per slot occurrence in the template.
+
+        Raises:
+            ImportError:
+                NumPy is not installed.
+        """
+        if numpy is None:
+            raise ImportError("generate_many() requires NumPy, which is not installed.")
+        if seed is None:
+            seed = self.rng.getrandbits(64)
+        generator = numpy.random.default_rng(seed)
+        if self._rhymes:
+            # Fill the outputs one at a time, from fresh copies of the slots (see below)
+            sequential_rng = random.Random(int(generator.integers(2 ** 63)))
+            slots = [slot.copy() for slot in self.slots]
+            value_rows = []
+            for _ in range(n):
+                fills = []
+                for position, index in enumerate(self.slot_indices):
+                    target = self._rhymes.get(position)
+                    slot = slots[index] if target is None else slots[index].rhyme_bucket(fills[target])
+                    fills.append(slot.fill(rng=sequential_rng))
+                value_rows.append(fills)
+            outputs = []
+            for fills in value_rows:
+                parts = self._parts[:]
+                parts[1::2] = fills
+                outputs.append(''.join(parts))
+            if not provenance:
+                return outputs
+            slot_names = self.occurrence_names()
+            return [(output, tuple(zip(slot_names, fills))) for output, fills in zip(outputs, value_rows)]
+        # Draw every index for every occurrence at once. The upper bound for each column is the number of
+        # values in that occurrence's slot; NumPy broadcasts the bounds across the rows.
+        sizes = numpy.array([len(self.slots[index].values) for index in self.slot_indices], dtype=numpy.int64)
+        draws = generator.integers(0, sizes, size=(n, len(sizes))) if len(sizes) else None
+        # Weighted slots need a second, uniform draw per cell to pick a value from their alias tables
+        weighted = any(self.slots[index].weights is not None for index in self.slot_indices)
+        heights = generator.random(size=(n, len(sizes))) if weighted else None
+        sequential_rng = random.Random(int(generator.integers(2 ** 63)))
+        # Build the columns of the output, interleaving the static segments (which are the same in every row)
+        # with the columns of slot values
+        value_arrays = {}
+        value_columns = []
+        columns = [repeat(self.segments[0], n)]
+        for column, index in enumerate(self.slot_indices):
+            slot = self.slots[index]
+            if slot.has_single_use_values():
+                if index not in value_arrays:
+                    # Fill from a fresh copy of the slot, so that the batch doesn't depend on (or disturb) the
+                    # state of the slot's single-use values
+                    value_arrays[index] = slot.copy()
+                value_column = [value_arrays[index].fill(rng=sequential_rng) for _ in range(n)]
+            elif not isinstance(slot.values, list):
+                # Memory-mapped values are decoded one drawn line at a time rather than all up front
+                values = slot.values
+                value_column = [values[value_index] for value_index in draws[:, column].tolist()]
+            else:
+                if index not in value_arrays:
+                    value_arrays[index] = numpy.array(slot.values, dtype=object)
+                value_indices = draws[:, column]
+                if slot.weights is not None:
+                    # The vectorized version of the alias-table draw in Slot.draw(): keep each drawn column if the
+                    # height falls within its probability, and take the column's alias otherwise
+                    probabilities = numpy.frombuffer(slot._probabilities, dtype=numpy.float64)
+                    aliases = numpy.frombuffer(slot._aliases, dtype=numpy.uint32)
+                    value_indices = numpy.where(
+                        heights[:, column] < probabilities[value_indices], value_indices, aliases[value_indices]
+                    )
+                value_column = value_arrays[index][value_indices].tolist()
+            value_columns.append(value_column)
+            columns.append(value_column)
+            columns.append(repeat(self.segments[column + 1], n))
+        outputs = [''.join(row) for row in zip(*columns)]
+        if not provenance:
+            return outputs
+        slot_names = self.occurrence_names()
+        value_rows = zip(*value_columns) if value_columns else repeat((), n)
+        return [(output, tuple(zip(slot_names, values))) for output, values in zip(outputs, value_rows)]
+
+    def occurrence_names(self):
+        """Return a tuple containing the name of the slot at each slot occurrence in this template, in order.
+
+        The names are those of the slots as defined, without the filters and constraints that the template (or
+        the occurrence itself) applies to them, so an occurrence written '<ADJ|cap>' in a 'POEM|unescape'
+        template is named 'ADJ', not 'ADJ|cap|unescape'.
+        """
+        return tuple(self.slots[index].name.split('|', 1)[0] for index in self.slot_indices)
+
+    def count(self):
+        """Return the number of outputs that this template can produce.
+
+        This is the product, over the slot occurrences in the template, of the number of values of the slot at
+        each occurrence. Python ints never overflow, so the count is exact however large it gets. It counts the
+        ways of filling in the template, which is the number of distinct outputs as long as no two fillings
+        happen to spell the same string (e.g., 'a' + 'bc' and 'ab' + 'c'). Weights are ignored, and so are
+        single-use restrictions: every value counts, even one whose weight is zero.
+
+        Returns:
+            An int, being the number of outputs.
+
+        Raises:
+            Exception:
+                The template has slots that must rhyme (see RhymeReference). Their fills depend on each other, so
+                the outputs can't be counted (or numbered, for output_at() and generate_unique()) this way.
+        """
+        if self._rhymes:
+            raise Exception(f"Template '{self.name}' has slots that must rhyme, so its outputs can't be counted.")
+        return prod(len(self.slots[index].values) for index in self.slot_indices)
+
+    def output_at(self, k):
+        """Return the k-th output that this template can produce.
+
+        Think of the outputs as numbered in the order that nested loops over the slot occurrences would produce
+        them, with the first occurrence in the outermost loop and each slot's values in their order in the
+        template definitions file. Output k is then found by writing k in a mixed-radix number system whose
+        digits are the slot occurrences, where the base of each digit is the number of values of that slot, and
+        filling each occurrence with the value whose index is its digit. That takes one division per occurrence,
+        no matter how large k is.
+
+        Args:
+            k:
+                An int, being an index between 0 and count() - 1 (or a negative index, counting back from the
+                end, as with a list).
+
+        Returns:
+            A string, being the k-th output.
+
+        Raises:
+            IndexError:
+                The index is out of range.
+        """
+        count = self.count()
+        if k < 0:
+            k += count
+        if not 0 <= k < count:
+            raise IndexError(f"Template '{self.name}' has {count} outputs, so there is no output at index {k}.")
+        return self._output_at(k)
+
+    def _output_at(self, k):
+        """Return the k-th output, like output_at(), but without checking the index."""
+        # Peel off the digits from the least significant (the last occurrence) to the most significant
+        fills = [None] * len(self.slot_indices)
+        for position in range(len(self.slot_indices) - 1, -1, -1):
+            values = self.slots[self.slot_indices[position]].values
+            k, digit = divmod(k, len(values))
+            fills[position] = values[digit]
+        parts = self._parts[:]
+        parts[1::2] = fills
+        return ''.join(parts)
+
+    def generate_unique(self, n, seed=None):
+        """Use this template to generate n distinct text outputs, in random order.
+
+        Rather than generating outputs at random and throwing away repeats (which gets slower and slower as the
+        outputs pile up, and needs a set holding every output so far), we number the template's outputs as in
+        output_at() and walk through a seeded pseudorandom permutation of those numbers (see IndexPermutation).
+        The outputs are distinct by construction, each costs the same however many have come before, and
+        nothing needs to be remembered between them. Distinct here means distinct fillings (see count()).
+
+        Args:
+            n:
+                An int, being the number of outputs to generate. It can't exceed count().
+            seed:
+                A value that will be used to seed the permutation. The same seed always gives the same outputs
+                in the same order, and the first n outputs for one n are the start of those for a larger n. If
+                None is passed, a seed is drawn from this template's own generator.
+
+        Returns:
+            A list of n distinct strings, each being a text output produced by filling the slots in this template.
+
+        Raises:
+            Exception:
+                There are fewer than n possible outputs.
+        """
+        count = self.count()
+        if n > count:
+            raise Exception(f"Template '{self.name}' can only produce {count} distinct outputs, not {n}.")
+        if seed is None:
+            seed = self.rng.getrandbits(64)
+        permutation = IndexPermutation(size=count, seed=derive_seed(seed, self.name, 'unique'))
+        return [self._output_at(permutation[position]) for position in range(n)]
+
+
+class TemplateReference:
+    """A reference, within one template, to another template (written like '<@ENDING>').
+
+    Attributes:
+        name:
+            A string, being the name of the referenced template.
+        filters:
+            A tuple of strings, being the filters applied to the referenced template's output, as in
+            '<@ENDING|upper>' (see Template.TEMPLATE_FILTERS).
+    """
+
+    def __init__(self, name, filters=()):
+        """Initialize a TemplateReference object.
+
+        Args:
+            name:
+                A string, being the name of the referenced template.
+            filters:
+                A tuple of strings, each being one of Template.TEMPLATE_FILTERS.
         """
-        output = ''
-        for element in self.template:
-            if isinstance(element, Slot):  # It's a slot, so append one of its values
-                # Here, we'll use the Slot method 'fill()', which returns a random value
-                output += element.fill()
-            else:  # It's a static element, so append it as is
-                output += element
+        self.name = name
+        self.filters = filters
 
-        return output
+
+class RhymeReference:
+    """A slot occurrence whose value must rhyme with an earlier occurrence's (written like '<PLACE|rhyme=NAME>').
+
+    The occurrence rhymes with the nearest occurrence of the target slot that comes before it in the template
+    (after any template references have been expanded). When the template is compiled, that earlier occurrence
+    is restricted to the values that something in this slot rhymes with (see Slot.constrained()), so a rhyme
+    can always be found, and this occurrence is filled from the slot's values that rhyme with whatever the
+    earlier occurrence was filled with (see Slot.rhyme_bucket()). Neither needs to retry.
+
+    Attributes:
+        slot:
+            A Slot object, being the slot to fill (with any filters and other constraints applied).
+        target:
+            A string, being the name of the slot to rhyme with.
+    """
+
+    def __init__(self, slot, target):
+        """Initialize a RhymeReference object.
+
+        Args:
+            slot:
+                A Slot object, being the slot to fill.
+            target:
+                A string, being the name of the slot to rhyme with.
+        """
+        self.slot = slot
+        self.target = target
+
+
+def _record_fill(fill, cell):
+    """Call the given fill function, and keep the value in the given one-item list as well as returning it. This
+    is how a slot occurrence that others rhyme with makes its value available to them."""
+    cell[0] = value = fill()
+    return value
+
+
+def _fill_rhyme(slot, rng, cell):
+    """Fill the given slot with a value that rhymes with the value in the given one-item list."""
+    return slot.rhyme_bucket(cell[0]).fill(rng)
+
+
+def _capitalize_first(value):
+    """Return the given string with its first non-whitespace character upper-cased and the rest lower-cased (the
+    'cap' filter). This is str.capitalize(), except that leading whitespace is skipped over."""
+    stripped = value.lstrip()
+    if not stripped:
+        return value
+    start = len(value) - len(stripped)
+    return value[:start] + stripped[0].upper() + stripped[1:].lower()
+
+
+# Beginnings of words that start with a vowel letter but a consonant sound ('a unicorn', 'a one-off'), and
+# beginnings of words that start with a consonant letter but a vowel sound ('an hour')
+CONSONANT_SOUND_PREFIXES = (
+    'eu', 'ewe', 'one', 'once', 'unic', 'unif', 'unio', 'uniq', 'unit', 'univ', 'use', 'usu', 'uten', 'uti', 'uto',
+    'ura', 'ure', 'uri', 'uro', 'ubiq', 'uku', 'ufo'
+)
+VOWEL_SOUND_PREFIXES = ('hour', 'honest', 'honor', 'honour', 'heir')
+
+# The letters whose names start with a vowel sound, for initialisms like 'an FBI agent'
+VOWEL_SOUND_LETTERS = frozenset('AEFHILMNORSX')
+
+
+def _prefix_indefinite_article(value):
+    """Return the given string preceded by the indefinite article that agrees with it (the 'a/an' filter).
+
+    Whether to use 'a' or 'an' depends on the sound that the value starts with, not the letter, so beyond
+    checking for a vowel letter we look out for the common exceptions (see CONSONANT_SOUND_PREFIXES and
+    VOWEL_SOUND_PREFIXES), and read words in capitals, like 'FBI', letter by letter.
+    """
+    word = value.lstrip().split(' ', 1)[0]
+    if len(word) > 1 and word.isupper():
+        vowel_sound = word[0] in VOWEL_SOUND_LETTERS
+    else:
+        word = word.lower()
+        if word.startswith(CONSONANT_SOUND_PREFIXES):
+            vowel_sound = False
+        elif word.startswith(VOWEL_SOUND_PREFIXES):
+            vowel_sound = True
+        else:
+            vowel_sound = word[:1] in ('a', 'e', 'i', 'o', 'u')
+    return f"{'an' if vowel_sound else 'a'} {value}"
+
+
+def _unescape(value):
+    """Return the given string with each '\\n' turned into a newline and each '\\t' into a tab (the 'unescape'
+    filter)."""
+    return value.replace('\\n', '\n').replace('\\t', '\t')
+
+
+# The letters that make vowel sounds, for the purposes of _rhyme_key() and _count_syllables()
+VOWEL_GROUP = re.compile('[aeiouy]+')
+WORD = re.compile("[a-z'-]+")
+
+# Unstressed word endings, which a word only rhymes on along with the syllable before them
+WEAK_ENDINGS = frozenset(('ed', 'el', 'en', 'er', 'est', 'ing', 'ish'))
+
+
+def _initial_letter(value):
+    """Return the first letter of the given string, lower-cased, or '' if it has no letters (the key for the
+    'initial' constraint)."""
+    for character in value:
+        if character.isalpha():
+            return character.lower()
+    return ''
+
+
+@lru_cache(maxsize=4096)
+def _rhyme_key(value):
+    """Return the ending that decides what the given string rhymes with (the key for the 'rhyme' constraint).
+
+    This goes by spelling, not sound: the ending of the last word, from its last group of vowels on, so that
+    'moon' and 'spoon' both give 'oon'. A plural or third-person 's' is dropped first ('berries' is read as
+    'berry'), and if the word ends with its vowels, as 'Harry' does, or with an unstressed ending like '-ing'
+    (see WEAK_ENDINGS), the ending reaches back to the vowels before them ('arry', 'alking'), since otherwise
+    every word ending in 'y' (or '-ing') would rhyme. It's cached, since the engine works out the key of the
+    value it rhymes with on every fill.
+    """
+    words = WORD.findall(value.lower())
+    word = words[-1].strip("'-") if words else ''
+    if word.endswith('ies') and len(word) > 4:
+        word = word[:-3] + 'y'
+    elif word.endswith('s') and not word.endswith('ss') and len(word) > 2:
+        word = word[:-1]
+    groups = [match.start() for match in VOWEL_GROUP.finditer(word)]
+    if not groups:
+        return word
+    start = groups[-1]
+    if len(groups) > 1 and (VOWEL_GROUP.match(word, start).end() == len(word) or word[start:] in WEAK_ENDINGS):
+        start = groups[-2]
+    return word[start:]
+
+
+def _count_syllables(value):
+    """Return roughly how many syllables the given string has (the key for the 'syllables' constraint).
+
+    Each group of vowels in a word counts as one syllable, except for a silent 'e' at the end of a word
+    ('time', but not 'purple'), the same 'e' before a plural or third-person 's' ('dives', but not 'places'
+    or 'bottles'), and the 'e' of a silent 'ed' ('tailored', but not 'painted'). Every word counts for at
+    least one. It's a rule of thumb, so it gets some words wrong ('salient' comes out at two).
+    """
+    syllables = 0
+    for word in WORD.findall(value.lower()):
+        count = len(VOWEL_GROUP.findall(word))
+        if word.endswith('es') and len(word) > 3 and word[-3] not in 'aeiouyscxzgh':
+            word = word[:-1]  # The 'e' is as silent here as it is at the end of the word without the 's'
+        if word.endswith('e') and not word.endswith('ee') and not (word.endswith('le') and word[-3:-2] not in 'aeiouy'):
+            count -= 1
+        elif word.endswith('ed') and len(word) > 3 and word[-3] not in 'aeiouytd':
+            count -= 1
+        syllables += max(count, 1)
+    return syllables
 
 
 class Slot:
@@ -402,74 +2851,1125 @@ class Slot:
         name:
             A string, being the slot name.
         values:
-            A list of strings, each being one way of filling the slot.
+            A list of strings, each being one way of filling the slot. Single-use values (those written with a
+            trailing '\\s' in the template definitions file) are stored without the marker; which values are
+            single-use is recorded separately. A slot whose values come from large corpora holds them in a
+            read-only sequence instead, such as a PackedValues object, which only decodes a value when it's read.
+        weights:
+            A list of floats, being the relative weight of each value, or None if the values are equally likely.
+        policy:
+            A string, being the policy that governs how values are used up (see SINGLE_USE_POLICIES).
     """
 
-    def __init__(self, name, values):
+    # The supported policies for using up slot values:
+    #   'refill':       A single-use value can't be drawn again until every single-use value has been drawn,
+    #                   at which point they're all put back.
+    #   'shuffle_bag':  Every value is treated as single-use, so each value is drawn exactly once per cycle.
+    #                   Weighted slots are the exception: they're drawn from by weight, as under 'refill'.
+    #   'exhaust':      Like 'refill', except that filling the slot once all of its single-use values have been
+    #                   drawn raises an Exception (call refill() to reset it).
+    SINGLE_USE_POLICIES = ('refill', 'shuffle_bag', 'exhaust')
+
+    # Slots don't get a __dict__, which saves memory and makes their attributes a little faster to look up.
+    # Besides the attributes documented above, 'refills' is the number of times refill() has been called on
+    # the slot, and '_loader' is only set while a deferred slot is waiting to be loaded (see deferred()).
+    __slots__ = (
+        'name', 'policy', 'values', 'weights', '_single_use', '_probabilities', '_aliases', '_order', '_live',
+        '_pool_left', '_pool_total', '_filtered', '_indexes', '_loader', 'refills', '__weakref__',
+    )
+
+    # The attributes that a deferred slot takes over from the slot that its loader returns (see load())
+    _LOADED_ATTRIBUTES = (
+        'values', 'weights', '_single_use', '_probabilities', '_aliases', '_order', '_live', '_pool_left',
+        '_pool_total',
+    )
+
+    # Loading a deferred slot can take a while (it may load a large corpus), and mustn't happen twice at once.
+    # It's reentrant because loading a slot can mean loading another first, as for a filtered slot.
+    _load_lock = threading.RLock()
+
+    # The filters that can be applied to a slot's values by writing them after its name in a slot reference,
+    # separated by bars, as in '<ADJ|cap>' or '<NAME|lower|cap>' (they're applied from left to right):
+    #   'upper':     Upper-case the whole value.
+    #   'lower':     Lower-case the whole value.
+    #   'cap':       Upper-case the first character that isn't whitespace, and lower-case the rest.
+    #   'title':     Upper-case the first letter of each word, and lower-case the rest (see str.title()).
+    #   'unescape':  Turn each '\n' written in the value into a newline, and each '\t' into a tab.
+    #   'a/an':      Put the indefinite article that agrees with the value ('a' or 'an') and a space before it.
+    #                This one is usually written as a prefix, '<a/an:ANIMAL>', which means '<ANIMAL|a/an>'.
+    # Since the filters are applied to each value when the slot is loaded, filling a filtered slot costs
+    # nothing extra. In particular, the article for each value is worked out once, not on every fill.
+    FILTERS = {
+        'upper': str.upper,
+        'lower': str.lower,
+        'cap': _capitalize_first,
+        'title': str.title,
+        'unescape': _unescape,
+        'a/an': _prefix_indefinite_article,
+    }
+
+    # The constraints that can be put on a slot's values by writing them among its filters, as a name and an
+    # argument joined by '=', as in '<NOUN|initial=d>' (see constrained()). Each has a function that gives a
+    # value's key; the constraint allows the values whose keys are among those its argument names:
+    #   'initial':    The first letter, or a range of them: 'initial=d', 'initial=a-c' or 'initial=a,e-g'.
+    #   'syllables':  The number of syllables, or a range: 'syllables=5' or 'syllables=1-2'.
+    #   'length':     The number of characters, or a range: 'length=4' or 'length=1-12'. The engine also uses this
+    #                 one to keep outputs within a length limit (see Template.generate_within()).
+    #   'rhyme':      The ending that decides what the value rhymes with. The argument is the name of another
+    #                 slot, and the value must rhyme with whatever filled that slot's nearest earlier occurrence
+    #                 in the template, as in '<NAME> works at the <PLACE|rhyme=NAME>' (see RhymeReference).
+    # Since a slot keeps an index of its values by each key (see key_index()), a constrained fill is a draw
+    # from a slot that holds just the matching values, which costs the same as any other fill.
+    CONSTRAINT_KEYS = {
+        'initial': _initial_letter,
+        'syllables': _count_syllables,
+        'length': len,
+        'rhyme': _rhyme_key,
+    }
+
+    def __init__(self, name, values, weights=None, policy='refill'):
         """Initialize a Slot object.
 
         Args:
             name:
                 A string representing the slot name.
             values:
-                A list of strings, each being one way of filling the slot.
+                A list of strings, each being one way of filling the slot. A value ending with '\\s' is single-use.
+            weights:
+                A list of floats, being the relative weight of each value, or None if the values are equally
+                likely. Weighted slots can't include single-use values, and under the 'shuffle_bag' policy
+                they're drawn from by weight, not from a bag.
+            policy:
+                A string, being one of SINGLE_USE_POLICIES.
+
+        Raises:
+            Exception:
+                The given policy is not supported, the weights are all zero, or the slot has weights and
+                single-use values at the same time.
         """
+        if policy not in self.SINGLE_USE_POLICIES:
+            raise Exception(f"Unknown single-use policy '{policy}'. Use one of: {', '.join(self.SINGLE_USE_POLICIES)}.")
         self.name = name
+        self.policy = policy
+        # Parse the single-use markers once, here, rather than rescanning the values on every fill. We end
+        # up with a flag per value (a bytearray, so one byte each) that says whether it's single-use.
+        single_use = None
+        if isinstance(values, list):
+            for index, value in enumerate(values):
+                if value.endswith('\\s'):
+                    if single_use is None:
+                        single_use = bytearray(len(values))
+                        values = list(values)  # Don't modify the caller's list
+                    single_use[index] = 1
+                    values[index] = value[:-2]
         self.values = values
-        self.collection = [] #I added a 'trash can' instance variable to the Slot class to facilitate the new functionality of single-use fill. 
+        self._single_use = single_use
+        self.weights = None
+        self._probabilities = None
+        self._aliases = None
+        # A bag of values drawn once per cycle would ignore their weights, so only unweighted slots get one
+        pooled = single_use is not None or (policy == 'shuffle_bag' and weights is None)
+        if weights is not None and pooled:
+            raise Exception(f"Slot '{name}' can't have weights and single-use values at the same time.")
+        # Old template definitions files express weights by repeating values (e.g., 'laziness,laziness,laundry'),
+        # so a slot with duplicate values is treated as a weighted slot with one entry per distinct value. That
+        # doesn't work for pooled slots, though, since each copy of a single-use value is used up separately.
+        if weights is None and not pooled and isinstance(values, list) and len(set(values)) < len(values):
+            weights = [1.0] * len(values)
+        if weights is not None:
+            self._set_weights(weights=weights)
+        self._setup_pool()
+        # The slots returned by filtered(), constrained() and rhyme_bucket(), keyed by their arguments
+        self._filtered = {}
+        self._indexes = {}  # The indexes built by key_index(), keyed by constraint name
+        self.refills = 0
+
+    def _set_weights(self, weights):
+        """Merge duplicate values, summing their weights, and build the alias table for weighted draws.
+
+        Weighted draws use Vose's alias method: the weights are scaled so that they average to one, and each
+        value gets a 'column' of height one that it fills up to its own scaled weight, with the rest of the
+        column given over to a single other value (its alias). Drawing then takes a uniformly random column and
+        a uniformly random height within it, which costs the same no matter how many values there are or how
+        lopsided their weights are, and the table needs only one probability and one alias per distinct value.
+        """
+        merged = {}
+        for value, weight in zip(self.values, weights):
+            merged[value] = merged.get(value, 0.0) + weight
+        total = sum(merged.values())
+        if not total > 0:
+            raise Exception(f"Slot '{self.name}' has no values with a positive weight.")
+        self.values = list(merged)
+        self.weights = list(merged.values())
+        count = len(self.values)
+        scaled = [weight * count / total for weight in self.weights]
+        probabilities = array('d', [1.0]) * count
+        aliases = array('I', range(count))
+        small = [index for index, weight in enumerate(scaled) if weight < 1.0]
+        large = [index for index, weight in enumerate(scaled) if weight >= 1.0]
+        while small and large:
+            small_index = small.pop()
+            large_index = large.pop()
+            probabilities[small_index] = scaled[small_index]
+            aliases[small_index] = large_index
+            scaled[large_index] += scaled[small_index] - 1.0
+            (small if scaled[large_index] < 1.0 else large).append(large_index)
+        # Anything left over is (up to floating-point error) a full column, which is already the default
+        self._probabilities = probabilities
+        self._aliases = aliases
+
+    def _setup_pool(self):
+        """Set up the pool from which this slot's values are drawn.
+
+        The pool is an array holding a permutation of the value indices, of which the first 'live' entries
+        are currently available. Drawing a pooled value swaps it to just past the end of the live region and
+        shrinks the region by one, which takes the value out of circulation in constant time without having to
+        search for it. Refilling the pool is then just a matter of resetting the size of the live region, since
+        every value index is still in the array somewhere. Slots that have no pooled values (the common case)
+        don't get a pool at all.
+        """
+        if self.policy == 'shuffle_bag' and self.weights is None:
+            self._single_use = None  # Every value is pooled, so there's no need for per-value flags
+            self._pool_total = len(self.values)
+        elif self._single_use is not None:
+            self._pool_total = self._single_use.count(1)
+        else:
+            self._pool_total = 0
+        self._order = array('I', range(len(self.values))) if self._pool_total else None
+        self._live = len(self.values)
+        self._pool_left = self._pool_total
+
+    @classmethod
+    def deferred(cls, name, policy, loader):
+        """Return a slot that isn't set up until it's first used.
+
+        A deferred slot is a DeferredSlot that starts out with just a name, a policy and a loader. The first time
+        anything else about it is needed (its values, say, or the state that fill() relies on), Python finds that
+        the attribute is missing and calls DeferredSlot.__getattr__(), which loads the slot (see load()). Loading
+        sets every attribute that was missing and turns the slot into a plain Slot, so from then on it costs
+        exactly as much to fill as one that was set up in the usual way. (Slot itself has no __getattr__(),
+        since merely defining one makes every attribute lookup on every slot slower.) The engine uses this to
+        defer loading corpora until a slot that needs them is filled (see TemplateEngine's 'lazy_corpora').
+
+        Args:
+            name:
+                A string representing the slot name.
+            policy:
+                A string, being the slot's policy for single-use values.
+            loader:
+                A callable that takes no arguments and returns a (loaded) Slot object with the same name, whose
+                state this slot takes over.
+
+        Returns:
+            A Slot object.
+        """
+        slot = DeferredSlot.__new__(DeferredSlot)
+        slot.name = name
+        slot.policy = policy
+        slot._filtered = {}
+        slot._indexes = {}
+        slot._loader = loader
+        slot.refills = 0
+        return slot
+
+    def is_loaded(self):
+        """Return whether this slot has been set up, i.e., whether it wasn't deferred or has since been loaded."""
+        return self.__class__ is not DeferredSlot
+
+    def load(self):
+        """Set up this slot, if it was deferred and hasn't been loaded yet (see deferred())."""
+        if self.__class__ is not DeferredSlot:
+            return
+        with Slot._load_lock:
+            if self.__class__ is not DeferredSlot:  # Another thread loaded it while we were waiting for the lock
+                return
+            loaded_slot = self._loader()
+            # The name, policy and filtered versions (which may already have been handed out) stay as they are
+            for attribute in self._LOADED_ATTRIBUTES:
+                setattr(self, attribute, getattr(loaded_slot, attribute))
+            del self._loader
+            # This has to come last, since other threads take the slot to be loaded as soon as its class changes
+            self.__class__ = Slot
+
+    def _loaded_copy(self):
+        """Load this slot if need be, and return a copy of it (see copy())."""
+        self.load()
+        return self.copy()
+
+    def copy(self):
+        """Return a copy of this slot that shares its values but has a fresh pool.
+
+        The copy of a deferred slot is deferred too. Loading it loads this slot (unless it already has been),
+        so the values are still only loaded once, however many copies are made.
+        """
+        if not self.is_loaded():
+            return Slot.deferred(name=self.name, policy=self.policy, loader=self._loaded_copy)
+        slot_copy = Slot.__new__(Slot)
+        slot_copy.name = self.name
+        slot_copy.policy = self.policy
+        slot_copy.values = self.values
+        slot_copy.weights = self.weights
+        slot_copy._single_use = self._single_use
+        slot_copy._probabilities = self._probabilities
+        slot_copy._aliases = self._aliases
+        slot_copy._setup_pool()
+        slot_copy._filtered = {}
+        slot_copy._indexes = {}
+        slot_copy.refills = 0
+        return slot_copy
+
+    def filtered(self, filters):
+        """Return a slot whose values are this slot's values passed through the given filters.
+
+        The filters are applied to every value once, here, so that filling the filtered slot costs no more than
+        filling this one. (Memory-mapped values are the exception: they're filtered one at a time as they're
+        drawn, so as not to decode the whole corpus.) The filtered slot has the same weights as this one, and
+        its name is this slot's name followed by the filters, as in 'ADJ|cap'. Asking for the same filters twice
+        returns the same slot. A filtered slot with single-use values has a pool of its own, separate from this
+        slot's.
+
+        Args:
+            filters:
+                A sequence of strings, each being a key of FILTERS.
+
+        Returns:
+            A Slot object.
+        """
+        filters = tuple(filters)
+        filtered_slot = self._filtered.get(filters)
+        if filtered_slot is None:
+            if self.is_loaded():
+                filtered_slot = self._filter(filters=filters)
+            else:
+                # Filtering means going through every value, so for a deferred slot, that waits until it's loaded
+                filtered_slot = Slot.deferred(
+                    name='|'.join((self.name,) + filters),
+                    policy=self.policy,
+                    loader=partial(self._filter, filters=filters)
+                )
+            self._filtered[filters] = filtered_slot
+        return filtered_slot
+
+    def _filter(self, filters):
+        """Load this slot if need be, and return a new slot whose values are this slot's values passed through the
+        given filters (see filtered())."""
+        self.load()
+        filtered_slot = self.copy()
+        filtered_slot.name = '|'.join((self.name,) + filters)
+        if isinstance(self.values, list) or type(self.values) is PackedValues:
+            values = self.values
+            for filter_name in filters:
+                values = list(map(self.FILTERS[filter_name], values))
+            # Packed values stay packed, so that filtering doesn't undo the memory savings
+            filtered_slot.values = values if isinstance(self.values, list) else PackedValues.from_strings(values)
+        else:
+            filtered_slot.values = FilteredValues(values=self.values, filters=filters)
+        return filtered_slot
+
+    def key_index(self, key_name):
+        """Return an index of this slot's values by the key of one of the constraints (see CONSTRAINT_KEYS).
+
+        The index is built the first time it's asked for, which loads the slot if it was deferred.
+
+        Args:
+            key_name:
+                A string, being a key of CONSTRAINT_KEYS.
+
+        Returns:
+            A dictionary mapping each key to a list of the indices of the values that have it, in order.
+        """
+        index = self._indexes.get(key_name)
+        if index is None:
+            self.load()
+            index = {}
+            for value_index, key in enumerate(map(self.CONSTRAINT_KEYS[key_name], self.values)):
+                index.setdefault(key, []).append(value_index)
+            self._indexes[key_name] = index
+        return index
+
+    def constrained(self, key_name, keys):
+        """Return a slot that holds just those of this slot's values that satisfy a constraint.
+
+        Like a filtered slot (see filtered()), the constrained slot is worked out once, so filling it costs no more
+        than filling this one, and asking for the same constraint twice returns the same slot. It keeps the weights
+        of the values it holds, and its name is this slot's name followed by the constraint, as in
+        'NOUN|initial=d'. A constrained slot with single-use values has a pool of its own.
+
+        Args:
+            key_name:
+                A string, being a key of CONSTRAINT_KEYS.
+            keys:
+                A frozenset of the keys to allow, or a Slot object, which stands for the keys of all its values.
+
+        Returns:
+            A Slot object.
 
-    def fill(self):
+        Raises:
+            Exception:
+                None of the values satisfy the constraint. (For a deferred slot, this is raised when it's loaded.)
+        """
+        constrained_slot = self._filtered.get((key_name, keys))
+        if constrained_slot is None:
+            if self.is_loaded() and (not isinstance(keys, Slot) or keys.is_loaded()):
+                constrained_slot = self._constrain(key_name=key_name, keys=keys)
+            else:
+                constrained_slot = Slot.deferred(
+                    name=self._constrained_name(key_name=key_name, keys=keys),
+                    policy=self.policy,
+                    loader=partial(self._constrain, key_name=key_name, keys=keys)
+                )
+            self._filtered[(key_name, keys)] = constrained_slot
+        return constrained_slot
+
+    def _constrained_name(self, key_name, keys):
+        """Return the name of the slot returned by constrained()."""
+        if isinstance(keys, Slot):
+            argument = keys.name
+        else:
+            argument = ','.join(sorted(map(str, keys)))
+        return f"{self.name}|{key_name}={argument}"
+
+    def _constrain(self, key_name, keys):
+        """Load this slot if need be, and return a new slot with just the values that satisfy the given constraint
+        (see constrained())."""
+        name = self._constrained_name(key_name=key_name, keys=keys)
+        index = self.key_index(key_name=key_name)
+        if isinstance(keys, Slot):
+            keys = keys.key_index(key_name=key_name).keys()
+        value_indices = sorted(value_index for key in keys & index.keys() for value_index in index[key])
+        if not value_indices:
+            raise Exception(f"Slot '{self.name}' has no values that satisfy the constraint in '{name}'.")
+        return self._subset(name=name, value_indices=value_indices)
+
+    def _subset(self, name, value_indices):
+        """Return a new slot with the given name, holding the values at the given indices, with their weights and
+        single-use markers."""
+        values = [self.values[value_index] for value_index in value_indices]
+        if self._single_use is not None:
+            # Put the single-use markers back, for the new slot to parse
+            values = [
+                f"{value}\\s" if self._single_use[value_index] else value
+                for value, value_index in zip(values, value_indices)
+            ]
+        weights = None if self.weights is None else [self.weights[value_index] for value_index in value_indices]
+        return Slot(name=name, values=values, weights=weights, policy=self.policy)
+
+    def rhyme_bucket(self, value):
+        """Return the slot that holds just those of this slot's values that rhyme with the given value.
+
+        This is how an occurrence that has to rhyme with an earlier one is filled (see RhymeReference). A word
+        rhymes with itself, but repeating it doesn't make for much of a rhyme, so the given value (ignoring case)
+        is left out of the slot, unless nothing else that rhymes with it can be drawn. The slot for each value is
+        made the first time it's needed, and found with a dictionary lookup after that.
+
+        Raises:
+            Exception:
+                None of the values rhyme with the given value.
+        """
+        # Keyed by the value itself, which (being a string) can't clash with the keys used by constrained()
+        bucket = self._filtered.get(('rhyme', value))
+        if bucket is None:
+            bucket = self.constrained(key_name='rhyme', keys=frozenset((_rhyme_key(value),)))
+            bucket.load()
+            word = value.lower()
+            value_indices = [
+                value_index for value_index, other in enumerate(bucket.values) if other.lower() != word
+            ]
+            weights = bucket.weights
+            if len(value_indices) < len(bucket.values) and any(
+                weights is None or weights[value_index] > 0 for value_index in value_indices
+            ):
+                bucket = bucket._subset(name=f"{bucket.name}|except={value}", value_indices=value_indices)
+            self._filtered[('rhyme', value)] = bucket
+        return bucket
+
+    def has_single_use_values(self):
+        """Return whether this slot draws from a pool, i.e., whether any of its values are ever used up."""
+        return self._order is not None
+
+    def draw(self, rng=random):
+        """Draw the index of one of this slot's values, according to the slot's policy.
+
+        Args:
+            rng:
+                The source of randomness to draw from, either the random module itself (the default) or
+                a random.Random instance.
+
+        Returns:
+            An int, being an index into this slot's values.
+
+        Raises:
+            Exception:
+                The slot's policy is 'exhaust' and all of its single-use values have been used.
+        """
+        order = self._order
+        if order is None:
+            if self._aliases is None:
+                return rng.randrange(len(self.values))
+            # A weighted draw, via the alias table (see _set_weights()). We use the integer part of a single
+            # uniform draw to pick a column and the fractional part to pick a height within it.
+            column_and_height = rng.random() * len(self.values)
+            column = int(column_and_height)
+            if column_and_height - column < self._probabilities[column]:
+                return column
+            return self._aliases[column]
+        if not self._pool_left:
+            raise Exception(f"Slot '{self.name}' has used up all of its single-use values.")
+        position = rng.randrange(self._live)
+        index = order[position]
+        if self._single_use is None or self._single_use[index]:
+            # Take this value out of circulation by swapping it to the end of the live region
+            live = self._live - 1
+            order[position] = order[live]
+            order[live] = index
+            self._live = live
+            self._pool_left -= 1
+            if not self._pool_left and self.policy != 'exhaust':
+                self.refill()
+        return index
+
+    def fill(self, rng=random):
         """Fill this slot.
 
-        This method fills the slot by randomly selecting from the list of slot values. Of course, we could
-        modify this method to implement a different policy, such as using each slot value one at a time, with
-        no repeating until every value has been used once.
+        This method fills the slot by randomly selecting from the list of slot values, according to their
+        weights (if any) and subject to the slot's policy for single-use values (see SINGLE_USE_POLICIES).
+        Every fill takes constant time, regardless of the number of values.
+
+        Args:
+            rng:
+                The source of randomness to draw from, either the random module itself (the default) or
+                a random.Random instance.
 
         Returns:
             A string representing one way to fill the slot.
         """
+        if self._order is None and self._aliases is None:
+            return rng.choice(self.values)
+        return self.values[self.draw(rng)]
 
-        #Basic structure is: While self.values has items in it, make a random choice. If the choice happens to be a single-use one (denoted by "\s"), then remove the choice from self.values, collect the choice in self.collection (which is just a 'trash can' of used slot values). Then you return the choice. If the choice is not a single-use one, just return the choice. The self.refill() step is basically, once you run out of slot values in self.values due to the removal of single-use ones, you 'refill' self.values with the original list of slot values. The mechanism of this 'refill' function is detailed below.  
-        
-        #Creating a list of single-use slot values
-        single_use_slot_values = []
-        for i in range(len(self.values)):
-          if self.values[i].endswith('\s'):
-            single_use_slot_values.append(self.values[i])
-
-        #This counter is essentially keeping track of how many single-use slot values are currently left. Every time a single-use slot value is selected, the counter is decremented. When this counter becomes 0, meaning there are no more single-use slot values left, then you refill self.value. 
-        
-        counter = len(single_use_slot_values) -1
-        choice = random.choice(self.values)
-        
-        while counter > 0:
-          if choice.endswith('\s'):
-            counter = counter -1
-            self.values.remove(choice)
-            self._collect(choice)
-            #print(self.values)
-            #print(self.collection)
-            return choice[:len(choice)-2]
-          return choice
-        
-        self.refill()
-        #print(f"refilled self.values -> {self.values}")
-        #print(f"emptied self.collection -> {self.collection}")
-
-        return choice
-    
-    #This private method "collects" the used single-use slot values so they are not completely removed from the Slot object. 
-    def _collect (self,item):
-      self.collection.append(item)
-    
-    #This method "refills" the original self.values list by populating it with what was collected in self.collection. And it empties out self.collection for future use. 
     def refill(self):
-      self.values.extend(self.collection)
-      self.collection = []
-    
-    
+        """Put every used-up value back into this slot's pool."""
+        # Refills happen at most once per cycle through the pool, so counting them is free for all practical
+        # purposes. The count is reported by TemplateEngine.stats().
+        self.refills += 1
+        self._live = len(self.values)
+        self._pool_left = self._pool_total
+
+
+class DeferredSlot(Slot):
+    """A slot that hasn't been loaded yet. See Slot.deferred(); once loaded, it turns into a plain Slot."""
 
+    # No attributes of its own, so that it has exactly the same layout as a Slot and can turn into one
+    __slots__ = ()
 
+    def __getattr__(self, name):
+        # Python only calls this for attributes that aren't set, which (other than for a typo) means that the
+        # slot hasn't been loaded yet
+        self.load()
+        if self.__class__ is DeferredSlot:
+            raise AttributeError(f"'Slot' object has no attribute '{name}'")
+        return getattr(self, name)
 
+    def __reduce_ex__(self, protocol):
+        # Load the slot before it's pickled, so that what gets pickled (say, into a template pack) is a complete,
+        # plain Slot that doesn't depend on the engine that deferred it
+        self.load()
+        return Slot.__reduce_ex__(self, protocol)
+
+
+class CorpusCache:
+    """A process-wide, least-recently-used cache of loaded corpora.
+
+    Every TemplateEngine in the process loads its corpora through the single instance of this class that
+    lives in the module variable 'corpus_cache', so constructing an engine whose corpora have already been
+    loaded (by it or by any other engine) doesn't read any corpus files. Each cached corpus is keyed by its
+    path and remembers the modification time and size of its file; if either has changed the next time the
+    corpus is requested, the cached copy is discarded and the file is read again. The cache is bounded by
+    the total size, in bytes, of the corpus files it holds: once that is exceeded, the least recently used
+    corpora are evicted.
+
+    Large corpora are kept as PackedValues rather than as tuples of strings, which takes a fraction of the
+    memory. They're also interned by their contents: two corpus files with the same contents (or the same file,
+    loaded again after an edit that was later undone) share a single PackedValues object for as long as
+    anything holds on to it, even if the cache itself has let go of it.
+
+    Attributes:
+        max_bytes:
+            An int, being the maximum total size in bytes of the corpora held in the cache.
+    """
+
+    # Corpora with at least this many lines are packed (see PackedValues). Smaller ones are kept as tuples of
+    # strings, since they take little memory either way, and a value from a tuple doesn't need decoding.
+    PACK_THRESHOLD = 4096
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """Initialize a CorpusCache object.
+
+        Args:
+            max_bytes:
+                An int, being the maximum total size in bytes of the corpora held in the cache.
+        """
+        self.max_bytes = max_bytes
+        # Maps a (path, mapped) key to a (mtime_ns, size, values, cost) tuple, least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._evictions = 0
+        # Maps a path to a [loads, seconds, bytes] list, covering every time the file was actually read
+        self._loads = {}
+        # Maps a (length, CRC-32) key for a packed corpus's contents to its PackedValues object
+        self._interned = weakref.WeakValueDictionary()
+
+    def load(self, path, mapped=False):
+        """Return the contents of the corpus file at the given path, loading it only if necessary.
+
+        Args:
+            path:
+                A string containing the path to a corpus file.
+            mapped:
+                If True, return a memory-mapped MappedCorpus for the file instead of a tuple of strings. A
+                mapped corpus only counts the size of its line-offset index against the cache's budget, since
+                the file contents themselves live in the operating system's page cache.
+
+        Returns:
+            A tuple of strings, one per line of the corpus file, or a PackedValues object holding the same
+            strings if there are at least PACK_THRESHOLD of them, or a MappedCorpus if 'mapped' is True. (A
+            tuple, rather than a list, because the same object is handed to every caller, so it mustn't be
+            modifiable.)
+
+        Raises:
+            IOError:
+                There is no corpus file at the given path.
+        """
+        key = (path, mapped)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                mtime_ns, size, values, _ = entry
+                if mtime_ns == stat.st_mtime_ns and size == stat.st_size:
+                    self._hits += 1
+                    self._entries.move_to_end(key)
+                    return values
+                # The file has changed since we cached it, so drop the stale copy
+                self._invalidations += 1
+                self._discard(key)
+            self._misses += 1
+        start = time.perf_counter()
+        if mapped:
+            values = MappedCorpus(path=path)
+            cost = values.index_nbytes()
+        else:
+            with open(path, 'rb') as corpus_file:
+                data = corpus_file.read()
+            if b'\r' in data:  # Translate line endings, just as reading the file as text would
+                data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+            if data.count(b'\n') + 1 >= self.PACK_THRESHOLD:
+                # A CRC is several times quicker to compute than a cryptographic hash, and comparing the bytes
+                # themselves (which takes next to no time) rules out the odd collision
+                content_key = (len(data), zlib.crc32(data))
+                with self._lock:
+                    values = self._interned.get(content_key)
+                if values is None or values._buffer != data:
+                    packed = PackedValues.from_bytes(data)
+                    with self._lock:
+                        # Another thread may have interned the same contents in the meantime
+                        values = self._interned.setdefault(content_key, packed)
+                    if values._buffer != data:
+                        values = packed
+                cost = values.nbytes()
+            else:
+                values = tuple(data.decode('utf-8').split('\n'))
+                cost = stat.st_size
+        seconds = time.perf_counter() - start
+        with self._lock:
+            loads = self._loads.setdefault(path, [0, 0.0, 0])
+            loads[0] += 1
+            loads[1] += seconds
+            loads[2] += stat.st_size
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = (stat.st_mtime_ns, stat.st_size, values, cost)
+            self._bytes += cost
+            # Evict the least recently used corpora until we're back within budget, though we always keep
+            # the corpus we just loaded, even if it alone exceeds the budget
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                oldest_key = next(iter(self._entries))
+                self._discard(oldest_key)
+                self._evictions += 1
+        return values
+
+    def _discard(self, key):
+        """Remove the corpus with the given key from the cache. The caller must hold the lock."""
+        _, _, _, cost = self._entries.pop(key)
+        self._bytes -= cost
+
+    def clear(self):
+        """Remove every corpus from the cache and reset its statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._hits = self._misses = self._invalidations = self._evictions = 0
+            self._loads.clear()
+
+    def stats(self):
+        """Return a dictionary of statistics about the cache.
+
+        Returns:
+            A dictionary with these keys: 'entries' (the number of cached corpora), 'bytes' (the total size
+            they count against the budget), 'max_bytes', 'hits', 'misses', 'invalidations' (corpora reloaded because their file
+            changed) and 'evictions' (corpora dropped to stay within the size budget).
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'invalidations': self._invalidations,
+                'evictions': self._evictions,
+            }
+
+    def load_stats(self, paths=None):
+        """Return how often, and at what cost, corpus files have been read by this cache.
+
+        Only actual reads count: a load that the cache served from memory costs nothing, so it isn't recorded.
+
+        Args:
+            paths:
+                An iterable of strings containing the paths of the corpora to report on, or None to report on
+                every corpus that has been read.
+
+        Returns:
+            A dictionary mapping each path to a dictionary with these keys: 'loads' (the number of times the
+            file was read), 'seconds' (the total time spent reading and splitting or indexing it) and 'bytes' (the
+            total size of the file across those reads). Paths that have never been read are left out.
+        """
+        with self._lock:
+            if paths is None:
+                paths = list(self._loads)
+            report = {}
+            for path in paths:
+                if path in self._loads:
+                    loads, seconds, size = self._loads[path]
+                    report[path] = {'loads': loads, 'seconds': seconds, 'bytes': size}
+            return report
+
+
+class PackedValues:
+    """A read-only sequence of strings, stored as UTF-8 text in one contiguous buffer along with an offset array.
+
+    A tuple of 100,000 short strings takes up far more memory than the text itself: every str object carries
+    around 50 bytes of overhead, and the tuple adds 8 bytes for its pointer to each one. Packed values keep the
+    text encoded in a single bytes object instead, with a newline after each value, and an array that gives
+    the offset at which each value starts (4 bytes each). So a value costs 4 bytes on top of its text, and is
+    decoded only when it's read, which adds a fraction of a microsecond to each fill. The corpus cache packs
+    large corpora this way (see CorpusCache.PACK_THRESHOLD). A MappedCorpus is the same thing, with a
+    memory-mapped file as its buffer.
+    """
+
+    __slots__ = ('_buffer', '_offsets', '_size', '__weakref__')
+
+    def __init__(self, buffer, offsets):
+        """Initialize a PackedValues object.
+
+        Args:
+            buffer:
+                A bytes-like object holding the values, encoded as UTF-8, each followed by a newline (except
+                perhaps the last).
+            offsets:
+                An array of ints, being the offset in the buffer at which each value starts.
+        """
+        self._buffer = buffer
+        self._offsets = offsets
+        self._size = len(buffer)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Return the lines of the given UTF-8 text as packed values, with the text itself as the buffer. The lines
+        are exactly those that splitting the decoded text on '\\n' would produce."""
+        return cls(buffer=data, offsets=cls._line_offsets(data))
+
+    @classmethod
+    def from_strings(cls, values):
+        """Return the given strings as packed values. The strings may themselves include newlines."""
+        encoded = [value.encode('utf-8') for value in values]
+        buffer = b'\n'.join(encoded)
+        return cls(buffer=buffer, offsets=cls._piece_offsets(buffer=buffer, pieces=encoded))
+
+    @staticmethod
+    def _line_offsets(buffer):
+        """Return an array of the offsets at which the lines of the given bytes-like object start."""
+        typecode = 'I' if len(buffer) < 2 ** 32 else 'Q'  # Four-byte offsets are plenty for anything under 4 GiB
+        offsets = array(typecode, [0])
+        if numpy is not None and len(buffer):
+            # With NumPy, finding every newline is a single vectorized comparison, which is several times faster
+            # than either of the alternatives below
+            starts = numpy.flatnonzero(numpy.frombuffer(buffer, dtype=numpy.uint8) == ord('\n')) + 1
+            offsets.frombytes(starts.astype(numpy.uint32 if typecode == 'I' else numpy.uint64).tobytes())
+        elif isinstance(buffer, bytes):
+            return PackedValues._piece_offsets(buffer=buffer, pieces=buffer.split(b'\n'))
+        else:
+            # Splitting a memory-mapped file would copy all of it into memory, so search it for newlines instead
+            find = buffer.find
+            position = find(b'\n')
+            while position != -1:
+                offsets.append(position + 1)
+                position = find(b'\n', position + 1)
+        return offsets
+
+    @staticmethod
+    def _piece_offsets(buffer, pieces):
+        """Return an array of the offsets at which the given pieces of encoded text start, when the buffer is the
+        pieces joined by newlines."""
+        # Each piece starts one past the end of the one before it, so the offsets are the running total of the
+        # lengths of the pieces (plus one for each newline). Working this out with map() and accumulate() keeps
+        # the loop over the pieces in C.
+        typecode = 'I' if len(buffer) < 2 ** 32 else 'Q'
+        offsets = array(typecode, accumulate(map((1).__add__, map(len, pieces)), initial=0))
+        offsets.pop()  # That's where a piece after the last one would start
+        return offsets
+
+    def index_nbytes(self):
+        """Return the number of bytes occupied by the offset array."""
+        return len(self._offsets) * self._offsets.itemsize
+
+    def nbytes(self):
+        """Return the number of bytes occupied by the buffer and the offset array together."""
+        return self._size + self.index_nbytes()
+
+    def contains(self, text):
+        """Return whether the given text (which mustn't include a newline) appears in any of the values."""
+        return text.encode('utf-8') in self._buffer
+
+    def has_single_use_values(self):
+        """Return whether any of the values is a single-use value (i.e., ends with '\\s')."""
+        if self._buffer[-2:] == b'\\s':  # The last value
+            return True
+        # Any other single-use value is followed by the newline that ends it, but a value may also include a
+        # newline of its own, so make sure that the next value actually starts right after the newline
+        offsets = self._offsets
+        position = self._buffer.find(b'\\s\n')
+        while position != -1:
+            index = bisect_left(offsets, position + 3)
+            if index < len(offsets) and offsets[index] == position + 3:
+                return True
+            position = self._buffer.find(b'\\s\n', position + 1)
+        return False
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._offsets)
+        start = self._offsets[index]  # Raises the IndexError that sequence protocols expect
+        end = self._offsets[index + 1] - 1 if index + 1 < len(self._offsets) else self._size
+        return self._buffer[start:end].decode('utf-8')
+
+    def __iter__(self):
+        for index in range(len(self._offsets)):
+            yield self[index]
+
+
+class MappedCorpus(PackedValues):
+    """A corpus that is memory-mapped rather than loaded into a list of strings.
+
+    Instead of decoding every line of the corpus file up front, a mapped corpus keeps the file mapped into
+    memory along with a compact array holding the byte offset at which each line starts. Indexing into the
+    corpus decodes just the requested line, so a fill costs the same whether the corpus has ten lines or
+    ten million, and the memory the corpus occupies is essentially just its offset index (the operating
+    system pages the file in and out as needed). A mapped corpus behaves like a read-only sequence of
+    strings, with exactly the same lines as reading the file and splitting it on '\\n' would produce.
+
+    Since building the offset index means scanning the whole file, the index is persisted in a sidecar file
+    next to the corpus (e.g., 'corpora/surnames.txt.idx'), along with the size and modification time of the
+    corpus file at the time it was built. The sidecar is reused as long as those still match, and rebuilt
+    otherwise.
+
+    Attributes:
+        path:
+            A string containing the path to the corpus file.
+    """
+
+    __slots__ = ('path',)
+
+    # The sidecar begins with this marker, then the corpus file's mtime (ns) and size, then the typecode and
+    # item count of the offset array, and finally the raw offsets themselves
+    SIDECAR_MAGIC = b'TPLIDX01'
+    SIDECAR_HEADER = struct.Struct('<8sqq1sxxxxxxxq')
+
+    def __init__(self, path):
+        """Initialize a MappedCorpus object.
+
+        Args:
+            path:
+                A string containing the path to a corpus file.
+
+        Raises:
+            IOError:
+                There is no corpus file at the given path.
+        """
+        self.path = path
+        with open(path, 'rb') as corpus_file:
+            stat = os.fstat(corpus_file.fileno())
+            # An empty file can't be mapped, but an empty bytes object supports everything we need
+            self._buffer = mmap.mmap(corpus_file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b''
+        self._size = stat.st_size
+        self._offsets = self._load_sidecar(stat) or self._build_index(stat)
+
+    def _load_sidecar(self, stat):
+        """Return the offset index stored in this corpus's sidecar file, or None if it's missing or stale."""
+        try:
+            with open(f"{self.path}.idx", 'rb') as sidecar_file:
+                header = sidecar_file.read(self.SIDECAR_HEADER.size)
+                magic, mtime_ns, size, typecode, count = self.SIDECAR_HEADER.unpack(header)
+                if magic != self.SIDECAR_MAGIC or mtime_ns != stat.st_mtime_ns or size != stat.st_size:
+                    return None
+                offsets = array(typecode.decode('ascii'))
+                offsets.frombytes(sidecar_file.read())
+        except (OSError, struct.error, ValueError):
+            return None
+        return offsets if len(offsets) == count else None
+
+    def _build_index(self, stat):
+        """Scan the corpus file to build its offset index, and try to persist it as a sidecar file."""
+        offsets = self._line_offsets(self._buffer)
+        # Persisting the index is only an optimization, so if we can't write the sidecar (say, because the
+        # 'corpora' folder is read-only), we'll just carry on with the in-memory index. We write to a temporary
+        # file first so that another process never reads a half-written sidecar.
+        sidecar_path = f"{self.path}.idx"
+        temporary_path = f"{sidecar_path}.{os.getpid()}.tmp"
+        header = self.SIDECAR_HEADER.pack(
+            self.SIDECAR_MAGIC, stat.st_mtime_ns, stat.st_size, offsets.typecode.encode('ascii'), len(offsets)
+        )
+        try:
+            with open(temporary_path, 'wb') as sidecar_file:
+                sidecar_file.write(header)
+                offsets.tofile(sidecar_file)
+            os.replace(temporary_path, sidecar_path)
+        except OSError:
+            pass
+        return offsets
+
+    def __reduce__(self):
+        # A memory map can't be pickled, so a pickled MappedCorpus just remembers its path and is mapped afresh
+        # (reusing the sidecar index) when it's unpickled
+        return MappedCorpus, (self.path,)
+
+    def has_single_use_values(self):
+        """Return whether any line of this corpus is a single-use value (i.e., ends with '\\s')."""
+        # A line of a corpus can't include a newline, so there's no need to check where each match falls
+        return self._buffer.find(b'\\s\n') != -1 or self._buffer[-2:] == b'\\s'
+
+
+class ChainedValues:
+    """A read-only sequence of slot values formed by chaining together several other sequences.
+
+    This is how a slot's values are represented when some of them come from a packed or memory-mapped corpus:
+    the regular values and the corpora are kept as separate parts, and indexing into the chain finds the
+    right part with a binary search over the parts' starting positions.
+    """
+
+    def __init__(self, parts):
+        """Initialize a ChainedValues object.
+
+        Args:
+            parts:
+                A list of sequences of strings (lists, tuples, PackedValues or MappedCorpus objects). Empty
+                ones are dropped.
+        """
+        self.parts = [part for part in parts if len(part)]
+        self._starts = []
+        length = 0
+        for part in self.parts:
+            self._starts.append(length)
+            length += len(part)
+        self._length = length
+
+    def has_single_use_values(self):
+        """Return whether any of the chained values is a single-use value (i.e., ends with '\\s')."""
+        for part in self.parts:
+            if isinstance(part, PackedValues):
+                if part.has_single_use_values():
+                    return True
+            elif any(value.endswith('\\s') for value in part):
+                return True
+        return False
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("slot value index out of range")
+        part_number = bisect_right(self._starts, index) - 1
+        return self.parts[part_number][index - self._starts[part_number]]
+
+    def __iter__(self):
+        for part in self.parts:
+            yield from part
+
+
+class FilteredValues:
+    """A read-only sequence of slot values that applies filters (see Slot.FILTERS) to each value as it's read.
+
+    This is how a filtered slot (see Slot.filtered()) holds memory-mapped values, which are too many to filter
+    all at once, and values chained together from several corpora. (The values of a single packed corpus are
+    simply filtered and packed again.)
+    """
+
+    def __init__(self, values, filters):
+        """Initialize a FilteredValues object.
+
+        Args:
+            values:
+                A sequence of strings (a MappedCorpus or ChainedValues object).
+            filters:
+                A tuple of strings, each being a key of Slot.FILTERS.
+        """
+        self.values = values
+        self.filters = filters
+
+    def has_single_use_values(self):
+        """Return whether any of the underlying values is a single-use value (i.e., ends with '\\s')."""
+        return self.values.has_single_use_values()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        value = self.values[index]
+        for filter_name in self.filters:
+            value = Slot.FILTERS[filter_name](value)
+        return value
+
+    def __iter__(self):
+        for index in range(len(self.values)):
+            yield self[index]
+
+
+class EngineCache:
+    """A process-wide cache of parsed template definitions files, from which engines can be forked.
+
+    The cache holds one parsed engine for each template definitions file (and set of parsing options), and
+    hands out forks of it (see TemplateEngine.fork()), so code that constructs an engine for the same file
+    over and over, as our component functions do, parses it only once. The seed doesn't matter to parsing,
+    so engines with different seeds share the same parsed definitions too. Before each fork, the parsed engine
+    is brought up to date with any edits to its files (see TemplateEngine.reload()), which costs a few calls to
+    os.stat() when nothing has changed.
+
+    The single instance of this class lives in the module variable 'engine_cache'; use it through
+    TemplateEngine.cached().
+    """
+
+    def __init__(self):
+        """Initialize an EngineCache object."""
+        # Maps a (file path, and the other arguments of TemplateEngine.__init__() but the seed) key to a parsed
+        # TemplateEngine
+        self._engines = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, file_path, random_seed=None, mmap_corpora=False, single_use_policy='refill', max_template_depth=32,
+            lazy_corpora=True):
+        """Return a fork of the cached engine for the given file and options, parsing the file if need be.
+
+        This takes the same arguments as TemplateEngine.__init__().
+
+        Returns:
+            A TemplateEngine object.
+        """
+        key = (file_path, mmap_corpora, single_use_policy, max_template_depth, lazy_corpora)
+        # Forking reads the parsed engine's state, so it mustn't overlap with a reload of that engine
+        with self._lock:
+            engine = self._engines.get(key)
+            if engine is None:
+                self._misses += 1
+                engine = TemplateEngine(
+                    file_path=file_path,
+                    random_seed=0,
+                    mmap_corpora=mmap_corpora,
+                    single_use_policy=single_use_policy,
+                    max_template_depth=max_template_depth,
+                    lazy_corpora=lazy_corpora
+                )
+                self._engines[key] = engine
+            else:
+                self._hits += 1
+                engine.reload()
+            return engine.fork(random_seed=random_seed)
+
+    def clear(self):
+        """Remove every engine from the cache and reset its statistics."""
+        with self._lock:
+            self._engines.clear()
+            self._hits = self._misses = 0
+
+    def stats(self):
+        """Return a dictionary of statistics about the cache, with these keys: 'entries' (the number of parsed
+        engines held), 'hits' (forks of an engine that was already parsed) and 'misses' (files parsed)."""
+        with self._lock:
+            return {'entries': len(self._engines), 'hits': self._hits, 'misses': self._misses}
+
+
+# The corpus cache shared by every TemplateEngine in the process
+corpus_cache = CorpusCache()
+
+# The engine cache shared by every TemplateEngine in the process (see TemplateEngine.cached())
+engine_cache = EngineCache()
+
+
+def main(argv=None):
+    """Run the command-line interface.
+
+    For now there's just one command, 'generate', which streams outputs of a template to a file (or to
+    standard output) in one of several formats:
+
+        python -m engine generate --file templates/c5_template.txt --template PLOT_SKELETON --count 1000000
+            --seed 7 --out plots.jsonl.gz
+
+    Args:
+        argv:
+            A list of command-line arguments, or None to use sys.argv.
+    """
+    import argparse
+    import sinks
+    parser = argparse.ArgumentParser(prog='python -m engine', description='Template-based text generation.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    generate_parser = subparsers.add_parser('generate', help='Write outputs of a template to a file.')
+    generate_parser.add_argument('--file', required=True, help='Path to a template definitions file.')
+    generate_parser.add_argument('--template', required=True, help='Name of the template to generate from.')
+    generate_parser.add_argument('--count', type=int, required=True, help='Number of outputs to generate.')
+    generate_parser.add_argument('--seed', type=int, default=None, help='Random seed.')
+    generate_parser.add_argument(
+        '--out', default='-', help="Output path ('-' for standard output). A '.gz' suffix compresses the output."
+    )
+    generate_parser.add_argument(
+        '--format', choices=sorted(sinks.SINK_CLASSES), default=None,
+        help="Output format. By default, it's inferred from the output path, falling back to 'text'."
+    )
+    generate_parser.add_argument('--chunk-size', type=int, default=10000, help='Outputs generated at a time.')
+    generate_parser.add_argument('--mmap-corpora', action='store_true', help='Memory-map corpora.')
+    args = parser.parse_args(argv)
+    engine = TemplateEngine(file_path=args.file, random_seed=args.seed, mmap_corpora=args.mmap_corpora)
+    with sinks.open_sink(path=args.out, format=args.format) as sink:
+        outputs = engine.iter_generate(
+            template_name=args.template,
+            n=args.count,
+            seed=args.seed,
+            chunk_size=args.chunk_size,
+            provenance=sink.needs_provenance
+        )
+        sink.write_all(outputs)
 
 
+if __name__ == '__main__':
+    main()
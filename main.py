@@ -17,8 +17,9 @@ def demo():
     print(f"Demo by James{multi_line_output}")
     
 
-#demo()
-print("*Welcome to Yemi's Template World*")
+if __name__ == '__main__':
+    #demo()
+    print("*Welcome to Yemi's Template World*")
 
-# Uncomment this function to print out all your results, at any time (see grade.py)
-grade()
\ No newline at end of file
+    # Uncomment this function to print out all your results, at any time (see grade.py)
+    grade()
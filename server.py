@@ -0,0 +1,518 @@
+import argparse
+import asyncio
+import json
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import engine
+from engine import TemplateEngine
+
+
+# Batches smaller than this are generated one output at a time with generate(), since setting up a NumPy batch
+# costs more than it saves for just a few outputs
+MIN_NUMPY_BATCH = 16
+
+
+def generate_batch(template_engine, template_name, n):
+    """Generate n outputs of the template with the given name, in a single batch if NumPy is available.
+
+    Args:
+        template_engine:
+            A TemplateEngine object.
+        template_name:
+            A string, being the name of a template defined in the engine.
+        n:
+            An int, being the number of outputs to generate.
+
+    Returns:
+        A list of n strings.
+
+    Raises:
+        Exception:
+            There is no defined template with the given name.
+    """
+    if engine.numpy is not None and n >= MIN_NUMPY_BATCH:
+        return template_engine.generate_many(template_name=template_name, n=n)
+    generate = template_engine.generate
+    return [generate(template_name) for _ in range(n)]
+
+
+class Batcher:
+    """Coalesces concurrent requests for outputs of the same template into batches.
+
+    A request doesn't generate anything itself: it adds itself to the batcher's list of pending requests and
+    gets back a future. The first request to arrive schedules a flush for when the event loop next gets
+    around to its callbacks, so every request that arrives in the meantime (which, with many clients, or
+    with one client that sends requests without waiting for the responses, can be a lot of them) is generated
+    in one batch, and the batch is then sliced up among their futures. A batch is flushed right away once it
+    holds max_batch outputs, which bounds how long the requests behind it have to wait.
+
+    The batch is generated on the executor, not on the event loop, so the loop carries on reading requests
+    and writing responses for every other connection in the meantime. The engine isn't meant to be used from
+    several threads at once (its random generators and single-use pools would be shared), so the executor
+    should have a single thread, shared by every batcher of the engine.
+
+    Attributes:
+        template_engine:
+            The TemplateEngine object that generates the outputs.
+        template_name:
+            A string, being the name of the template whose outputs are generated.
+        executor:
+            The concurrent.futures.Executor on which the batches are generated.
+        max_batch:
+            An int, being the number of outputs at which a batch is flushed without waiting any longer.
+        delay:
+            A float, being how many seconds to wait for more requests after the first one arrives, or 0 to
+            flush as soon as the event loop is free.
+    """
+
+    def __init__(self, template_engine, template_name, executor, max_batch=4096, delay=0.0):
+        """Initialize a Batcher object.
+
+        Args:
+            template_engine:
+                A TemplateEngine object.
+            template_name:
+                A string, being the name of a template defined in the engine.
+            executor:
+                A concurrent.futures.Executor (with a single thread; see above) to generate the batches on.
+            max_batch:
+                An int, being the number of outputs at which a batch is flushed without waiting any longer.
+            delay:
+                A float, being how many seconds to wait for more requests after the first one arrives.
+        """
+        self.template_engine = template_engine
+        self.template_name = template_name
+        self.executor = executor
+        self.max_batch = max_batch
+        self.delay = delay
+        # A list of (n, future) tuples, one for each request waiting for the next flush
+        self._pending = []
+        self._pending_outputs = 0
+        self._flush_handle = None
+
+    def submit(self, n):
+        """Ask for n outputs in the next batch.
+
+        Returns:
+            An asyncio.Future, which will be set to a list of n strings (or to the Exception raised while
+            generating the batch).
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((n, future))
+        self._pending_outputs += n
+        if self._pending_outputs >= self.max_batch:
+            self.flush()
+        elif self._flush_handle is None:
+            if self.delay:
+                self._flush_handle = loop.call_later(self.delay, self.flush)
+            else:
+                self._flush_handle = loop.call_soon(self.flush)
+        return future
+
+    def flush(self):
+        """Start generating one batch for every pending request, on the executor. When it's done, each request
+        gets its share of the outputs (see _hand_out())."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, []
+        total, self._pending_outputs = self._pending_outputs, 0
+        if not pending:
+            return
+        generation = asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            partial(generate_batch, template_engine=self.template_engine, template_name=self.template_name, n=total)
+        )
+        generation.add_done_callback(partial(self._hand_out, pending))
+
+    @staticmethod
+    def _hand_out(pending, generation):
+        """Slice up a generated batch among the futures of the requests it was generated for."""
+        error = generation.exception()
+        if error is not None:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        outputs = generation.result()
+        start = 0
+        for n, future in pending:
+            # The request may have been cancelled in the meantime, if its client went away
+            if not future.done():
+                future.set_result(outputs[start:start + n])
+            start += n
+
+
+class GenerationServer:
+    """A server that generates text outputs for clients over a TCP or Unix socket, using asyncio.
+
+    The server holds a compiled TemplateEngine for each of a set of template definitions files. Clients send
+    requests as lines of JSON, and get responses back as lines of JSON. A request looks like this:
+
+        {"id": 1, "template": "PLOT_SKELETON", "n": 3, "file": "templates/c5_template.txt"}
+
+    where 'n' defaults to 1, 'id' is any value the client likes (it's echoed back, so that the client can
+    match responses to requests), and 'file' can be left out if only one of the files defines the template.
+    The response to it looks like this:
+
+        {"id": 1, "outputs": ["...", "...", "..."]}
+
+    or, if something went wrong, like {"id": 1, "error": "There is no defined template..."}. A client may send
+    any number of requests without waiting for the responses, which come back in the same order as the
+    requests. Requests for more than stream_chunk outputs get their outputs streamed over several lines, each
+    holding at most stream_chunk outputs; every line but the last has "more": true.
+
+    Small requests for the same template, whether from one client or many, are coalesced into batches (see
+    Batcher). Outputs are generated on a single worker thread, one batch or chunk at a time, never on the event
+    loop, so a large request doesn't hold up the other connections while it's generated. Memory use is bounded
+    by backpressure at every stage: each connection has at most max_pending requests in flight, beyond which
+    the server stops reading from it (so the client's writes eventually block), and the server waits for each
+    response line to drain to the client before writing the next, so a slow reader holds up only its own
+    streams.
+
+    Attributes:
+        engines:
+            A dictionary mapping the path of each template definitions file to its TemplateEngine object.
+        max_batch:
+            An int, being the number of outputs at which a batch is generated without waiting for more
+            requests.
+        max_pending:
+            An int, being the number of requests that a connection can have in flight at once.
+        stream_chunk:
+            An int, being the number of outputs per response line for streamed requests. Requests for at most
+            this many outputs are coalesced; larger ones are streamed.
+        max_count:
+            An int, being the largest number of outputs that a single request may ask for.
+        batch_delay:
+            A float, being how many seconds to wait for more requests before generating a batch (see Batcher).
+    """
+
+    def __init__(self, file_paths, random_seed=None, max_batch=4096, max_pending=64, stream_chunk=10000,
+                 max_count=10 ** 7, batch_delay=0.0, mmap_corpora=False):
+        """Initialize a GenerationServer object, compiling an engine for each of the given files.
+
+        Args:
+            file_paths:
+                A list of strings, each containing the path to a template definitions file.
+            random_seed:
+                A value that will be used to seed every engine's random generators, or None.
+            max_batch:
+                An int, being the number of outputs at which a batch is generated without waiting for more
+                requests.
+            max_pending:
+                An int, being the number of requests that a connection can have in flight at once.
+            stream_chunk:
+                An int, being the number of outputs per response line for streamed requests.
+            max_count:
+                An int, being the largest number of outputs that a single request may ask for.
+            batch_delay:
+                A float, being how many seconds to wait for more requests before generating a batch.
+            mmap_corpora:
+                If True, the engines memory-map their corpora (see TemplateEngine).
+        """
+        self.engines = {
+            file_path: TemplateEngine(file_path=file_path, random_seed=random_seed, mmap_corpora=mmap_corpora)
+            for file_path in file_paths
+        }
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.stream_chunk = stream_chunk
+        self.max_count = max_count
+        self.batch_delay = batch_delay
+        # Maps a (file path, template name) pair to the Batcher for that template
+        self._batchers = {}
+        # Every output is generated on this one thread (see Batcher)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='generation')
+
+    def _find_engine(self, template_name, file_path=None):
+        """Return the path of the file that defines the template with the given name, along with its engine.
+
+        Raises:
+            Exception:
+                The file isn't served, or (if no file is given) the template is defined in none of the files
+                or in more than one.
+        """
+        if file_path is not None:
+            if file_path not in self.engines:
+                raise Exception(f"The file {file_path} is not served. These files are: {', '.join(self.engines)}.")
+            return file_path, self.engines[file_path]
+        matches = [
+            file_path for file_path, template_engine in self.engines.items()
+            if template_name in template_engine._templates_by_name
+        ]
+        if len(matches) != 1:
+            if matches:
+                error_message = f"The template {template_name} is defined in several files: {', '.join(matches)}. "
+                error_message += "Pick one with 'file'."
+            else:
+                error_message = f"There is no defined template with the name {template_name}."
+            raise Exception(error_message)
+        return matches[0], self.engines[matches[0]]
+
+    def _parse_request(self, request):
+        """Check a decoded request, and return a (file path, engine, template name, n) tuple for it.
+
+        Raises:
+            Exception:
+                The request isn't valid.
+        """
+        template_name = request.get('template')
+        if not isinstance(template_name, str):
+            raise Exception("The request must give the name of a template as 'template'.")
+        n = request.get('n', 1)
+        if not isinstance(n, int) or isinstance(n, bool) or not 0 <= n <= self.max_count:
+            raise Exception(f"'n' must be an int between 0 and {self.max_count}.")
+        file_path, template_engine = self._find_engine(template_name=template_name, file_path=request.get('file'))
+        # Check the template name now, so that a bad one gets its own error rather than failing a whole batch
+        template_engine._get_template(template_name=template_name)
+        return file_path, template_engine, template_name, n
+
+    def _submit(self, file_path, template_engine, template_name, n):
+        """Add a request for n outputs to the batch for its template, and return its future."""
+        key = (file_path, template_name)
+        batcher = self._batchers.get(key)
+        if batcher is None:
+            batcher = self._batchers[key] = Batcher(
+                template_engine=template_engine,
+                template_name=template_name,
+                executor=self._executor,
+                max_batch=self.max_batch,
+                delay=self.batch_delay
+            )
+        return batcher.submit(n)
+
+    async def _handle_connection(self, reader, writer):
+        """Serve one client connection until it closes.
+
+        The connection is handled by two coroutines joined by a bounded queue: this one reads and parses
+        requests and puts one item per request on the queue (blocking once max_pending of them are waiting),
+        and _write_responses() takes them off in order and writes their responses.
+        """
+        responses = asyncio.Queue(maxsize=self.max_pending)
+        response_writer = asyncio.create_task(self._write_responses(responses, writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                request_id = None
+                try:
+                    try:
+                        request = json.loads(line)
+                    except ValueError:
+                        raise Exception("The request is not valid JSON.")
+                    if not isinstance(request, dict):
+                        raise Exception("The request must be a JSON object.")
+                    request_id = request.get('id')
+                    file_path, template_engine, template_name, n = self._parse_request(request)
+                except Exception as error:
+                    item = ('error', request_id, str(error))
+                else:
+                    if n <= self.stream_chunk:
+                        item = ('batch', request_id, self._submit(file_path, template_engine, template_name, n))
+                    else:
+                        item = ('stream', request_id, (template_engine, template_name, n))
+                await responses.put(item)
+        except (ConnectionError, ValueError):
+            pass  # The client went away, or sent a line too long to be a request
+        finally:
+            await responses.put(None)
+            await response_writer
+            writer.close()
+
+    async def _write_responses(self, responses, writer):
+        """Write the response to each item on the queue, in order, until the item None arrives.
+
+        If the client goes away, this carries on taking items off the queue (without writing anything), so that
+        the reading side never blocks on a full queue.
+        """
+        dumps = json.JSONEncoder(ensure_ascii=False).encode
+        connected = True
+        while True:
+            item = await responses.get()
+            if item is None:
+                return
+            kind, request_id, payload = item
+            if kind == 'batch':
+                try:
+                    payload = [{'id': request_id, 'outputs': await payload}]
+                except Exception as error:
+                    payload = [{'id': request_id, 'error': str(error)}]
+            elif kind == 'error':
+                payload = [{'id': request_id, 'error': payload}]
+            if not connected:
+                continue
+            try:
+                if kind == 'stream':
+                    # A streamed response is generated a chunk at a time, and each chunk has to reach the client
+                    # before the next one is generated
+                    stream = self._stream(request_id, *payload)
+                    try:
+                        async for response in stream:
+                            writer.write(f'{dumps(response)}\n'.encode('utf-8'))
+                            await writer.drain()
+                    finally:
+                        await stream.aclose()
+                else:
+                    for response in payload:
+                        writer.write(f'{dumps(response)}\n'.encode('utf-8'))
+                        await writer.drain()
+            except ConnectionError:
+                connected = False
+
+    async def _stream(self, request_id, template_engine, template_name, n):
+        """Generate the response lines for a streamed request, one chunk of outputs at a time, on the executor."""
+        loop = asyncio.get_running_loop()
+        while n:
+            chunk_size = min(n, self.stream_chunk)
+            try:
+                outputs = await loop.run_in_executor(
+                    self._executor,
+                    partial(generate_batch, template_engine=template_engine, template_name=template_name, n=chunk_size)
+                )
+            except Exception as error:
+                yield {'id': request_id, 'error': str(error)}
+                return
+            n -= chunk_size
+            response = {'id': request_id, 'outputs': outputs}
+            if n:
+                response['more'] = True
+            yield response
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """Start listening for connections, and return the asyncio.Server.
+
+        Args:
+            host:
+                A string, being the host to listen on over TCP.
+            port:
+                An int, being the port to listen on over TCP, or 0 to pick a free one (see the returned server's
+                'sockets' attribute for the one picked).
+            path:
+                A string containing the path of a Unix socket to listen on instead of TCP, or None.
+        """
+        if path is not None:
+            return await asyncio.start_unix_server(self._handle_connection, path=path)
+        return await asyncio.start_server(self._handle_connection, host=host, port=port)
+
+    async def serve_forever(self, host='127.0.0.1', port=0, path=None):
+        """Start listening for connections (see start()) and serve them until cancelled."""
+        server = await self.start(host=host, port=port, path=path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the thread that generates the outputs, once it has finished what it's working on."""
+        self._executor.shutdown(wait=False)
+
+
+class Client:
+    """A simple blocking client for a GenerationServer, mostly for trying the server out and for testing.
+
+    Usage:
+        with Client(port=8765) as client:
+            outputs = client.generate('PLOT_SKELETON', n=10)
+    """
+
+    def __init__(self, host='127.0.0.1', port=8765, path=None):
+        """Initialize a Client object, connecting to the server over TCP or (if 'path' is given) a Unix socket."""
+        if path is not None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(path)
+        else:
+            self._socket = socket.create_connection((host, port))
+        self._file = self._socket.makefile('rwb')
+        self._next_id = 0
+
+    def send(self, template_name, n=1, file_path=None):
+        """Send a request without waiting for its response, and return the request's id."""
+        self._next_id += 1
+        request = {'id': self._next_id, 'template': template_name, 'n': n}
+        if file_path is not None:
+            request['file'] = file_path
+        self._file.write(f'{json.dumps(request)}\n'.encode('utf-8'))
+        self._file.flush()
+        return self._next_id
+
+    def receive(self):
+        """Wait for the response to the oldest request still awaiting one, and return its outputs.
+
+        Raises:
+            Exception:
+                The server responded with an error, or closed the connection.
+        """
+        outputs = []
+        while True:
+            line = self._file.readline()
+            if not line:
+                raise Exception("The server closed the connection.")
+            response = json.loads(line)
+            if 'error' in response:
+                raise Exception(response['error'])
+            outputs.extend(response['outputs'])
+            if not response.get('more'):
+                return outputs
+
+    def generate(self, template_name, n=1, file_path=None):
+        """Request n outputs of the template with the given name, and return them as a list of strings."""
+        self.send(template_name=template_name, n=n, file_path=file_path)
+        return self.receive()
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main(argv=None):
+    """Run the server from the command line. Run this from the root of the repository:
+
+        python server.py templates/c2_template.txt templates/c5_template.txt --port 8765
+        python server.py templates/*.txt --unix /tmp/engine.sock
+
+    Args:
+        argv:
+            A list of command-line arguments, or None to use sys.argv.
+    """
+    parser = argparse.ArgumentParser(prog='python server.py', description='Serve template outputs over a socket.')
+    parser.add_argument('files', nargs='+', help='Paths to template definitions files.')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen on.')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port to listen on.')
+    parser.add_argument('--unix', metavar='PATH', default=None, help='Listen on a Unix socket instead of TCP.')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed.')
+    parser.add_argument('--max-batch', type=int, default=4096, help='Outputs at which a batch is generated.')
+    parser.add_argument('--max-pending', type=int, default=64, help='Requests in flight per connection.')
+    parser.add_argument('--stream-chunk', type=int, default=10000, help='Outputs per line of a streamed response.')
+    parser.add_argument('--batch-delay', type=float, default=0.0, help='Seconds to wait for more requests.')
+    parser.add_argument('--mmap-corpora', action='store_true', help='Memory-map corpora.')
+    args = parser.parse_args(argv)
+    server = GenerationServer(
+        file_paths=args.files,
+        random_seed=args.seed,
+        max_batch=args.max_batch,
+        max_pending=args.max_pending,
+        stream_chunk=args.stream_chunk,
+        batch_delay=args.batch_delay,
+        mmap_corpora=args.mmap_corpora
+    )
+    try:
+        asyncio.run(server.serve_forever(host=args.host, port=args.port, path=args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
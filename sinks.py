@@ -0,0 +1,187 @@
+import csv
+import gzip
+import io
+import json
+import sys
+from itertools import islice
+
+
+class Sink:
+    """A destination for generated text outputs, which writes them to a file in large buffered chunks.
+
+    Rather than writing each output as soon as it arrives (which, for tens of millions of short outputs,
+    means tens of millions of tiny writes), a sink formats outputs in batches and collects the formatted
+    text in a buffer, which it writes out in one go whenever it grows past buffer_size characters. Memory
+    use is therefore bounded by the size of the buffer, however many outputs pass through the sink.
+
+    This is a base class: subclasses decide how an output is formatted by overriding _format_many().
+
+    Attributes:
+        file:
+            A file object opened for writing text.
+        buffer_size:
+            An int, being the number of characters to collect before writing them to the file.
+        needs_provenance:
+            A bool indicating whether the sink expects each output to be paired with the values that filled
+            its slots, as produced by TemplateEngine.iter_generate(provenance=True).
+    """
+
+    needs_provenance = False
+
+    # The number of outputs formatted at a time by write_all()
+    BATCH_SIZE = 4096
+
+    def __init__(self, file, buffer_size=1 << 20, close_file=True):
+        """Initialize a Sink object.
+
+        Args:
+            file:
+                A file object opened for writing text.
+            buffer_size:
+                An int, being the number of characters to collect before writing them to the file.
+            close_file:
+                If True, close() also closes the file.
+        """
+        self.file = file
+        self.buffer_size = buffer_size
+        self._close_file = close_file
+        self._buffer = []
+        self._buffered = 0
+
+    def _format_many(self, outputs):
+        """Return a string containing the formatted version of each of the given outputs."""
+        raise NotImplementedError
+
+    def write(self, output):
+        """Write a single output (or, for sinks that need provenance, an (output, slot values) tuple)."""
+        self._append(self._format_many([output]))
+
+    def write_all(self, outputs):
+        """Write every output from the given iterable, consuming it a batch at a time.
+
+        Args:
+            outputs:
+                An iterable of outputs, such as the generator returned by TemplateEngine.iter_generate().
+        """
+        outputs = iter(outputs)
+        while True:
+            batch = list(islice(outputs, self.BATCH_SIZE))
+            if not batch:
+                break
+            self._append(self._format_many(batch))
+
+    def _append(self, text):
+        """Add the given text to the buffer, writing the buffer out if it has grown large enough."""
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write everything in the buffer to the file."""
+        if self._buffer:
+            self.file.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        self.file.flush()
+
+    def close(self):
+        """Flush the buffer, and close the file if this sink opened it."""
+        self.flush()
+        if self._close_file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TextSink(Sink):
+    """A sink that writes each output on its own line, as plain text.
+
+    So that every line is one output, even for templates whose outputs span several lines, a newline within an
+    output is written as a backslash followed by 'n', and a backslash as two backslashes.
+    """
+
+    def _format_many(self, outputs):
+        text = '\n'.join(outputs) + '\n'
+        # Escaping is only needed if some output has a newline or a backslash, which is rare, so check the whole
+        # batch at once first
+        if text.count('\n') == len(outputs) and '\\' not in text:
+            return text
+        return '\n'.join(output.replace('\\', '\\\\').replace('\n', '\\n') for output in outputs) + '\n'
+
+
+class JSONLSink(Sink):
+    """A sink that writes each output as a line of JSON, along with the values that filled its slots.
+
+    Each line looks like this: {"text": "the red moon", "slots": [["DET", "the"], ["NOUN", "moon"]]}.
+    """
+
+    needs_provenance = True
+
+    def _format_many(self, outputs):
+        dumps = json.JSONEncoder(ensure_ascii=False).encode
+        return ''.join([f'{dumps({"text": text, "slots": slots})}\n' for text, slots in outputs])
+
+
+class CSVSink(Sink):
+    """A sink that writes the outputs as CSV, with a column for the output and one for each slot occurrence.
+
+    The first row is a header, giving 'text' followed by the name of the slot at each occurrence.
+    """
+
+    needs_provenance = True
+
+    def __init__(self, file, buffer_size=1 << 20, close_file=True):
+        super().__init__(file=file, buffer_size=buffer_size, close_file=close_file)
+        self._wrote_header = False
+
+    def _format_many(self, outputs):
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator='\n')
+        if not self._wrote_header:
+            _, slots = outputs[0]
+            writer.writerow(['text'] + [slot_name for slot_name, _ in slots])
+            self._wrote_header = True
+        writer.writerows([output] + [value for _, value in slots] for output, slots in outputs)
+        return text.getvalue()
+
+
+# The sink class for each output format
+SINK_CLASSES = {'text': TextSink, 'jsonl': JSONLSink, 'csv': CSVSink}
+
+
+def open_sink(path, format=None, buffer_size=1 << 20):
+    """Open a sink that writes to the file at the given path.
+
+    Args:
+        path:
+            A string containing the path to write to, or '-' for standard output. If the path ends with '.gz',
+            the output is gzip-compressed.
+        format:
+            A string, being one of the keys of SINK_CLASSES. If None is passed, the format is inferred from the
+            path's extension (ignoring any '.gz'): '.jsonl' and '.csv' get their own formats, and anything else
+            is written as plain text.
+        buffer_size:
+            An int, being the number of characters to collect before writing them to the file.
+
+    Returns:
+        A Sink object, which should be closed when you're done with it (or used in a 'with' statement).
+    """
+    compressed = path.endswith('.gz')
+    base_path = path[:-len('.gz')] if compressed else path
+    if format is None:
+        extension = base_path.rsplit('.', 1)[-1].lower() if '.' in base_path else ''
+        format = extension if extension in SINK_CLASSES else 'text'
+    sink_class = SINK_CLASSES[format]
+    if path == '-':
+        return sink_class(file=sys.stdout, buffer_size=buffer_size, close_file=False)
+    if compressed:
+        # A middling compression level: the top levels cost far more time than they save in space
+        file = gzip.open(path, 'wt', encoding='utf-8', newline='', compresslevel=6)
+    else:
+        file = open(path, 'w', encoding='utf-8', newline='')
+    return sink_class(file=file, buffer_size=buffer_size)
@@ -0,0 +1,326 @@
+import os
+import random
+import tempfile
+import unittest
+
+from engine import IndexPermutation, Slot, TemplateEngine, _count_syllables
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def make_engine(templates, slots, random_seed=0):
+    """Return a TemplateEngine for a template definitions file with the given template and slot lines.
+
+    Args:
+        templates:
+            A list of strings, being the lines of the templates section.
+        slots:
+            A list of strings, being the lines of the slots section.
+        random_seed:
+            A value from which the engine's random generators are seeded.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, 'templates.txt')
+        with open(file_path, 'w') as definitions_file:
+            definitions_file.write('<BEGIN TEMPLATES>\n' + '\n'.join(templates) + '\n<END TEMPLATES>\n\n')
+            definitions_file.write('<BEGIN SLOTS>\n' + '\n'.join(slots) + '\n<END SLOTS>\n')
+        return TemplateEngine(file_path=file_path, random_seed=random_seed, lazy_corpora=False)
+
+
+def write_file(path, contents):
+    """Write the given string to the file at the given path, making sure that the edit shows up even on file
+    systems with coarse modification times."""
+    with open(path, 'w') as file:
+        file.write(contents)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+@unittest.skipUnless(numpy, 'NumPy is not installed')
+class GenerateManyTest(unittest.TestCase):
+
+    def test_same_seed_gives_same_outputs(self):
+        outputs = [
+            TemplateEngine(file_path='templates/c1_template.txt', random_seed=0).generate_many('YES_CORPUS', 50, seed=7)
+            for _ in range(2)
+        ]
+        self.assertEqual(len(outputs[0]), 50)
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_different_seeds_give_different_outputs(self):
+        engine = TemplateEngine(file_path='templates/c1_template.txt', random_seed=0)
+        self.assertNotEqual(
+            engine.generate_many('YES_CORPUS', 50, seed=1), engine.generate_many('YES_CORPUS', 50, seed=2)
+        )
+
+    def test_outputs_are_made_of_the_slot_values(self):
+        engine = make_engine(templates=['T -><A>-<B>'], slots=['A -> x,y,z', 'B -> 1,2^3'])
+        for output in engine.generate_many('T', 200, seed=0):
+            first, second = output.split('-')
+            self.assertIn(first, ('x', 'y', 'z'))
+            self.assertIn(second, ('1', '2'))
+
+
+@unittest.skipUnless(numpy, 'NumPy is not installed')
+class GenerateParallelTest(unittest.TestCase):
+
+    def test_outputs_are_the_same_for_any_number_of_workers(self):
+        engine = TemplateEngine(file_path='templates/c1_template.txt', random_seed=0)
+        outputs = [
+            engine.generate_parallel('YES_CORPUS', 250, workers=workers, seed=3, chunk_size=40)
+            for workers in (1, 2, 3)
+        ]
+        self.assertEqual(len(outputs[0]), 250)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
+    def test_outputs_match_iter_generate(self):
+        engine = TemplateEngine(file_path='templates/c1_template.txt', random_seed=0)
+        self.assertEqual(
+            engine.generate_parallel('YES_CORPUS', 100, workers=2, seed=3, chunk_size=30),
+            list(engine.iter_generate('YES_CORPUS', n=100, seed=3, chunk_size=30))
+        )
+
+
+class SingleUsePolicyTest(unittest.TestCase):
+
+    def test_advanced_templates_load_with_every_policy(self):
+        for policy in Slot.SINGLE_USE_POLICIES:
+            engine = TemplateEngine(
+                file_path='templates/advanced_templates.txt', random_seed=0, single_use_policy=policy
+            )
+            for template in engine.templates:
+                engine.generate(template.name)
+
+    def test_shuffle_bag_draws_weighted_slots_by_weight(self):
+        slot = Slot(name='W', values=['a', 'b'], weights=[1, 3], policy='shuffle_bag')
+        rng = random.Random(0)
+        draws = [slot.fill(rng) for _ in range(4000)]
+        self.assertAlmostEqual(draws.count('b') / len(draws), 0.75, delta=0.05)
+
+    def test_shuffle_bag_draws_each_unweighted_value_once_per_cycle(self):
+        slot = Slot(name='W', values=['a', 'b', 'c'], policy='shuffle_bag')
+        for _ in range(5):
+            self.assertEqual(sorted(slot.fill() for _ in range(3)), ['a', 'b', 'c'])
+
+
+class TemplatePackTest(unittest.TestCase):
+
+    def setUp(self):
+        # Corpora are looked up in the 'corpora' folder of the working directory, so work in a fresh one
+        self.directory = tempfile.TemporaryDirectory()
+        self.original_directory = os.getcwd()
+        os.chdir(self.directory.name)
+        os.mkdir('corpora')
+        write_file('templates.txt', '<BEGIN TEMPLATES>\nT -><A> <B>\n<END TEMPLATES>\n\n'
+                   '<BEGIN SLOTS>\nA -> red,green,blue\nB -> $words.txt\n<END SLOTS>\n')
+        write_file('corpora/words.txt', 'moon\nsun\nstar\n')
+        engine = TemplateEngine(file_path='templates.txt', random_seed=0)
+        engine.compile_pack('templates.pack')
+
+    def tearDown(self):
+        os.chdir(self.original_directory)
+        self.directory.cleanup()
+
+    def test_pack_gives_the_same_outputs_as_a_fresh_engine(self):
+        packed = TemplateEngine.from_pack('templates.pack', random_seed=5, verify=True)
+        fresh = TemplateEngine(file_path='templates.txt', random_seed=5)
+        self.assertEqual([packed.generate('T') for _ in range(50)], [fresh.generate('T') for _ in range(50)])
+
+    def test_edited_definitions_make_the_pack_stale(self):
+        write_file('templates.txt', '<BEGIN TEMPLATES>\nT -><A>\n<END TEMPLATES>\n\n'
+                   '<BEGIN SLOTS>\nA -> red\n<END SLOTS>\n')
+        with self.assertRaisesRegex(Exception, 'stale'):
+            TemplateEngine.from_pack('templates.pack', verify=True)
+
+    def test_edited_corpus_makes_the_pack_stale(self):
+        write_file('corpora/words.txt', 'moon\nsun\ncomet\n')
+        with self.assertRaisesRegex(Exception, 'stale'):
+            TemplateEngine.from_pack('templates.pack', verify=True)
+
+    def test_other_files_are_rejected(self):
+        write_file('not.pack', 'hello')
+        with self.assertRaisesRegex(Exception, 'not a template pack'):
+            TemplateEngine.from_pack('not.pack')
+
+
+class ReloadTest(unittest.TestCase):
+
+    TEMPLATES = ['T -><A> <B>', 'U -><@T>!', 'V -><A>']
+    SLOTS = ['A -> red', 'B -> $words.txt']
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.original_directory = os.getcwd()
+        os.chdir(self.directory.name)
+        os.mkdir('corpora')
+        write_file('corpora/words.txt', 'moon')  # Corpora are split on newlines, so a last one adds a blank value
+        self.write_definitions(templates=self.TEMPLATES, slots=self.SLOTS)
+        self.engine = TemplateEngine(file_path='templates.txt', random_seed=0, lazy_corpora=False)
+
+    def tearDown(self):
+        os.chdir(self.original_directory)
+        self.directory.cleanup()
+
+    @staticmethod
+    def write_definitions(templates, slots):
+        write_file('templates.txt', '<BEGIN TEMPLATES>\n' + '\n'.join(templates) + '\n<END TEMPLATES>\n\n'
+                   '<BEGIN SLOTS>\n' + '\n'.join(slots) + '\n<END SLOTS>\n')
+
+    def test_nothing_changed(self):
+        self.assertFalse(self.engine.reload())
+        self.assertEqual(self.engine.generate('U'), 'red moon!')
+
+    def test_corpus_change(self):
+        write_file('corpora/words.txt', 'sun')
+        self.assertTrue(self.engine.reload())
+        self.assertEqual(self.engine.generate('U'), 'red sun!')
+
+    def test_slot_change(self):
+        unchanged = self.engine._get_template(template_name='V')
+        self.write_definitions(templates=self.TEMPLATES, slots=['A -> blue', 'B -> $words.txt'])
+        self.assertTrue(self.engine.reload())
+        self.assertEqual(self.engine.generate('U'), 'blue moon!')
+        self.assertEqual(self.engine.generate('V'), 'blue')
+        self.assertIsNot(self.engine._get_template(template_name='V'), unchanged)
+
+    def test_template_change_recompiles_only_what_depends_on_it(self):
+        unchanged = self.engine._get_template(template_name='V')
+        self.write_definitions(templates=['T -><B> <A>', 'U -><@T>!', 'V -><A>'], slots=self.SLOTS)
+        self.assertTrue(self.engine.reload())
+        self.assertEqual(self.engine.generate('U'), 'moon red!')
+        self.assertIs(self.engine._get_template(template_name='V'), unchanged)
+
+    def test_added_and_removed_definitions(self):
+        self.write_definitions(templates=['W -><C>', 'T -><A> <B>', 'U -><@T>!'], slots=['C -> new'] + self.SLOTS)
+        self.engine.reload()
+        self.assertEqual([template.name for template in self.engine.templates], ['W', 'T', 'U'])
+        self.assertEqual(self.engine.generate('W'), 'new')
+        with self.assertRaisesRegex(Exception, 'V'):
+            self.engine.generate('V')
+
+    def test_malformed_line_keeps_the_old_state(self):
+        self.write_definitions(templates=self.TEMPLATES, slots=['A red', 'B -> $words.txt'])
+        with self.assertRaisesRegex(Exception, "templates.txt, line 8, column 1: Malformed slot definition"):
+            self.engine.reload()
+        self.assertEqual(self.engine.generate('U'), 'red moon!')
+        # Fixing the line makes the next reload work, with the slot as it is now
+        self.write_definitions(templates=self.TEMPLATES, slots=['A -> green', 'B -> $words.txt'])
+        self.assertTrue(self.engine.reload())
+        self.assertEqual(self.engine.generate('U'), 'green moon!')
+
+    def test_reference_cycle_is_rejected(self):
+        self.write_definitions(templates=['T -><A> <@U>', 'U -><@T>!', 'V -><A>'], slots=self.SLOTS)
+        with self.assertRaisesRegex(Exception, 'cycle|itself'):
+            self.engine.reload()
+        self.assertEqual(self.engine.generate('U'), 'red moon!')
+
+    def test_errors_give_line_numbers_after_lines_were_added(self):
+        self.write_definitions(templates=['# A comment', ''] + self.TEMPLATES, slots=self.SLOTS)
+        self.engine.reload()
+        # 'T' isn't edited this time, so its line number comes from the record of where each definition is
+        self.write_definitions(templates=['# A comment', ''] + self.TEMPLATES, slots=['A -> red'])
+        with self.assertRaisesRegex(Exception, "templates.txt, line 4, column 9: .*undefined slot 'B'"):
+            self.engine.reload()
+
+    def test_duplicate_names_are_reported_on_the_later_line(self):
+        self.write_definitions(templates=['V -><B>'] + self.TEMPLATES, slots=self.SLOTS)
+        with self.assertRaisesRegex(Exception, "templates.txt, line 5, column 1: Multiple templates with the name 'V'"):
+            self.engine.reload()
+
+
+class GenerateUniqueTest(unittest.TestCase):
+
+    def test_index_permutation_is_a_permutation(self):
+        for size in range(1, 70):
+            self.assertEqual(sorted(IndexPermutation(size=size, seed=size)), list(range(size)))
+
+    def test_outputs_are_distinct_up_to_the_count(self):
+        engine = make_engine(templates=['T -><A>-<B>-<A>'], slots=['A -> a,b,c', 'B -> 1,2^5'])
+        count = engine.count('T')
+        self.assertEqual(count, 18)
+        every_output = {engine.output_at('T', k) for k in range(count)}
+        for seed in range(5):
+            outputs = engine.generate_unique('T', count, seed=seed)
+            self.assertEqual(len(set(outputs)), count)
+            self.assertEqual(set(outputs), every_output)
+
+    def test_fewer_outputs_are_the_start_of_more(self):
+        engine = make_engine(templates=['T -><A><A>'], slots=['A -> a,b,c,d,e'])
+        outputs = engine.generate_unique('T', 25, seed=1)
+        self.assertEqual(engine.generate_unique('T', 10, seed=1), outputs[:10])
+
+    def test_more_outputs_than_the_count_are_rejected(self):
+        engine = make_engine(templates=['T -><A>'], slots=['A -> a,b'])
+        with self.assertRaisesRegex(Exception, 'only produce 2 distinct outputs'):
+            engine.generate_unique('T', 3)
+
+
+class FilterTest(unittest.TestCase):
+
+    def test_cap_works_like_str_capitalize(self):
+        engine = make_engine(templates=['T -><A|cap>'], slots=['A -> hELLO wORLD'])
+        self.assertEqual(engine.generate('T'), 'hELLO wORLD'.capitalize())
+
+    def test_template_cap_lower_cases_everything_after_the_first_character(self):
+        engine = make_engine(templates=['T|cap -> <A> And <B>'], slots=['A -> hELLO', 'B -> WORLD'])
+        self.assertEqual(engine.generate('T'), ' Hello and world')
+
+    def test_capitalized_template_matches_capitalizing_its_output(self):
+        engine = TemplateEngine(file_path='templates/c2_template.txt', random_seed=0)
+        for k in range(0, engine.count('LOWERCASE'), 97):
+            self.assertEqual(
+                engine.output_at('LOWERCASE_CAPITALIZED', k), engine.output_at('LOWERCASE', k).capitalize()
+            )
+
+
+class RhymeTest(unittest.TestCase):
+
+    def test_rhyme_differs_from_its_target_when_it_can(self):
+        engine = TemplateEngine(file_path='templates/c8_template.txt', random_seed=0)
+        template = engine._get_template(template_name='QUATRAIN')
+        for _ in range(500):
+            _, fills = template._render()
+            for position, target in template._rhymes.items():
+                self.assertNotEqual(fills[position].lower(), fills[target].lower())
+
+    def test_rhyme_falls_back_to_its_target_when_nothing_else_rhymes(self):
+        engine = make_engine(templates=['T -> <W> <W|rhyme=W>'], slots=['W -> cat,dog'])
+        for _ in range(20):
+            first, second = engine.generate('T').split()
+            self.assertEqual(first, second)
+
+
+class SyllableTest(unittest.TestCase):
+
+    def test_silent_e_before_s(self):
+        for word, syllables in [('dives', 1), ('times', 1), ('places', 2), ('bottles', 2), ('horses', 2)]:
+            self.assertEqual(_count_syllables(word), syllables, word)
+
+    def test_haiku_lines_have_five_seven_and_five_syllables(self):
+        engine = TemplateEngine(file_path='templates/c8_template.txt', random_seed=0)
+        for _ in range(100):
+            lines = engine.generate('HAIKU').split('\n')
+            self.assertEqual([_count_syllables(line) for line in lines], [5, 7, 5], lines)
+
+
+class LengthTest(unittest.TestCase):
+
+    def test_generated_lengths_are_within_the_limits(self):
+        engine = TemplateEngine(file_path='templates/advanced_templates.txt', random_seed=0)
+        for _ in range(200):
+            output = engine.generate('COMPLEX_SENTENCE', min_len=60, max_len=70)
+            self.assertTrue(60 <= len(output) <= 70, output)
+
+    def test_values_of_weight_zero_are_not_counted_on(self):
+        engine = make_engine(templates=['T -><W><W>'], slots=['W -> aaaaaa^0,b,cc'])
+        self.assertEqual(engine.generate('T', min_len=4), 'cccc')
+        with self.assertRaisesRegex(Exception, "can't produce an output of at least 7 characters"):
+            engine.generate('T', min_len=7)
+
+
+if __name__ == '__main__':
+    unittest.main()
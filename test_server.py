@@ -0,0 +1,92 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import server
+from server import Client, GenerationServer
+
+
+class GenerationServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        file_path = os.path.join(self.directory.name, 'templates.txt')
+        with open(file_path, 'w') as definitions_file:
+            definitions_file.write('<BEGIN TEMPLATES>\nLETTER -><A>\nDIGIT -><B>\n<END TEMPLATES>\n\n'
+                                   '<BEGIN SLOTS>\nA -> x,y,z\nB -> 1,2,3\n<END SLOTS>\n')
+        self.server = GenerationServer(file_paths=[file_path], random_seed=0, stream_chunk=10)
+        # Run the server's event loop on a thread of its own, so that the tests can use the blocking Client
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.listener = asyncio.run_coroutine_threadsafe(self.server.start(port=0), self.loop).result()
+        self.client = Client(port=self.listener.sockets[0].getsockname()[1])
+
+    def tearDown(self):
+        self.client.close()
+        # The listener belongs to the event loop's thread, so it has to be closed there
+        asyncio.run_coroutine_threadsafe(self.close_listener(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.server.close()
+        self.directory.cleanup()
+
+    async def close_listener(self):
+        self.listener.close()
+        await self.listener.wait_closed()
+
+    def test_batch(self):
+        outputs = self.client.generate('LETTER', n=5)
+        self.assertEqual(len(outputs), 5)
+        self.assertTrue(set(outputs) <= {'x', 'y', 'z'})
+
+    def test_stream(self):
+        self.client.send('DIGIT', n=25)
+        lines = [json.loads(self.client._file.readline()) for _ in range(3)]
+        self.assertEqual([len(line['outputs']) for line in lines], [10, 10, 5])
+        self.assertEqual([line.get('more', False) for line in lines], [True, True, False])
+        self.assertTrue(all(set(line['outputs']) <= {'1', '2', '3'} for line in lines))
+
+    def test_pipelined_requests_are_answered_in_order(self):
+        requests = [('LETTER', 3), ('DIGIT', 25), ('LETTER', 1), ('DIGIT', 2), ('LETTER', 12)]
+        for template_name, n in requests:
+            self.client.send(template_name, n=n)
+        for template_name, n in requests:
+            outputs = self.client.receive()
+            self.assertEqual(len(outputs), n)
+            self.assertTrue(set(outputs) <= ({'x', 'y', 'z'} if template_name == 'LETTER' else {'1', '2', '3'}))
+
+    def test_unknown_template(self):
+        with self.assertRaisesRegex(Exception, 'no defined template with the name NOPE'):
+            self.client.generate('NOPE')
+        # The connection carries on working
+        self.assertEqual(len(self.client.generate('LETTER', n=2)), 2)
+
+    def test_no_outputs(self):
+        self.assertEqual(self.client.generate('LETTER', n=0), [])
+        self.assertEqual(len(self.client.generate('LETTER', n=1)), 1)
+
+    def test_outputs_are_not_generated_on_the_event_loop(self):
+        threads = set()
+        generate_batch = server.generate_batch
+
+        def recording_generate_batch(**kwargs):
+            threads.add(threading.current_thread())
+            return generate_batch(**kwargs)
+
+        server.generate_batch = recording_generate_batch
+        try:
+            self.client.generate('LETTER', n=3)
+            self.client.generate('DIGIT', n=25)
+        finally:
+            server.generate_batch = generate_batch
+        self.assertTrue(threads)
+        self.assertNotIn(self.thread, threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
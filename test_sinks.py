@@ -0,0 +1,45 @@
+import io
+import json
+import unittest
+
+from engine import TemplateEngine
+from sinks import JSONLSink, TextSink
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TextSinkTest(unittest.TestCase):
+
+    def test_each_output_is_one_line(self):
+        file = io.StringIO()
+        with TextSink(file=file, close_file=False) as sink:
+            sink.write_all(['one', 'two\nlines', 'back\\slash'])
+        self.assertEqual(file.getvalue(), 'one\ntwo\\nlines\nback\\\\slash\n')
+
+    def test_outputs_without_newlines_are_written_as_they_are(self):
+        file = io.StringIO()
+        with TextSink(file=file, close_file=False) as sink:
+            sink.write_all(['a b', 'c'])
+        self.assertEqual(file.getvalue(), 'a b\nc\n')
+
+
+@unittest.skipUnless(numpy, 'NumPy is not installed')
+class ProvenanceTest(unittest.TestCase):
+
+    def test_slot_names_leave_out_filters(self):
+        engine = TemplateEngine(file_path='templates/c9_template.txt', random_seed=0)
+        file = io.StringIO()
+        with JSONLSink(file=file, close_file=False) as sink:
+            sink.write_all(engine.iter_generate('LETTER', n=3, provenance=True))
+        for line in file.getvalue().splitlines():
+            record = json.loads(line)
+            slot_names = [slot_name for slot_name, _ in record['slots']]
+            self.assertEqual(slot_names[:2], ['ADJ', 'START'])
+            self.assertTrue(all('|' not in slot_name for slot_name in slot_names))
+
+
+if __name__ == '__main__':
+    unittest.main()